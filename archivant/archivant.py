@@ -1,21 +1,37 @@
 import os
+import re
+import time
+from threading import Lock
 from numbers import Integral
 from utils.es import Elasticsearch
 from elasticsearch import NotFoundError, ConflictError
 from uuid import uuid4
 from fsdb import Fsdb
-from fsdb.hashtools import calc_file_digest, calc_digest
 from copy import deepcopy
 from urlparse import urlparse
 from json import dumps
 
 from libreantdb import DB
+from libreantdb.querycache import QueryCache, SimilarCache
+from libreantdb.counters import DownloadCounter
 from exceptions import NotFoundException, FileOpNotSupported, ConflictException
+from ingest import ingest, SpoolFile
+from digestset import DigestSet
+from fsck import Fsck, STATE_FILE
+from shards import ShardedFsdb
+from resolvers import FsdbResolver, ObjectStoreResolver
+from diskcache import DiskCache
+from compression import is_compressible, ingest_compressed, decode
+from executors import ThreadExecutor
+from uploads import UploadManager
 
 from logging import getLogger
 log = getLogger('archivant')
 
 
+SHA1_RE = re.compile('^[0-9a-f]{40}$')
+
+
 class Archivant():
     ''' Implementation of a Data Access Layer
 
@@ -29,21 +45,62 @@ class Archivant():
 
         If you won't configure the FSDB_PATH parameter, fsdb will not be initialized
         and archivant will start in metadata-only mode.
+        FSDB_PATH can also be a list of paths, or of [path, weight] pairs,
+        in order to spread files over several devices (see :py:mod:`archivant.shards`).
         In metdata-only mode all file related functions will raise FileOpNotSupported.
+
+        Attachment contents can also be kept in an S3 compatible object store
+        configured with OBJECT_STORE, see :py:mod:`archivant.resolvers`.
+        Objects downloaded from it are cached in OBJECT_CACHE_PATH,
+        up to OBJECT_CACHE_SIZE bytes.
+
+        If PREHASH_LOCAL_FILES is set, files given as local paths are hashed
+        before being copied, so that the ones already stored are not written
+        at all, while new ones are read twice (see :py:func:`archivant.ingest.ingest`).
+
+        If COMPRESS_ATTACHMENTS is set, compressible contents are stored
+        compressed, see :py:mod:`archivant.compression`, except the ones
+        of upload sessions, that are already hashed and spooled in fsdb.
+
+        Big files can be uploaded in chunks through upload sessions
+        (see :py:mod:`archivant.uploads`), sessions not updated for
+        UPLOAD_EXPIRE seconds are removed.
+
+        If QUERY_CACHE_SIZE is set, search results are cached in memory,
+        up to that number of bytes, for QUERY_CACHE_TTL seconds at most
+        (see :py:mod:`libreantdb.querycache`).
+        Similar volumes are cached for SIMILAR_CACHE_SIZE volumes,
+        and refreshed after SIMILAR_CACHE_TTL seconds.
     '''
 
     def __init__(self, conf={}):
         defaults = {
             'FSDB_PATH': None,
             'ES_HOSTS': None,
-            'ES_INDEXNAME': None
+            'ES_INDEXNAME': None,
+            'DOWNLOAD_COUNT_FLUSH_INTERVAL': 0,
+            'DOWNLOAD_COUNT_JOURNAL': None,
+            'GC_GRACE_PERIOD': 3600,
+            'OBJECT_STORE': None,
+            'OBJECT_CACHE_PATH': None,
+            'OBJECT_CACHE_SIZE': 10 * 2**30,
+            'COMPRESS_ATTACHMENTS': False,
+            'PREHASH_LOCAL_FILES': False,
+            'INGEST_CONCURRENCY': 4,
+            'UPLOAD_EXPIRE': 24 * 3600,
+            'QUERY_CACHE_SIZE': 0,
+            'QUERY_CACHE_TTL': 60,
+            'SIMILAR_CACHE_SIZE': 1000,
+            'SIMILAR_CACHE_TTL': 3600
         }
         defaults.update(conf)
         self._config = defaults
         log.debug('initializing with this config: ' + dumps(self._config))
 
         # initialize fsdb
-        if self._config['FSDB_PATH']:
+        if isinstance(self._config['FSDB_PATH'], (list, tuple)):
+            self.__fsdb = ShardedFsdb(self._config['FSDB_PATH'])
+        elif self._config['FSDB_PATH']:
             self.__fsdb = Fsdb(self._config['FSDB_PATH'])
         else:
             log.warning('It has not been set any value for FSDB_PATH, file operations will not be supported')
@@ -52,16 +109,69 @@ class Archivant():
         if not self._config['ES_INDEXNAME']:
             raise ValueError('ES_INDEXNAME cannot be empty')
         self.__db = None
+        self.__download_counter = None
+        self._dedup_stats = dict(files=0, bytes=0)
+        self._dedup_lock = Lock()
+        self._executor = ThreadExecutor()
+        self.__uploads = None
+
+        # initialize url resolvers
+        self._resolvers = dict()
+        self.register_resolver('fsdb', FsdbResolver(self))
+        if self._config['OBJECT_STORE']:
+            cache = None
+            if self._config['OBJECT_CACHE_PATH']:
+                cache = DiskCache(self._config['OBJECT_CACHE_PATH'], self._config['OBJECT_CACHE_SIZE'])
+            self.register_resolver('s3', ObjectStoreResolver(cache=cache, **self._config['OBJECT_STORE']))
 
     @property
     def _db(self):
         if self.__db is None:
+            queryCache = None
+            if self._config['QUERY_CACHE_SIZE']:
+                queryCache = QueryCache(self._config['QUERY_CACHE_SIZE'], ttl=self._config['QUERY_CACHE_TTL'])
+            similarCache = None
+            if self._config['SIMILAR_CACHE_SIZE']:
+                similarCache = SimilarCache(self._config['SIMILAR_CACHE_SIZE'], ttl=self._config['SIMILAR_CACHE_TTL'])
             db = DB(Elasticsearch(hosts=self._config['ES_HOSTS']),
-                    index_name=self._config['ES_INDEXNAME'])
+                    index_name=self._config['ES_INDEXNAME'],
+                    query_cache=queryCache,
+                    similar_cache=similarCache)
             db.setup_db()
             self.__db = db
         return self.__db
 
+    @property
+    def dedup_stats(self):
+        '''number of stored files and bytes saved by deduplication
+
+           Counts attachments inserted by this instance whose content
+           was already stored.
+        '''
+        return dict(self._dedup_stats)
+
+    @property
+    def query_cache_stats(self):
+        '''hit and miss counts of the search results cache, None if it is disabled'''
+        if self.__db is None or self.__db.query_cache is None:
+            return None
+        return self.__db.query_cache.stats
+
+    @property
+    def similar_cache_stats(self):
+        '''hit and miss counts of the similar volumes cache, None if it is disabled'''
+        if self.__db is None or self.__db.similar_cache is None:
+            return None
+        return self.__db.similar_cache.stats
+
+    @property
+    def _download_counter(self):
+        if self.__download_counter is None:
+            self.__download_counter = DownloadCounter(self._db,
+                                                      flush_interval=self._config['DOWNLOAD_COUNT_FLUSH_INTERVAL'],
+                                                      journal_path=self._config['DOWNLOAD_COUNT_JOURNAL'])
+        return self.__download_counter
+
     @property
     def _fsdb(self):
         try:
@@ -69,6 +179,12 @@ class Archivant():
         except AttributeError:
             raise FileOpNotSupported("FSDB_PATH paramenter has not been set")
 
+    @property
+    def _uploads(self):
+        if self.__uploads is None:
+            self.__uploads = UploadManager(self._fsdb, expire=self._config['UPLOAD_EXPIRE'])
+        return self.__uploads
+
     def is_file_op_supported(self):
         try:
             self._fsdb
@@ -77,6 +193,15 @@ class Archivant():
         else:
             return True
 
+    def spool_file(self):
+        '''return a new :py:class:`~archivant.ingest.SpoolFile`
+
+           Content written to the returned object is hashed on the fly and
+           can be given as `file` of an attachment, in which case
+           it will be moved into fsdb without being read again.
+        '''
+        return SpoolFile(self._fsdb)
+
     @staticmethod
     def normalize_volume(volume):
         '''convert volume metadata from es to archivant format
@@ -112,9 +237,9 @@ class Archivant():
             res['score'] = volume['_score']
 
         source = volume['_source']
-        attachments = source['_attachments']
-        del(source['_attachments'])
-        del(source['_text_' + source['_language']])
+        attachments = source.pop('_attachments', [])
+        # the full text field could have been excluded from the request
+        source.pop('_text_' + source.get('_language', ''), None)
         res['metadata'] = source
 
         atts = list()
@@ -163,42 +288,103 @@ class Archivant():
         res.update(attachment['metadata'])
         return res
 
-    def _req_raw_volume(self, volumeID):
+    def _req_raw_volume(self, volumeID, **kargs):
         try:
-            return self._db.get_book_by_id(volumeID)
+            return self._db.get_book_by_id(volumeID, **kargs)
         except NotFoundError:
             raise NotFoundException("could not found volume with id: '{}'".format(volumeID))
 
+    def merge_download_counts(self, volumes):
+        '''set the download count of all the attachments of the given volumes
+
+           Download counts are not stored together with volumes,
+           this function retrieves them with a single request.
+           It makes side effect on the given normalized volumes.
+        '''
+        attachments = [a for v in volumes for a in v['attachments']]
+        counts = self._db.get_download_counts([a['id'] for a in attachments])
+        for a in attachments:
+            a['metadata']['download_count'] = counts.get(a['id'], 0)
+        return volumes
+
     def import_volume(self, volume):
         _id, den_v = Archivant.denormalize_volume(volume)
+        counts = dict()
+        for a in den_v['_attachments']:
+            if a.get('download_count'):
+                counts[a['id']] = a['download_count']
         try:
             self._db.add_book(body=den_v, id=_id)
         except ConflictError:
             raise ConflictException("A volume with the same id already exists: '{}'".format(_id))
+        if counts:
+            self._db.set_download_counts({_id: counts})
+        self._reference_attachments(_id, den_v['_attachments'])
 
-    def iter_all_volumes(self):
+    def iter_all_volumes(self, batch_size=500):
         '''iterate over all stored volumes'''
+        batch = []
         for raw_volume in self._db.iterate_all():
             v = self.normalize_volume(raw_volume)
             del v['score']
+            batch.append(v)
+            if len(batch) >= batch_size:
+                for v in self.merge_download_counts(batch):
+                    yield v
+                batch = []
+        for v in self.merge_download_counts(batch):
             yield v
 
-    def get_volume(self, volumeID):
+    def get_volume(self, volumeID, download_count=True):
         log.debug("Requested volume with id:'{}'".format(volumeID))
-        return Archivant.normalize_volume(self._req_raw_volume(volumeID))
+        volume = Archivant.normalize_volume(self._req_raw_volume(volumeID, excludes=self._db.text_fields))
+        if not download_count:
+            return volume
+        return self.merge_download_counts([volume])[0]
 
-    def get_attachment(self, volumeID, attachmentID):
-        log.debug("Requested attachment '{}' of the volume '{}'".format(attachmentID, volumeID))
-        rawVolume = self._req_raw_volume(volumeID)
-        for rawAttachment in rawVolume['_source']['_attachments']:
+    def _req_raw_attachment(self, volumeID, attachmentID):
+        try:
+            rawAttachments = self._db.get_book_attachments(volumeID)
+        except NotFoundError:
+            raise NotFoundException("could not found volume with id: '{}'".format(volumeID))
+        for rawAttachment in rawAttachments:
             if rawAttachment['id'] == attachmentID:
-                return Archivant.normalize_attachment(rawAttachment)
+                return rawAttachment
         raise NotFoundException("could not found attachment '{}' of the volume '{}'".format(attachmentID, volumeID))
 
+    def get_attachment(self, volumeID, attachmentID, download_count=True):
+        log.debug("Requested attachment '{}' of the volume '{}'".format(attachmentID, volumeID))
+        attachment = Archivant.normalize_attachment(self._req_raw_attachment(volumeID, attachmentID))
+        if download_count:
+            counts = self._db.get_download_counts([attachmentID])
+            attachment['metadata']['download_count'] = counts.get(attachmentID, 0)
+        return attachment
+
     def get_file(self, volumeID, attachmentID):
         log.debug("Requested file associated with attachment '{}' of the volume '{}'".format(attachmentID, volumeID))
-        attachment = self.get_attachment(volumeID, attachmentID)
-        return self._resolve_url(attachment['url'])
+        return self.get_attachment_file(volumeID, attachmentID)[1]
+
+    def get_attachment_file(self, volumeID, attachmentID):
+        '''return both the attachment and its associated file
+
+           Only one request is made to the database,
+           the returned attachment does not include the download count.
+        '''
+        attachment = self.get_attachment(volumeID, attachmentID, download_count=False)
+        return attachment, self.open_attachment_file(attachment)
+
+    def open_attachment_file(self, attachment, decode_content=True):
+        '''return the file associated with an attachment returned by :py:meth:`get_attachment`
+
+           If the content is stored compressed it is decompressed on the fly,
+           unless `decode_content` is False: in that case the stored content is returned
+           as it is, encoded as specified by the `content_encoding` attachment metadata.
+        '''
+        f = self._resolve_url(attachment['url'])
+        encoding = attachment['metadata'].get('content_encoding')
+        if encoding and decode_content:
+            return decode(f, encoding)
+        return f
 
     def delete_attachments(self, volumeID, attachmentsID):
         ''' delete attachments from a volume '''
@@ -209,16 +395,124 @@ class Archivant():
         for id in attachmentsID:
             if id not in insID:
                 raise NotFoundException("could not found attachment '{}' of the volume '{}'".format(id, volumeID))
-        for index, id in enumerate(attachmentsID):
-            rawVolume['_source']['_attachments'].pop(insID.index(id))
+        removed = [a for a in rawVolume['_source']['_attachments'] if a['id'] in attachmentsID]
+        rawVolume['_source']['_attachments'] = [a for a in rawVolume['_source']['_attachments'] if a['id'] not in attachmentsID]
         self._db.modify_book(volumeID, rawVolume['_source'], version=rawVolume['_version'])
+        self._db.delete_download_counts(attachmentIDs=attachmentsID)
+        self._release_attachments(volumeID, removed)
 
     def delete_volume(self, volumeID):
         log.debug("Deleting volume: '{}'".format(volumeID))
         try:
+            attachments = self._db.get_book_attachments(volumeID)
             self._db.delete_book(volumeID)
         except NotFoundError:
             raise NotFoundException("could not found volume with id: '{}'".format(volumeID))
+        self._db.delete_download_counts(volumeID)
+        self._release_attachments(volumeID, attachments)
+
+    @staticmethod
+    def _blob_id(url):
+        '''return the fsdb id referenced by an attachment url, None for other schemes'''
+        prefix = 'fsdb:///'
+        return url[len(prefix):] if url.startswith(prefix) else None
+
+    def _reference_attachments(self, volumeID, rawAttachments):
+        '''record that the given attachments of a volume reference their blobs'''
+        for a in rawAttachments:
+            blobID = self._blob_id(a['url'])
+            if blobID is not None:
+                self._db.add_blob_refs(blobID, ['{}/{}'.format(volumeID, a['id'])])
+
+    def _release_attachments(self, volumeID, rawAttachments):
+        '''drop the references of the given attachments and collect unreferenced blobs'''
+        released = False
+        for a in rawAttachments:
+            blobID = self._blob_id(a['url'])
+            if blobID is None:
+                continue
+            if self._db.remove_blob_refs(blobID, ['{}/{}'.format(volumeID, a['id'])]) == 0:
+                log.debug("blob '{}' is not referenced anymore".format(blobID))
+                released = True
+        if released and self._config['GC_GRACE_PERIOD'] is not None:
+            self.collect_garbage()
+
+    def collect_garbage(self, grace_period=None):
+        '''remove the blobs that have not been referenced for `grace_period` seconds
+
+           `grace_period` defaults to `GC_GRACE_PERIOD`: it protects contents that are
+           being attached again, e.g. by an upload of the same file,
+           from being removed before the new reference is recorded.
+
+           Only blobs whose references are tracked are considered,
+           see :py:meth:`shrink_local_fsdb` for a full scan. Nothing is removed
+           until the references of the volumes inserted before they were tracked
+           are recorded by ``libreant-db upgrade``, since those volumes
+           could share the same blobs.
+           Returns the number of removed blobs.
+        '''
+        if not self._db.blob_refs_tracked():
+            log.warning("references of older volumes are not tracked, run 'libreant-db upgrade' to enable garbage collection")
+            return 0
+        if grace_period is None:
+            grace_period = self._config['GC_GRACE_PERIOD'] or 0
+        before = int((time.time() - grace_period) * 1000)
+        count = 0
+        for blobID, version in self._db.iter_released_blobs(before):
+            if not self._db.delete_released_blob(blobID, version):
+                continue
+            # deduplicated contents are held just before being referenced, see _hold_blob
+            if self._db.get_blob_refs(blobID) is not None:
+                continue
+            if blobID in self._fsdb:
+                log.info("removing unreferenced blob '{}'".format(blobID))
+                self._fsdb.remove(blobID)
+                count += 1
+        return count
+
+    def _hold_blob(self, blobID):
+        '''protect an already stored blob, about to be referenced, from garbage collection
+
+           Touching its references makes a collection that already listed it fail,
+           or restarts its grace period. Raises IOError if the blob has been removed
+           in the meanwhile.
+        '''
+        self._db.add_blob_refs(blobID, [])
+        if blobID not in self._fsdb:
+            raise IOError("stored content '{}' has been removed".format(blobID))
+
+    def find_stored_file(self, sha1, size):
+        '''return the fsdb id of the stored content with the given sha1 and size
+
+           Returns None if such content is not stored.
+        '''
+        found = self._find_stored_file(sha1, size)
+        return found[0] if found is not None else None
+
+    def _find_stored_file(self, sha1, size):
+        '''return a tuple (fsdb id, content encoding) of the stored content, None if not stored'''
+        if not isinstance(sha1, basestring) or not SHA1_RE.match(sha1):
+            raise ValueError("'sha1' must be a lowercase hexadecimal sha1 digest")
+        if not isinstance(size, Integral):
+            raise ValueError("'size' must be a number")
+        if self._fsdb._conf['hash_alg'] == 'sha1' and sha1 in self._fsdb:
+            if os.path.getsize(self._fsdb.get_file_path(sha1)) == size:
+                return sha1, None
+        # compressed contents are stored with the digest of the compressed data
+        attachment = self._db.get_attachment_by_sha1(sha1)
+        if attachment is None or not attachment['url'].startswith('fsdb:///'):
+            return None
+        fsdbID = attachment['url'][len('fsdb:///'):]
+        if fsdbID not in self._fsdb:
+            return None
+        encoding = attachment.get('content_encoding')
+        if encoding:
+            storedSize = attachment.get('size')
+        else:
+            storedSize = os.path.getsize(self._fsdb.get_file_path(fsdbID))
+        if storedSize != size:
+            return None
+        return fsdbID, encoding
 
     def insert_attachments(self, volumeID, attachments):
         ''' add attachments to an already existing volume '''
@@ -226,18 +520,95 @@ class Archivant():
         if not attachments:
             return
         rawVolume = self._req_raw_volume(volumeID)
-        attsID = list()
-        for index, a in enumerate(attachments):
-            try:
-                rawAttachment = self._assemble_attachment(a['file'], a)
-                rawVolume['_source']['_attachments'].append(rawAttachment)
-                attsID.append(rawAttachment['id'])
-            except Exception:
-                log.exception("Error while elaborating attachments array at index: {}".format(index))
-                raise
+        rawAttachments = self._assemble_attachments(attachments)
+        rawVolume['_source']['_attachments'].extend(rawAttachments)
+        attsID = [a['id'] for a in rawAttachments]
         self._db.modify_book(volumeID, rawVolume['_source'], version=rawVolume['_version'])
+        self._reference_attachments(volumeID, [a for a in rawVolume['_source']['_attachments'] if a['id'] in attsID])
         return attsID
 
+    def create_upload(self, volumeID, size, metadata):
+        '''start the upload of a file of `size` bytes that will be attached to a volume
+
+           `metadata` can hold the "name", "mime" and "notes" of the attachment,
+           "name" is mandatory.
+           Returns the status of the upload, see :py:meth:`get_upload`.
+        '''
+        if not metadata.get('name'):
+            raise KeyError("Required field 'name' is missing")
+        self._req_raw_volume(volumeID)
+        metadata = dict((k, metadata[k]) for k in ('name', 'mime', 'notes') if k in metadata)
+        session = self._uploads.create(volumeID, size, metadata)
+        return session.status(self._uploads.expire)
+
+    def _get_upload(self, volumeID, uploadID):
+        session = self._uploads.get(uploadID)
+        if session.volume_id != volumeID:
+            raise NotFoundException("could not found upload '{}' of the volume '{}'".format(uploadID, volumeID))
+        return session
+
+    def get_upload(self, volumeID, uploadID):
+        '''return the status of an upload
+
+           The status is a dict holding the total `size` of the file,
+           the number of bytes `received` so far, the numbers of the received `chunks`
+           and the time when the upload `expires` if it is not updated.
+        '''
+        return self._get_upload(volumeID, uploadID).status(self._uploads.expire)
+
+    def write_upload_chunk(self, volumeID, uploadID, number, offset, stream, length):
+        '''append a chunk of `length` bytes read from `stream` to an upload
+
+           `offset` must be the number of bytes received so far,
+           chunks already received are ignored.
+           Raises ConflictException if the chunk does not start where the received content ends.
+           Returns the status of the upload.
+        '''
+        self._get_upload(volumeID, uploadID)
+        session = self._uploads.write_chunk(uploadID, number, offset, stream, length)
+        return session.status(self._uploads.expire)
+
+    def finalize_upload(self, volumeID, uploadID, sha1=None):
+        '''attach the uploaded file to its volume and close the upload
+
+           The content is moved into fsdb without being read again.
+           If `sha1` is given it must match the digest of the received content.
+           Returns the ID of the new attachment.
+        '''
+        session = self._get_upload(volumeID, uploadID)
+        if not session.complete:
+            raise ConflictException('only {} bytes out of {} have been received'.format(session.received, session.size))
+        if sha1 is not None and sha1.lower() != session.spool.hexdigest('sha1'):
+            raise ValueError('sha1 of the received content does not match')
+        if not session.lock.acquire(False):
+            raise ConflictException('this upload is already being finalized')
+        try:
+            # a concurrent finalization could have just completed
+            if session.removed:
+                raise NotFoundException("could not found upload '{}'".format(uploadID))
+            attachment = dict(session.metadata)
+            attachment['file'] = session.spool
+            attachmentID = self.insert_attachments(volumeID, [attachment])[0]
+            self._uploads.discard(session)
+        finally:
+            session.lock.release()
+        return attachmentID
+
+    def abort_upload(self, volumeID, uploadID):
+        '''remove an upload and the content received so far
+
+           Raises ConflictException if a chunk is being received or the upload is being finalized.
+        '''
+        if not self._uploads.remove(self._get_upload(volumeID, uploadID)):
+            raise ConflictException('a chunk of this upload is being received, or it is being finalized')
+
+    def expire_uploads(self):
+        '''remove the uploads that have not been updated for UPLOAD_EXPIRE seconds
+
+           Returns the number of removed uploads.
+        '''
+        return self._uploads.expire_sessions()
+
     def insert_volume(self, metadata, attachments=[]):
         '''Insert a new volume
 
@@ -265,6 +636,10 @@ class Archivant():
               "notes" : "this file is awesome"   # notes that will be attached to this file [optional]
             }
 
+            Instead of "file", "sha1" and "size" can be given to attach
+            content already stored (see :py:meth:`find_stored_file`),
+            in that case "name" is mandatory.
+
         '''
 
         log.debug("adding new volume:\n\tdata: {}\n\tfiles: {}".format(metadata, attachments))
@@ -276,22 +651,71 @@ class Archivant():
 
         volume = deepcopy(metadata)
 
-        attsData = []
-        for index, a in enumerate(attachments):
-            try:
-                attData = self._assemble_attachment(a['file'], a)
-                attsData.append(attData)
-            except Exception:
-                log.exception("Error while elaborating attachments array at index: {}".format(index))
-                raise
+        attsData = self._assemble_attachments(attachments)
         volume['_attachments'] = attsData
 
         log.debug('constructed volume for insertion: {}'.format(volume))
         addedVolume = self._db.add_book(body=volume)
         log.debug("added new volume: '{}'".format(addedVolume['_id']))
+        self._reference_attachments(addedVolume['_id'], attsData)
         return addedVolume['_id']
 
-    def _assemble_attachment(self, file, metadata):
+    def _assemble_attachments(self, attachments):
+        ''' store the files of many attachments and return their assembled metadata
+
+            Up to `INGEST_CONCURRENCY` files are hashed and stored at the same time
+            through the executor (see :py:meth:`set_executor`),
+            the returned list keeps the order of `attachments`.
+            If an attachment fails, the ones not yet started are skipped,
+            the contents stored so far are released for garbage collection
+            and the error is raised.
+            Only files are handled by the executor: database requests,
+            e.g. holding contents already stored, are made by the calling thread.
+        '''
+        newBlobs = []
+        reusedBlobs = []
+        failed = []
+
+        def assemble(item):
+            index, a = item
+            if failed:
+                return None
+            try:
+                return self._assemble_attachment(a.get('file'), a, new_blobs=newBlobs, reused_blobs=reusedBlobs)
+            except Exception:
+                failed.append(index)
+                log.exception("Error while elaborating attachments array at index: {}".format(index))
+                raise
+
+        res = [None] * len(attachments)
+        toStore = []
+        for index, a in enumerate(attachments):
+            if a.get('file') is None and 'sha1' in a:
+                # already stored, it only needs a lookup in the database
+                res[index] = assemble((index, a))
+            else:
+                toStore.append((index, a))
+        concurrency = self._config['INGEST_CONCURRENCY'] or 1
+        try:
+            stored = self._executor.map(assemble, toStore, concurrency)
+            for blobID, size, name in reusedBlobs:
+                self._hold_blob(blobID)
+                self._count_deduplicated(name, size)
+        except Exception:
+            for blobID in newBlobs:
+                self._db.add_blob_refs(blobID, [])
+            raise
+        for (index, _), attData in zip(toStore, stored):
+            res[index] = attData
+        return res
+
+    def _count_deduplicated(self, name, size):
+        with self._dedup_lock:
+            self._dedup_stats['files'] += 1
+            self._dedup_stats['bytes'] += size
+        log.info("content of '{}' already stored, saved {} bytes".format(name, size))
+
+    def _assemble_attachment(self, file, metadata, new_blobs=None, reused_blobs=None):
         ''' store file and return a dict containing assembled metadata
 
             param `file` must be a path or a File Object
@@ -301,40 +725,71 @@ class Archivant():
                   "mime"  : "application/json"       # mime type of the file [optional]
                   "notes" : "this file is awesome"   # notes about this file [optional]
                 }
+            the fsdb ids of contents that were not already stored are appended to `new_blobs`,
+            tuples (fsdb id, size, name) of the ones already stored to `reused_blobs`:
+            the latter must be held (see :py:meth:`_hold_blob`) before being referenced
         '''
         res = dict()
 
+        if file is None and 'sha1' in metadata:
+            return self._assemble_stored_attachment(metadata)
+
         if isinstance(file, basestring) and os.path.isfile(file):
             res['name'] = metadata['name'] if 'name' in metadata else os.path.basename(file)
-            res['size'] = os.path.getsize(file)
-            res['sha1'] = calc_file_digest(file, algorithm="sha1")
 
-        elif hasattr(file, 'read') and hasattr(file, 'seek'):
+        elif hasattr(file, 'read'):
             if 'name' in metadata and metadata['name']:
                 res['name'] = metadata['name']
             elif hasattr(file, 'name'):
-                file['name'] = file.name
+                res['name'] = file.name
             else:
                 raise ValueError("Could not assign a name to the file")
 
-            old_position = file.tell()
-
-            file.seek(0, os.SEEK_END)
-            res['size'] = file.tell() - old_position
-            file.seek(old_position, os.SEEK_SET)
-
-            res['sha1'] = calc_digest(file, algorithm="sha1")
-            file.seek(old_position, os.SEEK_SET)
-
         else:
             raise ValueError("Unsupported file value type: {}".format(type(file)))
 
+        stored = None
+        # compressing an uploaded file would read it again in full
+        if self._config['COMPRESS_ATTACHMENTS'] and not isinstance(file, SpoolFile) \
+                and is_compressible(metadata.get('mime'), res['name']):
+            stored = ingest_compressed(self._fsdb, file, algorithms=['sha1'])
+            if stored is not None:
+                res['content_encoding'] = stored.content_encoding
+        if stored is None:
+            # hash and store the content with a single read
+            stored = ingest(self._fsdb, file, algorithms=['sha1'], prehash=self._config['PREHASH_LOCAL_FILES'])
+        res['size'] = stored.size
+        res['sha1'] = stored.hexdigest('sha1')
+        if not stored.deduplicated and new_blobs is not None:
+            new_blobs.append(stored.fsdb_id)
+        if stored.deduplicated and reused_blobs is not None:
+            reused_blobs.append((stored.fsdb_id, stored.size, res['name']))
+
         res['id'] = uuid4().hex
         res['mime'] = metadata['mime'] if 'mime' in metadata else None
         res['notes'] = metadata['notes'] if 'notes' in metadata else ""
-        res['download_count'] = 0
-        fsdb_id = self._fsdb.add(file)
-        res['url'] = "fsdb:///" + fsdb_id
+        res['url'] = "fsdb:///" + stored.fsdb_id
+        return res
+
+    def _assemble_stored_attachment(self, metadata):
+        ''' return assembled metadata of an attachment whose content is already stored '''
+        if not metadata.get('name'):
+            raise ValueError("Could not assign a name to the file")
+        found = self._find_stored_file(metadata['sha1'], metadata.get('size'))
+        if found is None:
+            raise NotFoundException("no stored content with sha1 '{}' and size {}".format(metadata['sha1'], metadata.get('size')))
+        fsdbID, encoding = found
+        self._hold_blob(fsdbID)
+        self._count_deduplicated(metadata['name'], metadata['size'])
+        res = {'id': uuid4().hex,
+               'name': metadata['name'],
+               'size': metadata['size'],
+               'sha1': metadata['sha1'],
+               'mime': metadata['mime'] if 'mime' in metadata else None,
+               'notes': metadata['notes'] if 'notes' in metadata else "",
+               'url': "fsdb:///" + fsdbID}
+        if encoding:
+            res['content_encoding'] = encoding
         return res
 
     def update_volume(self, volumeID, metadata):
@@ -368,27 +823,130 @@ class Archivant():
             raise ValueError("'notes' must be a string")
         if 'download_count' in metadata and not isinstance(metadata['download_count'], Integral):
             raise ValueError("'download_count' must be a number")
+        metadata = dict(metadata)
+        download_count = metadata.pop('download_count', None)
         rawVolume = self._req_raw_volume(volumeID)
         for attachment in rawVolume['_source']['_attachments']:
             if attachment['id'] == attachmentID:
-                attachment.update(metadata)
-                self._db.modify_book(id=volumeID, body=rawVolume['_source'], version=rawVolume['_version'])
+                if metadata:
+                    attachment.update(metadata)
+                    self._db.modify_book(id=volumeID, body=rawVolume['_source'], version=rawVolume['_version'])
+                if download_count is not None:
+                    self._db.set_download_counts({volumeID: {attachmentID: download_count}})
                 return
         raise NotFoundException('Could not found attachment with id {} in volume {}'.format(attachmentID, volumeID))
 
+    def increment_download_count(self, volumeID, attachmentID):
+        '''count a download of the given attachment
+
+           Increments are buffered and written to the database
+           at most every `DOWNLOAD_COUNT_FLUSH_INTERVAL` seconds,
+           see :py:meth:`flush_download_counts`.
+        '''
+        self._download_counter.increment(volumeID, attachmentID)
+
+    def increment_download_counts(self, volumeID, attachmentIDs):
+        '''count a download of each of the given attachments of a volume
+
+           The increments are buffered together, as done by :py:meth:`increment_download_count`.
+        '''
+        self._download_counter.increment_many(volumeID, attachmentIDs)
+
+    def flush_download_counts(self):
+        '''write all the buffered download counts to the database'''
+        if self.__download_counter is not None:
+            self._download_counter.flush()
+
+    def set_executor(self, executor):
+        '''run the hashing and storage of attachment files through `executor`
+
+           See :py:mod:`archivant.executors`, the default one uses native threads
+           and blocks the calling thread until files are stored.
+        '''
+        self._executor = executor
+
+    def register_resolver(self, scheme, resolver):
+        '''open attachment urls with the given scheme using `resolver`
+
+           `resolver` must have an ``open(url)`` method returning a readable file object.
+        '''
+        self._resolvers[scheme] = resolver
+
     def _resolve_url(self, url):
         parseResult = urlparse(url)
-        if parseResult.scheme == "fsdb":
-            return self._fsdb[os.path.basename(parseResult.path)]
-        else:
+        try:
+            resolver = self._resolvers[parseResult.scheme]
+        except KeyError:
             raise Exception("url scheme '{}' not supported".format(parseResult.scheme))
+        return resolver.open(url)
+
+    def move_to_object_store(self, volumeID, attachmentID):
+        '''upload the file of an attachment to the object store and drop the local copy
+
+           The object is named after the fsdb id of the file.
+           The local file is removed only when it is not referenced by other attachments,
+           according to the usual garbage collection.
+           Returns the new url of the attachment.
+        '''
+        try:
+            store = self._resolvers['s3']
+        except KeyError:
+            raise FileOpNotSupported('OBJECT_STORE parameter has not been set')
+        rawVolume = self._req_raw_volume(volumeID)
+        rawAttachment = next((a for a in rawVolume['_source']['_attachments'] if a['id'] == attachmentID), None)
+        if rawAttachment is None:
+            raise NotFoundException("could not found attachment '{}' of the volume '{}'".format(attachmentID, volumeID))
+        blobID = self._blob_id(rawAttachment['url'])
+        if blobID is None:
+            return rawAttachment['url']
+        log.info("moving '{}' to the object store".format(blobID))
+        with self._fsdb[blobID] as f:
+            url = store.store(blobID, f, os.fstat(f.fileno()).st_size)
+        oldAttachment = dict(rawAttachment)
+        rawAttachment['url'] = url
+        try:
+            self._db.modify_book(volumeID, rawVolume['_source'], version=rawVolume['_version'])
+        except ConflictError:
+            raise ConflictException('volume has been modified in the meanwhile')
+        self._release_attachments(volumeID, [oldAttachment])
+        return url
 
     def dangling_files(self):
-        '''iterate over fsdb files no more attached to any volume'''
+        '''iterate over fsdb files no more attached to any volume
+
+           All the attachment urls are retrieved with a single scroll
+           and compared with the fsdb content.
+        '''
+        prefix = 'fsdb:///'
+        # a malformed url raises ValueError, rather than letting its file be collected
+        attached = DigestSet((url[len(prefix):] for url in self._db.iter_attachment_urls()
+                              if url.startswith(prefix)),
+                             hash_alg=self._fsdb._conf['hash_alg'])
+        log.debug('{} distinct files are attached to volumes'.format(len(attached)))
         for fid in self._fsdb:
-            if not self._db.file_is_attached('fsdb:///' + fid):
+            if fid not in attached:
                 yield fid
 
+    def fsck(self, processes=None, max_age=None, full=False):
+        '''return an :py:class:`~archivant.fsck.Fsck` instance for the local fsdb
+
+           Verifications are recorded in a state file inside the fsdb root,
+           if `full` is True the previous ones are ignored.
+        '''
+        statePath = os.path.join(self._fsdb.fsdbRoot, STATE_FILE)
+        if full and os.path.exists(statePath):
+            os.remove(statePath)
+        return Fsck(self._fsdb, processes=processes, max_age=max_age, state_path=statePath)
+
+    def rebalance_local_fsdb(self, dryrun=False):
+        '''move files to their preferred device, e.g. after a new one has been added to FSDB_PATH
+
+           Returns a tuple (moved files, moved bytes).
+        '''
+        if not isinstance(self._fsdb, ShardedFsdb):
+            return 0, 0
+        return self._fsdb.rebalance(dryrun=dryrun)
+
     def shrink_local_fsdb(self, dangling=True, corrupted=True, dryrun=False):
         '''shrink local fsdb by removing dangling and/or corrupted files
 
@@ -403,7 +961,8 @@ class Archivant():
                     self._fsdb.remove(fid)
                 count += 1
         if corrupted:
-            for fid in self._fsdb.corrupted():
+            # bit rot leaves mtimes alone: every file is verified again
+            for fid in self.fsck(full=True).corrupted():
                 log.info("shrinking: removing corrupted '{}'".format(fid))
                 if not dryrun:
                     self._fsdb.remove(fid)
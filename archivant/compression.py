@@ -0,0 +1,229 @@
+'''Compression at rest of attachment contents
+
+Contents whose mime type is compressible are stored in fsdb gzip compressed,
+and their attachment gets a ``content_encoding`` field. The ``sha1`` and
+``size`` fields of the attachment keep describing the uncompressed content.
+
+Compression is dropped when it would not save at least
+``1 - MIN_RATIO`` of the space, e.g. for PDFs whose streams are already
+compressed: the ratio is first estimated on the initial ``SAMPLE_SIZE`` bytes,
+so that big incompressible files are not compressed entirely.
+'''
+import os
+import zlib
+import struct
+import hashlib
+import mimetypes
+from collections import deque
+
+from ingest import SpoolFile, BLOCK_SIZE
+
+from logging import getLogger
+log = getLogger('archivant')
+
+
+GZIP = 'gzip'
+MIN_RATIO = 0.9
+SAMPLE_SIZE = 4 * 2**20
+READ_SIZE = 2**16
+
+COMPRESSIBLE_MIMETYPES = set(['application/xml',
+                              'application/xhtml+xml',
+                              'application/json',
+                              'application/javascript',
+                              'application/rtf',
+                              'application/postscript',
+                              'application/pdf',
+                              'application/x-tex',
+                              'image/svg+xml',
+                              'image/bmp',
+                              'image/tiff'])
+
+
+def is_compressible(mime, name=None):
+    '''return True if contents of the given mime type (or file name) are worth compressing'''
+    if not mime and name:
+        mime = mimetypes.guess_type(name)[0]
+    if not mime:
+        return False
+    mime = mime.split(';')[0].strip().lower()
+    return mime.startswith('text/') or mime in COMPRESSIBLE_MIMETYPES
+
+
+class CompressedFile(object):
+    '''Compressed content stored in fsdb
+
+       Exposes the same attributes of a committed :py:class:`~archivant.ingest.SpoolFile`,
+       `size` and digests refer to the uncompressed content,
+       `stored_size` to the compressed one.
+    '''
+
+    committed = True
+    content_encoding = GZIP
+
+    def __init__(self, spool, size, hashes):
+        self.fsdb_id = spool.fsdb_id
+        self.deduplicated = spool.deduplicated
+        self.stored_size = spool.size
+        self.size = size
+        self._hashes = hashes
+
+    def hexdigest(self, algorithm='sha1'):
+        return self._hashes[algorithm].hexdigest()
+
+
+def ingest_compressed(fsdb, origin, algorithms=('sha1',), min_ratio=MIN_RATIO):
+    '''store the gzip compressed content of `origin` into fsdb
+
+       param `origin` must be a path or a seekable readable object,
+       in the latter case the content is read starting from the current position.
+
+       Returns a :py:class:`CompressedFile`, or None if compression would save
+       too little space: in this case nothing is stored and `origin`
+       is rewound to its initial position.
+    '''
+    if isinstance(origin, basestring):
+        with open(origin, 'rb') as f:
+            return ingest_compressed(fsdb, f, algorithms, min_ratio)
+    try:
+        start = origin.tell()
+    except (AttributeError, IOError):
+        # the content could not be read again if compression is not worth
+        return None
+
+    hashes = dict((alg, hashlib.new(alg)) for alg in algorithms)
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    size = 0
+    spool = SpoolFile(fsdb, algorithms=())
+    try:
+        while True:
+            chunk = origin.read(BLOCK_SIZE)
+            if not chunk:
+                spool.write(compressor.flush())
+                break
+            for h in hashes.itervalues():
+                h.update(chunk)
+            size += len(chunk)
+            spool.write(compressor.compress(chunk))
+            if size >= SAMPLE_SIZE and size - len(chunk) < SAMPLE_SIZE and spool.size > size * min_ratio:
+                break
+        if spool.size > size * min_ratio:
+            log.debug('compression not worth: {} bytes out of {}'.format(spool.size, size))
+            spool.discard()
+            origin.seek(start)
+            return None
+        spool.commit()
+    except Exception:
+        spool.discard()
+        raise
+    log.debug("stored compressed file '{}': {} bytes out of {}".format(spool.fsdb_id, spool.size, size))
+    return CompressedFile(spool, size, hashes)
+
+
+class GzipReader(object):
+    '''Readable object that decompresses the gzip content of `f` on the fly'''
+
+    def __init__(self, f):
+        self._f = f
+        self._start = f.tell() if hasattr(f, 'tell') else 0
+        self._reset()
+
+    def _reset(self):
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        # decompressed chunks not yet read, the first one starting from _offset
+        self._chunks = deque()
+        self._offset = 0
+        self._available = 0
+        self._pos = 0
+        self._eof = False
+
+    @property
+    def name(self):
+        return getattr(self._f, 'name', None)
+
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+        while not self._eof and (size < 0 or self._available < size):
+            chunk = self._f.read(READ_SIZE)
+            if not chunk:
+                data = self._decompressor.flush()
+                self._eof = True
+            else:
+                data = self._decompressor.decompress(chunk)
+            if data:
+                self._chunks.append(data)
+                self._available += len(data)
+        if size < 0 or size > self._available:
+            size = self._available
+        # only the returned bytes are copied, however big the decompressed chunks are
+        pieces = []
+        remaining = size
+        while remaining > 0:
+            chunk = self._chunks[0]
+            piece = chunk[self._offset:self._offset + remaining]
+            pieces.append(piece)
+            remaining -= len(piece)
+            self._offset += len(piece)
+            if self._offset == len(chunk):
+                self._chunks.popleft()
+                self._offset = 0
+        self._available -= size
+        self._pos += size
+        return ''.join(pieces)
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class SeekableGzipReader(GzipReader):
+    ''':py:class:`GzipReader` of a seekable object
+
+       Seeking backwards decompresses the content again from the beginning.
+    '''
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence != os.SEEK_SET:
+            raise IOError('only seeking from the beginning or the current position is supported')
+        if offset < self._pos:
+            self._f.seek(self._start)
+            self._reset()
+        while self._pos < offset:
+            if not self.read(min(BLOCK_SIZE, offset - self._pos)):
+                break
+
+
+def deflate_member(f, size):
+    '''locate the raw deflate stream of the gzip content of `f`, `size` bytes long
+
+       Returns a tuple (crc32, offset, length) where crc32 is the checksum of the
+       uncompressed content, as found in the gzip trailer, or None if the gzip header
+       has optional fields (contents stored by :py:func:`ingest_compressed` have none).
+    '''
+    f.seek(0)
+    header = f.read(10)
+    if len(header) < 10 or header[:3] != '\x1f\x8b\x08' or header[3] != '\x00' or size < 18:
+        return None
+    f.seek(size - 8)
+    crc, _ = struct.unpack('<II', f.read(8))
+    return crc, 10, size - 18
+
+
+def decode(f, encoding):
+    '''return a readable object with the decoded content of `f`'''
+    if encoding != GZIP:
+        raise ValueError("content encoding '{}' not supported".format(encoding))
+    if hasattr(f, 'seek'):
+        return SeekableGzipReader(f)
+    return GzipReader(f)
@@ -0,0 +1,86 @@
+'''Byte budgeted in-memory cache of small file contents
+
+Keeps the content of the most requested small attachments in memory,
+so that they can be sent without reading them from disk again.
+A content is admitted only after it has been requested a few times,
+so that a scan of rarely requested files cannot flush the hot ones.
+'''
+from collections import OrderedDict
+from threading import Lock
+
+from logging import getLogger
+log = getLogger('archivant')
+
+
+class ContentCache(object):
+    '''LRU cache of contents keyed by digest
+
+       :param max_size: total bytes of cached contents
+       :param max_item_size: bigger contents are never cached
+       :param min_hits: requests of a content needed for it to be admitted
+       :param history_size: number of not cached digests whose requests are counted
+    '''
+
+    def __init__(self, max_size, max_item_size=2 * 2**20, min_hits=2, history_size=10000):
+        self.max_size = max_size
+        self.max_item_size = min(max_item_size, max_size)
+        self.min_hits = min_hits
+        self.history_size = history_size
+        self._lock = Lock()
+        self._entries = OrderedDict()
+        self._history = OrderedDict()
+        self._size = 0
+        self._stats = dict(hits=0, misses=0, admissions=0, evictions=0)
+
+    @property
+    def stats(self):
+        '''hit, miss, admission and eviction counts together with the current size'''
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['size'] = self._size
+        return stats
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        '''return the tuple (content, last_modified) cached for `key`, None on cache miss
+
+           Misses are counted for admission.
+        '''
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+                self._stats['hits'] += 1
+                return entry
+            self._stats['misses'] += 1
+            self._history[key] = self._history.pop(key, 0) + 1
+            if len(self._history) > self.history_size:
+                self._history.popitem(last=False)
+            return None
+
+    def admits(self, key, size):
+        '''return True if a content of `size` bytes for `key` should be cached'''
+        return size <= self.max_item_size and self._history.get(key, 0) >= self.min_hits
+
+    def put(self, key, content, last_modified=None):
+        '''cache `content`, evicting the least recently used ones'''
+        if len(content) > self.max_item_size:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old[0])
+            self._history.pop(key, None)
+            self._entries[key] = (content, last_modified)
+            self._size += len(content)
+            self._stats['admissions'] += 1
+            while self._size > self.max_size:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+                self._stats['evictions'] += 1
@@ -0,0 +1,97 @@
+'''
+Compact set of hexadecimal digests, used to compare huge lists of file ids
+without keeping millions of python strings in memory.
+'''
+import heapq
+import hashlib
+from cStringIO import StringIO
+from binascii import unhexlify, Error as BinasciiError
+
+
+class DigestSet(object):
+    '''
+    Immutable set of hexadecimal digests made with the `hash_alg` algorithm
+
+    Digests are stored in binary form, sorted and packed in a single string,
+    so each entry takes exactly half the length of its hexadecimal representation.
+    Membership is checked with a binary search.
+
+    Digests are loaded in chunks of `chunk_size` elements that are sorted
+    independently and merged at the end, so that the memory needed while
+    building the set stays close to the final one.
+    Raises ValueError if any string is not a valid hexadecimal digest
+    of the `hash_alg` length.
+    '''
+
+    def __init__(self, hexdigests, hash_alg='sha1', chunk_size=100000):
+        self.width = hashlib.new(hash_alg).digest_size
+        chunks = []
+        chunk = []
+        for hexdigest in hexdigests:
+            chunk.append(self._unhexlify(hexdigest))
+            if len(chunk) >= chunk_size:
+                chunks.append(self._pack(chunk))
+                chunk = []
+        if chunk:
+            chunks.append(self._pack(chunk))
+        if len(chunks) == 1:
+            self._data = chunks[0]
+        else:
+            merged = heapq.merge(*[self._iter_packed(c) for c in chunks])
+            self._data = self._pack(merged, presorted=True)
+        self._len = len(self._data) // self.width
+
+    def _unhexlify(self, hexdigest):
+        try:
+            digest = unhexlify(hexdigest)
+        except (TypeError, BinasciiError):
+            raise ValueError("'{}' is not an hexadecimal digest".format(hexdigest))
+        if len(digest) != self.width:
+            raise ValueError("'{}' is not {} bytes long".format(hexdigest, self.width))
+        return digest
+
+    @staticmethod
+    def _pack(digests, presorted=False):
+        '''return sorted and deduplicated digests joined in a single string'''
+        if not presorted:
+            digests = sorted(digests)
+        res = StringIO()
+        last = None
+        for d in digests:
+            if d != last:
+                res.write(d)
+                last = d
+        return res.getvalue()
+
+    def _iter_packed(self, data):
+        for i in xrange(0, len(data), self.width):
+            yield data[i:i + self.width]
+
+    def _get(self, index):
+        start = index * self.width
+        return self._data[start:start + self.width]
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for digest in self._iter_packed(self._data):
+            yield digest.encode('hex')
+
+    def __contains__(self, hexdigest):
+        if not self._len:
+            return False
+        try:
+            digest = unhexlify(hexdigest)
+        except (TypeError, BinasciiError):
+            return False
+        if len(digest) != self.width:
+            return False
+        lo, hi = 0, self._len
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._get(mid) < digest:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo < self._len and self._get(lo) == digest
@@ -0,0 +1,171 @@
+'''Size bounded LRU cache of files on local disk
+
+Used to keep on the web node a copy of the most requested contents
+stored in slower backends, such as an object store.
+'''
+import os
+import errno
+import hashlib
+from collections import OrderedDict
+from tempfile import mkstemp
+from threading import Lock
+
+from logging import getLogger
+log = getLogger('archivant')
+
+
+TMP_SUFFIX = '.tmp'
+
+
+class DiskCache(object):
+    '''Least recently used files cache
+
+       Entries are files inside `path`, named after the sha1 of their key.
+       Their total size is kept below `max_size` bytes evicting
+       the least recently read ones, recency is tracked with file mtimes
+       so that it survives restarts.
+    '''
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self._lock = Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self._load()
+
+    def _load(self):
+        entries = []
+        for name in os.listdir(self.path):
+            entryPath = os.path.join(self.path, name)
+            if name.endswith(TMP_SUFFIX):
+                # left by an interrupted transfer
+                os.remove(entryPath)
+                continue
+            st = os.stat(entryPath)
+            entries.append((st.st_mtime, name, st.st_size))
+        for _, name, size in sorted(entries):
+            self._entries[name] = size
+            self._size += size
+        log.debug('disk cache {}: {} entries, {} bytes'.format(self.path, len(self._entries), self._size))
+        with self._lock:
+            self._evict()
+
+    @property
+    def size(self):
+        '''total size in bytes of the cached files'''
+        return self._size
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _name(self, key):
+        return hashlib.sha1(key).hexdigest()
+
+    def __contains__(self, key):
+        return self._name(key) in self._entries
+
+    def get(self, key):
+        '''return the cached file opened for reading, None on cache miss'''
+        name = self._name(key)
+        entryPath = os.path.join(self.path, name)
+        try:
+            f = open(entryPath, 'rb')
+            os.utime(entryPath, None)
+        except (IOError, OSError):
+            with self._lock:
+                if name in self._entries:
+                    self._size -= self._entries.pop(name)
+            return None
+        with self._lock:
+            size = self._entries.pop(name, None)
+            if size is None:
+                # added by another process sharing the cache
+                size = os.fstat(f.fileno()).st_size
+                self._size += size
+            self._entries[name] = size
+        return f
+
+    def tee(self, key, stream, size=None):
+        '''return a file object reading `stream` that saves its content in the cache
+
+           The content is cached once it has been entirely read,
+           if `size` is given only when it has the expected size.
+        '''
+        return CachingReader(self, key, stream, size)
+
+    def _new_tmp(self):
+        fd, tmpPath = mkstemp(suffix=TMP_SUFFIX, dir=self.path)
+        return os.fdopen(fd, 'wb'), tmpPath
+
+    def _commit(self, key, tmpPath):
+        size = os.path.getsize(tmpPath)
+        if size > self.max_size:
+            os.remove(tmpPath)
+            return
+        name = self._name(key)
+        os.rename(tmpPath, os.path.join(self.path, name))
+        with self._lock:
+            self._size += size - self._entries.pop(name, 0)
+            self._entries[name] = size
+            self._evict()
+
+    def _evict(self):
+        while self._size > self.max_size and self._entries:
+            name, size = self._entries.popitem(last=False)
+            self._size -= size
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            log.debug("disk cache: evicted '{}' ({} bytes)".format(name, size))
+
+
+class CachingReader(object):
+    '''Readable object that copies what it reads into a :py:class:`DiskCache`'''
+
+    def __init__(self, cache, key, stream, size=None):
+        self._cache = cache
+        self._key = key
+        self._stream = stream
+        self._expected = size
+        self._read = 0
+        self._tmp, self._tmpPath = cache._new_tmp()
+
+    def read(self, size=-1):
+        data = self._stream.read() if size is None or size < 0 else self._stream.read(size)
+        if self._tmp is not None:
+            if data:
+                self._tmp.write(data)
+                self._read += len(data)
+            if not data or (size is None or size < 0) or self._read == self._expected:
+                self._finish()
+        return data
+
+    def _finish(self):
+        self._tmp.close()
+        self._tmp = None
+        if self._expected is None or self._read == self._expected:
+            self._cache._commit(self._key, self._tmpPath)
+        else:
+            os.remove(self._tmpPath)
+
+    def close(self):
+        self._stream.close()
+        if self._tmp is not None:
+            # the content has not been read entirely
+            self._tmp.close()
+            self._tmp = None
+            os.remove(self._tmpPath)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,84 @@
+'''Execution of blocking work, such as hashing and storing files
+
+Archivant runs CPU and disk bound work through an executor
+(see :py:meth:`archivant.Archivant.set_executor`), so that applications
+with their own concurrency model, like a gevent web server, can decide
+where that work runs. An executor has a single method::
+
+    map(func, items, concurrency)
+
+that applies `func` to every item, running at most `concurrency` calls
+at the same time, and returns the results in the order of `items`.
+All the calls are completed before returning; if some of them failed,
+the exception of the first failed item is raised.
+'''
+import sys
+import time
+from threading import Lock
+from multiprocessing.pool import ThreadPool
+
+
+def call_safely(func, item):
+    '''call `func(item)` and return a tuple (ok, result or exc_info)'''
+    try:
+        return True, func(item)
+    except Exception:
+        return False, sys.exc_info()
+
+
+class TaskStats(object):
+    '''number of executed tasks and seconds spent running them'''
+
+    def __init__(self):
+        self._lock = Lock()
+        self.tasks = 0
+        self.busy = 0.0
+
+    def timed(self, func):
+        '''wrap `func` with :py:func:`call_safely`, accounting for its execution'''
+        def timed(item):
+            start = time.time()
+            try:
+                return call_safely(func, item)
+            finally:
+                with self._lock:
+                    self.tasks += 1
+                    self.busy += time.time() - start
+        return timed
+
+    def as_dict(self):
+        with self._lock:
+            return dict(tasks=self.tasks, busy=self.busy)
+
+
+def collect(outcomes):
+    '''return the results of the given :py:func:`call_safely` outcomes,
+       raising the first exception found'''
+    for ok, value in outcomes:
+        if not ok:
+            raise value[0], value[1], value[2]
+    return [value for _, value in outcomes]
+
+
+class ThreadExecutor(object):
+    '''run functions in a pool of native threads, blocking the caller until they complete
+
+       With a concurrency of 1 functions are run in the calling thread.
+       Statistics about the executed tasks are kept in :py:attr:`stats`.
+    '''
+
+    def __init__(self):
+        self.stats = TaskStats()
+
+    def map(self, func, items, concurrency):
+        items = list(items)
+        timed = self.stats.timed(func)
+        if concurrency <= 1 or len(items) <= 1:
+            return collect([timed(item) for item in items])
+        pool = ThreadPool(min(concurrency, len(items)))
+        try:
+            outcomes = pool.map(timed, items, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        return collect(outcomes)
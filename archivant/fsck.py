@@ -0,0 +1,265 @@
+'''Parallel verification of fsdb contents
+
+:py:meth:`fsdb.Fsdb.corrupted` rehashes every stored file one after the
+other on a single core. :py:class:`Fsck` walks the fsdb tree one top level
+directory at a time, interleaving the roots of a sharded storage, and rehashes
+files with a pool of worker processes, keeping a bounded number of files in flight.
+
+Every verification is appended to a state journal together with the file
+mtime, so that an interrupted scan can be resumed and later scans only
+re-verify files that changed or whose last verification is too old.
+'''
+import os
+import json
+import errno
+import time
+import signal
+import hashlib
+from collections import deque
+from multiprocessing import Pool, cpu_count
+
+from logging import getLogger
+log = getLogger('archivant')
+
+
+BLOCK_SIZE = 2**20
+STATE_FILE = '.fsck'
+
+
+def _ignore_sigint():
+    # interruptions are handled by the parent process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def verify_file(task):
+    '''rehash a single file and compare it with its expected digest
+
+       `task` is a tuple (digest, path, algorithm),
+       returns a tuple (digest, ok, size), where ok is None if the file does not exist anymore.
+    '''
+    digest, path, algorithm = task
+    hashM = hashlib.new(algorithm)
+    size = 0
+    try:
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(BLOCK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                hashM.update(chunk)
+    except (IOError, OSError) as e:
+        if e.errno == errno.ENOENT:
+            return digest, None, size
+        return digest, False, size
+    return digest, hashM.hexdigest() == digest, size
+
+
+class FsckState(object):
+    '''Last verification of each fsdb file
+
+       Records are kept in memory and appended as JSON lines
+       ``[digest, mtime, verified_at, ok]`` to the file at `path`,
+       later lines override earlier ones.
+       If `path` is None nothing is persisted.
+    '''
+
+    def __init__(self, path=None):
+        self.path = path
+        self.records = dict()
+        self._journal = None
+        if path:
+            self._load()
+            self._journal = open(path, 'a')
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as journal:
+            for line in journal:
+                try:
+                    digest, mtime, verifiedAt, ok = json.loads(line)
+                except ValueError:
+                    # an incomplete line could be left by an interruption
+                    continue
+                self.records[digest] = (mtime, verifiedAt, ok)
+        log.debug('loaded {} fsck records from {}'.format(len(self.records), self.path))
+
+    def get(self, digest):
+        '''return a tuple (mtime, verified_at, ok) or None'''
+        return self.records.get(digest)
+
+    def record(self, digest, mtime, ok):
+        now = time.time()
+        self.records[digest] = (mtime, now, ok)
+        if self._journal is not None:
+            self._journal.write(json.dumps([digest, mtime, now, ok]) + '\n')
+            self._journal.flush()
+
+    def compact(self, digests):
+        '''keep only the records of the given digests'''
+        self.records = dict((d, r) for d, r in self.records.iteritems() if d in digests)
+        if self._journal is None:
+            return
+        tmpPath = self.path + '.tmp'
+        with open(tmpPath, 'w') as tmp:
+            for digest, (mtime, verifiedAt, ok) in self.records.iteritems():
+                tmp.write(json.dumps([digest, mtime, verifiedAt, ok]) + '\n')
+        self._journal.close()
+        os.rename(tmpPath, self.path)
+        self._journal = open(self.path, 'a')
+
+    def close(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+
+class Fsck(object):
+    '''Verify the integrity of the files stored in `fsdb`
+
+       :param processes: number of worker processes, defaults to the number of cpus.
+                         With 1 files are verified in the calling process.
+       :param read_ahead: maximum number of files queued to the workers
+       :param max_age: seconds after which a verified file is verified again,
+                       None means that unchanged files are verified only once
+       :param state_path: path of the state journal, None disables it
+    '''
+
+    def __init__(self, fsdb, processes=None, read_ahead=None, max_age=None, state_path=None):
+        self._fsdb = fsdb
+        self.processes = processes or cpu_count()
+        self.read_ahead = read_ahead or self.processes * 4
+        self.max_age = max_age
+        self.state_path = state_path
+        self.stats = dict(files=0, verified=0, skipped=0, corrupted=0, vanished=0, bytes=0, elapsed=0)
+
+    @property
+    def throughput(self):
+        '''verified bytes per second'''
+        if not self.stats['elapsed']:
+            return 0
+        return self.stats['bytes'] / self.stats['elapsed']
+
+    def roots(self):
+        '''root directories of the fsdb, more than one for a sharded storage'''
+        return [shard.fsdbRoot for shard in getattr(self._fsdb, 'shards', [self._fsdb])]
+
+    def shards(self, root):
+        '''top level directories of the given fsdb root'''
+        return sorted(d for d in os.listdir(root)
+                      if not d.startswith('.') and os.path.isdir(os.path.join(root, d)))
+
+    def iter_shard(self, root, shard):
+        '''iterate over (digest, path) of the files in the given shard'''
+        depth = self._fsdb._conf['depth']
+        for dirpath, dirnames, filenames in os.walk(os.path.join(root, shard)):
+            relDirpath = os.path.relpath(dirpath, root)
+            if relDirpath.count(os.sep) + 1 != depth:
+                continue
+            for f in filenames:
+                yield (relDirpath + f).replace(os.sep, ''), os.path.join(dirpath, f)
+
+    def _iter_root(self, root):
+        for shard in self.shards(root):
+            for item in self.iter_shard(root, shard):
+                yield item
+
+    def iter_files(self):
+        '''iterate over (digest, path) of all the files
+
+           Files of different roots are interleaved,
+           so that all the devices of a sharded storage are read at the same time.
+        '''
+        iterators = deque(self._iter_root(root) for root in self.roots())
+        while iterators:
+            it = iterators.popleft()
+            try:
+                item = next(it)
+            except StopIteration:
+                continue
+            iterators.append(it)
+            yield item
+
+    def _needs_check(self, record, mtime, now):
+        if record is None:
+            return True
+        recMtime, verifiedAt, ok = record
+        if not ok or recMtime != mtime:
+            return True
+        return self.max_age is not None and now - verifiedAt >= self.max_age
+
+    def _iter_verifications(self, tasks, pool):
+        if pool is None:
+            for task in tasks:
+                yield verify_file(task)
+            return
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.apply_async(verify_file, (task,)))
+            if len(pending) >= self.read_ahead:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def run(self):
+        '''verify files and iterate over (digest, ok) for each verified one
+
+           Files that have not changed since their last successful verification
+           (and that are not older than `max_age`) are skipped, as well as files
+           removed while the verification is running.
+           The statistics of the run are kept in :py:attr:`stats`.
+        '''
+        state = FsckState(self.state_path)
+        algorithm = self._fsdb._conf['hash_alg']
+        pool = Pool(self.processes, _ignore_sigint) if self.processes > 1 else None
+        seen = set()
+        mtimes = dict()
+        start = time.time()
+
+        def tasks():
+            now = time.time()
+            for digest, path in self.iter_files():
+                seen.add(digest)
+                self.stats['files'] += 1
+                try:
+                    mtime = os.path.getmtime(path)
+                except OSError:
+                    # removed in the meanwhile
+                    continue
+                if not self._needs_check(state.get(digest), mtime, now):
+                    self.stats['skipped'] += 1
+                    continue
+                mtimes[digest] = mtime
+                yield digest, path, algorithm
+
+        completed = False
+        try:
+            for digest, ok, size in self._iter_verifications(tasks(), pool):
+                if ok is None:
+                    mtimes.pop(digest)
+                    self.stats['vanished'] += 1
+                    continue
+                state.record(digest, mtimes.pop(digest), ok)
+                self.stats['verified'] += 1
+                self.stats['bytes'] += size
+                self.stats['elapsed'] = time.time() - start
+                if not ok:
+                    self.stats['corrupted'] += 1
+                    log.warning("found corrupted file: '{}'".format(digest))
+                yield digest, ok
+            completed = True
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            self.stats['elapsed'] = time.time() - start
+            if completed:
+                state.compact(seen)
+            state.close()
+
+    def corrupted(self):
+        '''iterate over the digests of all corrupted files'''
+        for digest, ok in self.run():
+            if not ok:
+                yield digest
@@ -0,0 +1,289 @@
+'''Single-pass storage of attachment contents into fsdb
+
+Storing a file through :py:meth:`fsdb.Fsdb.add` reads it twice (once to
+compute the key digest and once to copy it), and archivant used to read it
+a third time to compute the sha1 that goes into the attachment metadata.
+
+Contents already stored are not written again: spooled copies are dropped
+on commit. Local paths that are likely already stored can be hashed before
+being copied, so that no write happens at all for them, at the cost of a
+second read of the new ones.
+
+The helpers provided here stream the content only once: every chunk is
+written into a spool file placed inside the fsdb root and fed to all the
+requested hash functions at the same time. Once the content is complete the
+spool file is atomically renamed to its final location in the fsdb tree.
+'''
+import os
+import errno
+import hashlib
+from tempfile import mkstemp
+from threading import Lock
+
+from shards import copy_file, ShardedFsdb
+
+from logging import getLogger
+log = getLogger('archivant')
+
+
+BLOCK_SIZE = 2**20
+SPOOL_DIR = '.spool'
+
+# the process umask is changed while creating files and directories
+_umask_lock = Lock()
+
+
+def makedirs(fsdb, path):
+    '''create the directory `path` of `fsdb`, it is safe to call from multiple threads'''
+    with _umask_lock:
+        oldmask = os.umask(0)
+        try:
+            fsdb._makedirs(path)
+        finally:
+            # fsdb does not restore the umask if the directory already exists
+            os.umask(oldmask)
+
+
+class SpoolFile(object):
+    '''Writable file object that stores its content into fsdb
+
+       Data written to this object is saved into a temporary file inside
+       the fsdb root and hashed incrementally with `algorithms`
+       and with the algorithm used by fsdb to compute its keys.
+
+       Call :py:meth:`commit` to move the content into the fsdb tree
+       or :py:meth:`discard` to throw it away.
+
+       The spooled content can be read back, but digests only account
+       for data passed to :py:meth:`write`: do not write after seeking.
+    '''
+
+    def __init__(self, fsdb, algorithms=('sha1',)):
+        self._init_state(fsdb, algorithms)
+        spoolDir = get_spool_dir(fsdb)
+        fd, self.path = mkstemp(prefix='upload_', suffix='.tmp', dir=spoolDir)
+        with _umask_lock:
+            oldmask = os.umask(0)
+            try:
+                os.chmod(self.path, fsdb._conf['fmode'])
+            finally:
+                os.umask(oldmask)
+        self._file = os.fdopen(fd, 'w+b')
+
+    def _init_state(self, fsdb, algorithms):
+        self._fsdb = fsdb
+        self._fsdb_alg = fsdb._conf['hash_alg']
+        self._hashes = dict()
+        for alg in set(algorithms) | set([self._fsdb_alg]):
+            self._hashes[alg] = hashlib.new(alg)
+        self.size = 0
+        self.fsdb_id = None
+        # true if the content was already stored in fsdb
+        self.deduplicated = False
+
+    @classmethod
+    def reopen(cls, fsdb, path, size, algorithms=('sha1',)):
+        '''resume the spool file left at `path` keeping its first `size` bytes
+
+           The kept content is read again to rebuild its digests.
+        '''
+        self = cls.__new__(cls)
+        self._init_state(fsdb, algorithms)
+        self.path = path
+        self._file = open(path, 'r+b')
+        self._file.truncate(size)
+        while True:
+            chunk = self._file.read(BLOCK_SIZE)
+            if not chunk:
+                break
+            for h in self._hashes.itervalues():
+                h.update(chunk)
+            self.size += len(chunk)
+        return self
+
+    def checkpoint(self):
+        '''return the current state of the content, see :py:meth:`rollback`'''
+        return self.size, dict((alg, h.copy()) for alg, h in self._hashes.iteritems())
+
+    def rollback(self, checkpoint):
+        '''discard what has been written after the given :py:meth:`checkpoint`'''
+        size, hashes = checkpoint
+        self._hashes = dict((alg, h.copy()) for alg, h in hashes.iteritems())
+        self.size = size
+        self._file.truncate(size)
+        self._file.seek(size)
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    @property
+    def committed(self):
+        return self.fsdb_id is not None
+
+    def write(self, chunk):
+        self._file.write(chunk)
+        for h in self._hashes.itervalues():
+            h.update(chunk)
+        self.size += len(chunk)
+
+    def flush(self):
+        self._file.flush()
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def close(self):
+        self._file.close()
+
+    def hexdigest(self, algorithm='sha1'):
+        return self._hashes[algorithm].hexdigest()
+
+    def copy_from(self, origin, block_size=BLOCK_SIZE):
+        '''write all the remaining content of the readable object `origin`'''
+        while True:
+            chunk = origin.read(block_size)
+            if not chunk:
+                break
+            self.write(chunk)
+
+    def commit(self):
+        '''move the spooled content into the fsdb tree
+
+           Returns the fsdb id of the stored file.
+           If a file with the same digest is already stored
+           the spooled content is discarded.
+        '''
+        if self.committed:
+            return self.fsdb_id
+        self.close()
+        digest = self.hexdigest(self._fsdb_alg)
+        try:
+            if self._fsdb.exists(digest):
+                log.debug("file '{}' already stored, discarding spooled content".format(digest))
+                os.remove(self.path)
+                self.deduplicated = True
+            else:
+                dstPath = get_file_path(self._fsdb, digest, self.size)
+                makedirs(self._fsdb, os.path.dirname(dstPath))
+                try:
+                    os.rename(self.path, dstPath)
+                except OSError as e:
+                    if e.errno != errno.EXDEV:
+                        raise
+                    # the blob is placed on another device
+                    copy_file(self.path, dstPath)
+                    os.remove(self.path)
+                log.debug("stored file '{}' [{}]".format(digest, dstPath))
+        except Exception:
+            self.discard()
+            raise
+        self.fsdb_id = digest
+        return digest
+
+    def discard(self):
+        '''remove the spooled content, if any'''
+        self.close()
+        try:
+            os.remove(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.discard()
+
+
+class StoredFile(object):
+    '''Content found already stored in fsdb
+
+       Exposes the same attributes of a committed :py:class:`SpoolFile`.
+    '''
+
+    committed = True
+    deduplicated = True
+
+    def __init__(self, fsdb_id, size, hexdigests):
+        self.fsdb_id = fsdb_id
+        self.size = size
+        self._hexdigests = hexdigests
+
+    def hexdigest(self, algorithm='sha1'):
+        return self._hexdigests[algorithm]
+
+
+def hash_file(path, algorithms, block_size=BLOCK_SIZE):
+    '''return the size and a dict of hexdigests of the file at `path`'''
+    hashes = dict((alg, hashlib.new(alg)) for alg in algorithms)
+    size = 0
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(block_size)
+            if not chunk:
+                break
+            size += len(chunk)
+            for h in hashes.itervalues():
+                h.update(chunk)
+    return size, dict((alg, h.hexdigest()) for alg, h in hashes.iteritems())
+
+
+def get_file_path(fsdb, digest, size):
+    '''return the path where a blob of `size` bytes is stored, or should be written'''
+    if isinstance(fsdb, ShardedFsdb):
+        return fsdb.get_file_path(digest, size)
+    return fsdb.get_file_path(digest)
+
+
+def get_spool_dir(fsdb):
+    '''return the spool directory of the given fsdb, creating it if needed'''
+    spoolDir = os.path.join(fsdb.fsdbRoot, SPOOL_DIR)
+    makedirs(fsdb, spoolDir)
+    return spoolDir
+
+
+def ingest(fsdb, origin, algorithms=('sha1',), prehash=False):
+    '''store `origin` into fsdb reading its content only once
+
+       param `origin` must be a path or a readable object,
+       in the latter case the content is read starting from the current position.
+       If `origin` is a :py:class:`SpoolFile` of the same fsdb holding all
+       the requested digests, it is committed without copying its content.
+       If `origin` is a path and `prehash` is True, it is hashed first and
+       copied only if its content is not already stored: this avoids writing
+       contents already stored, but new ones are read twice.
+
+       Returns the committed :py:class:`SpoolFile` (or a :py:class:`StoredFile`),
+       that holds the fsdb id, the size and the digests of the stored content;
+       its `deduplicated` attribute tells if the content was already stored.
+    '''
+    if isinstance(origin, SpoolFile) and origin._fsdb is fsdb and \
+            all(alg in origin._hashes for alg in algorithms):
+        origin.commit()
+        return origin
+
+    if prehash and isinstance(origin, basestring):
+        fsdbAlg = fsdb._conf['hash_alg']
+        size, hexdigests = hash_file(origin, set(algorithms) | set([fsdbAlg]))
+        if fsdb.exists(hexdigests[fsdbAlg]):
+            log.debug("file '{}' already stored, skipping copy".format(hexdigests[fsdbAlg]))
+            return StoredFile(hexdigests[fsdbAlg], size, hexdigests)
+
+    with SpoolFile(fsdb, algorithms=algorithms) as spool:
+        if isinstance(origin, basestring):
+            with open(origin, 'rb') as f:
+                spool.copy_from(f)
+        else:
+            spool.copy_from(origin)
+    return spool
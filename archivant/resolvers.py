@@ -0,0 +1,159 @@
+'''Backends holding the content of attachments
+
+Every attachment has an url whose scheme selects the resolver used to open it,
+see :py:meth:`archivant.Archivant.register_resolver`.
+
+ * ``fsdb:///<id>`` files are stored in the local fsdb.
+ * ``s3://<bucket>/<key>`` objects are stored in an S3 compatible object store,
+   and are kept on local disk by a :py:class:`~archivant.diskcache.DiskCache`
+   once they have been downloaded.
+'''
+import os
+import hmac
+import hashlib
+import urllib2
+from datetime import datetime
+from urllib import quote
+from urlparse import urlparse
+
+from logging import getLogger
+log = getLogger('archivant')
+
+
+class FsdbResolver(object):
+    '''open ``fsdb:///<id>`` urls from the fsdb of an archivant instance'''
+
+    def __init__(self, archivant):
+        self._archivant = archivant
+
+    def open(self, url):
+        return self._archivant._fsdb[os.path.basename(urlparse(url).path)]
+
+
+def sha256_hex(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _hmac(key, msg):
+    return hmac.new(key, msg, hashlib.sha256).digest()
+
+
+def sign_request(method, url, headers, access_key, secret_key, region, service='s3', now=None):
+    '''add AWS signature version 4 headers to `headers`
+
+       The payload is not signed, so that bodies can be streamed.
+    '''
+    now = now or datetime.utcnow()
+    amzDate = now.strftime('%Y%m%dT%H%M%SZ')
+    date = now.strftime('%Y%m%d')
+    parsed = urlparse(url)
+    headers['Host'] = parsed.netloc
+    headers['X-Amz-Date'] = amzDate
+    headers['X-Amz-Content-Sha256'] = 'UNSIGNED-PAYLOAD'
+
+    signed = sorted((k.lower(), ' '.join(str(v).split())) for k, v in headers.iteritems())
+    signedHeaders = ';'.join(k for k, _ in signed)
+    canonicalRequest = '\n'.join([method,
+                                  quote(parsed.path or '/', safe='/~'),
+                                  '&'.join(sorted(q for q in parsed.query.split('&') if q)),
+                                  ''.join('{}:{}\n'.format(k, v) for k, v in signed),
+                                  signedHeaders,
+                                  'UNSIGNED-PAYLOAD'])
+    scope = '/'.join([date, region, service, 'aws4_request'])
+    stringToSign = '\n'.join(['AWS4-HMAC-SHA256', amzDate, scope, sha256_hex(canonicalRequest)])
+
+    key = _hmac(('AWS4' + secret_key).encode('utf-8'), date)
+    for part in (region, service, 'aws4_request'):
+        key = _hmac(key, part)
+    signature = hmac.new(key, stringToSign, hashlib.sha256).hexdigest()
+    headers['Authorization'] = 'AWS4-HMAC-SHA256 Credential={}/{}, SignedHeaders={}, Signature={}'.format(
+        access_key, scope, signedHeaders, signature)
+    return headers
+
+
+class _Request(urllib2.Request):
+
+    def __init__(self, method, *args, **kwargs):
+        urllib2.Request.__init__(self, *args, **kwargs)
+        self._method = method
+
+    def get_method(self):
+        return self._method
+
+
+class ObjectStoreResolver(object):
+    '''open ``s3://<bucket>/<key>`` urls from an S3 compatible object store
+
+       Objects are requested with path-style urls (``<endpoint>/<bucket>/<key>``).
+       If a :py:class:`~archivant.diskcache.DiskCache` is given,
+       objects are served from it when possible, otherwise they are streamed
+       from the object store while being copied into the cache.
+
+       :param endpoint: base url of the object store, e.g. ``https://s3.example.org``
+       :param bucket: bucket in which new objects are stored
+    '''
+
+    def __init__(self, endpoint, bucket, access_key, secret_key, region='us-east-1', cache=None, timeout=30):
+        self.endpoint = endpoint.rstrip('/')
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.cache = cache
+        self.timeout = timeout
+
+    def url(self, key, bucket=None):
+        '''return the attachment url of the given object'''
+        return 's3://{}/{}'.format(bucket or self.bucket, key)
+
+    def _request(self, method, bucket, key, data=None, headers=None):
+        url = '{}/{}/{}'.format(self.endpoint, bucket, quote(key, safe='/~'))
+        headers = sign_request(method, url, dict(headers or {}),
+                               self.access_key, self.secret_key, self.region)
+        # the Host header is set by urllib2
+        del headers['Host']
+        return urllib2.urlopen(_Request(method, url, data=data, headers=headers), timeout=self.timeout)
+
+    @staticmethod
+    def _split_url(url):
+        parsed = urlparse(url)
+        return parsed.netloc, parsed.path.lstrip('/')
+
+    def open(self, url):
+        '''return a readable file object with the content of the object
+
+           Raises KeyError if the object does not exist.
+        '''
+        bucket, key = self._split_url(url)
+        if self.cache is not None:
+            cached = self.cache.get(url)
+            if cached is not None:
+                log.debug("object cache hit: '{}'".format(url))
+                return cached
+        log.debug("fetching '{}' from the object store".format(url))
+        try:
+            res = self._request('GET', bucket, key)
+        except urllib2.HTTPError as e:
+            if e.code == 404:
+                raise KeyError("no stored object found for '{}'".format(url))
+            raise
+        if self.cache is None:
+            return res
+        size = res.info().getheader('Content-Length')
+        return self.cache.tee(url, res, int(size) if size is not None else None)
+
+    def exists(self, url):
+        bucket, key = self._split_url(url)
+        try:
+            self._request('HEAD', bucket, key).close()
+        except urllib2.HTTPError as e:
+            if e.code == 404:
+                return False
+            raise
+        return True
+
+    def store(self, key, f, size):
+        '''upload `size` bytes read from the file object `f` and return the url of the new object'''
+        headers = {'Content-Length': str(size), 'Content-Type': 'application/octet-stream'}
+        self._request('PUT', self.bucket, key, data=f, headers=headers).close()
+        return self.url(key)
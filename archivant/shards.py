@@ -0,0 +1,176 @@
+'''Storage of fsdb blobs across several directories
+
+:py:class:`ShardedFsdb` spreads blobs over many :py:class:`fsdb.Fsdb`
+instances, usually placed on different devices, and exposes the part of
+the :py:class:`fsdb.Fsdb` interface used by archivant, so that ``fsdb:///``
+urls keep being resolved transparently.
+
+Blobs are placed by weighted rendezvous hashing of the first
+:py:data:`PREFIX_LENGTH` characters of their digest: every prefix has its own
+ranking of the shards, and a blob goes to the first shard in that ranking
+with enough free space. Adding a shard only changes the preferred location
+of the prefixes it wins, that :py:meth:`ShardedFsdb.rebalance` moves there.
+'''
+import os
+import math
+import errno
+import shutil
+import hashlib
+from itertools import chain
+
+from fsdb import Fsdb
+
+from logging import getLogger
+log = getLogger('archivant')
+
+
+PREFIX_LENGTH = 4
+
+
+def free_space(path):
+    '''bytes available to unprivileged users on the filesystem of `path`'''
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+def copy_file(src, dst):
+    '''atomically create `dst` with the content of `src`
+
+       A hard link is used when both are on the same device.
+    '''
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        tmpPath = dst + '.tmp'
+        shutil.copy2(src, tmpPath)
+        os.rename(tmpPath, dst)
+
+
+class ShardedFsdb(object):
+    '''Fsdb-like storage spread over several roots
+
+       :param shards: list of paths, or of (path, weight) pairs.
+                      Weights are positive numbers, the default one is 1.
+                      The first shard also holds spool files and fsck state.
+       :param reserve: bytes to leave free on every device
+    '''
+
+    def __init__(self, shards, reserve=0):
+        self.shards = []
+        self.weights = []
+        for shard in shards:
+            if isinstance(shard, basestring):
+                path, weight = shard, 1
+            else:
+                path, weight = shard
+            if weight <= 0:
+                raise ValueError("weight of shard '{}' must be positive".format(path))
+            self.shards.append(Fsdb(path))
+            self.weights.append(float(weight))
+        if not self.shards:
+            raise ValueError('at least one shard is needed')
+        self._conf = self.shards[0]._conf
+        for shard in self.shards[1:]:
+            if shard._conf['hash_alg'] != self._conf['hash_alg'] or shard._conf['depth'] != self._conf['depth']:
+                raise ValueError("shard '{}' has a different configuration from '{}'".format(shard.fsdbRoot, self.fsdbRoot))
+        self.reserve = reserve
+
+    @property
+    def fsdbRoot(self):
+        return self.shards[0].fsdbRoot
+
+    def _makedirs(self, path):
+        self.shards[0]._makedirs(path)
+
+    def ranking(self, digest):
+        '''return the shards sorted by preference for the given digest'''
+        prefix = digest[:PREFIX_LENGTH]
+        scores = []
+        for shard, weight in zip(self.shards, self.weights):
+            h = hashlib.sha1(shard.fsdbRoot + ':' + prefix).hexdigest()
+            # uniform value in (0, 1)
+            u = (int(h[:15], 16) + 1) / float(16**15 + 1)
+            scores.append((-weight / math.log(u), shard))
+        scores.sort(key=lambda s: s[0], reverse=True)
+        return [shard for _, shard in scores]
+
+    def placement(self, digest, size=0):
+        '''return the shard where a new blob should be written'''
+        for shard in self.ranking(digest):
+            if free_space(shard.fsdbRoot) - self.reserve > size:
+                return shard
+        raise IOError(errno.ENOSPC, 'no shard has enough free space for {} bytes'.format(size))
+
+    def locate(self, digest):
+        '''return the shard holding the given blob, None if it is not stored'''
+        for shard in self.ranking(digest):
+            if shard.exists(digest):
+                return shard
+        return None
+
+    def exists(self, digest):
+        return self.locate(digest) is not None
+
+    def __contains__(self, digest):
+        return self.exists(digest)
+
+    def get_file_path(self, digest, size=0):
+        '''path of the stored blob, or the one where it should be written if it is `size` bytes long'''
+        shard = self.locate(digest) or self.placement(digest, size)
+        return shard.get_file_path(digest)
+
+    def __getitem__(self, digest):
+        shard = self.locate(digest)
+        if shard is None:
+            raise KeyError("no stored file found for '{0}'".format(digest))
+        return shard[digest]
+
+    def remove(self, digest):
+        shard = self.locate(digest)
+        if shard is None:
+            raise KeyError("no stored file found for '{0}'".format(digest))
+        shard.remove(digest)
+
+    def check(self, digest):
+        shard = self.locate(digest)
+        return shard is not None and shard.check(digest)
+
+    def corrupted(self):
+        return chain(*[shard.corrupted() for shard in self.shards])
+
+    def size(self):
+        return sum(shard.size() for shard in self.shards)
+
+    def __iter__(self):
+        return chain(*self.shards)
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def rebalance(self, dryrun=False):
+        '''move every blob to its preferred shard
+
+           Returns a tuple (moved blobs, moved bytes).
+        '''
+        moved = 0
+        movedBytes = 0
+        for shard in self.shards:
+            for digest in list(shard):
+                path = shard.get_file_path(digest)
+                size = os.path.getsize(path)
+                target = self.placement(digest, size)
+                ranking = self.ranking(digest)
+                # when preferred shards are full the current one could be the best choice
+                if ranking.index(target) >= ranking.index(shard):
+                    continue
+                log.info("rebalance: moving '{}' from '{}' to '{}'".format(digest, shard.fsdbRoot, target.fsdbRoot))
+                if not dryrun:
+                    dstPath = target.get_file_path(digest)
+                    target._makedirs(os.path.dirname(dstPath))
+                    copy_file(path, dstPath)
+                    shard.remove(digest)
+                moved += 1
+                movedBytes += size
+        return moved, movedBytes
@@ -20,6 +20,8 @@ class TestArchivant():
     @classmethod
     def tearDownClass(self):
         self.es.indices.delete(self.TEST_ES_INDEX)
+        self.es.indices.delete(self.TEST_ES_INDEX + '-counters', ignore=[404])
+        self.es.indices.delete(self.TEST_ES_INDEX + '-refs', ignore=[404])
 
     def setUp(self):
         self.tmpDir = mkdtemp(prefix=self.FSDB_PATH_PREFIX)
@@ -1,7 +1,7 @@
 from archivant.test.class_template import TestArchivant
 from archivant.exceptions import NotFoundException
 
-from nose.tools import eq_, raises  # , ok_
+from nose.tools import eq_, ok_, raises
 
 
 class TestArchivantAttachmentOperations(TestArchivant):
@@ -80,3 +80,32 @@ class TestArchivantAttachmentOperations(TestArchivant):
         self.arc.update_attachment(volumeID, added_volume['attachments'][0]['id'], {'notes': 'new_notes'})
         added_volume = self.arc.get_volume(volumeID)
         eq_(added_volume['attachments'][0]['metadata']['notes'], 'new_notes')
+
+    def test_insert_stored_attachment(self):
+        attachments = self.generate_attachments(1)
+        volumeID = self.arc.insert_volume(self.generate_volume_metadata(), attachments=attachments)
+        stored = self.arc.get_volume(volumeID)['attachments'][0]
+        sha1, size = stored['metadata']['sha1'], stored['metadata']['size']
+        eq_(self.arc.find_stored_file(sha1, size + 1), None)
+        otherID = self.arc.insert_volume(self.generate_volume_metadata())
+        self.arc.insert_attachments(otherID, [{'sha1': sha1, 'size': size, 'name': 'copy.txt'}])
+        added = self.arc.get_volume(otherID)['attachments'][0]
+        eq_(added['url'], stored['url'])
+        eq_(added['metadata']['name'], 'copy.txt')
+        eq_(self.arc.dedup_stats['bytes'], size)
+
+    @raises(NotFoundException)
+    def test_insert_stored_attachment_missing(self):
+        volumeID = self.arc.insert_volume(self.generate_volume_metadata())
+        self.arc.insert_attachments(volumeID, [{'sha1': 'a' * 40, 'size': 1, 'name': 'missing'}])
+
+    def test_update_attachment_download_count(self):
+        volume_metadata = self.generate_volume_metadata()
+        attachments = self.generate_attachments(1)
+        volumeID = self.arc.insert_volume(volume_metadata, attachments=attachments)
+        attachmentID = self.arc.get_volume(volumeID)['attachments'][0]['id']
+        self.arc.update_attachment(volumeID, attachmentID, {'download_count': 7})
+        eq_(self.arc.get_attachment(volumeID, attachmentID)['metadata']['download_count'], 7)
+        eq_(self.arc.get_volume(volumeID)['attachments'][0]['metadata']['download_count'], 7)
+        raw = self.arc._db.get_book_by_id(volumeID)
+        ok_('download_count' not in raw['_source']['_attachments'][0])
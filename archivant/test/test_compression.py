@@ -0,0 +1,140 @@
+import os
+import zlib
+import gzip
+import hashlib
+from shutil import rmtree
+from tempfile import mkdtemp
+from StringIO import StringIO
+
+from fsdb import Fsdb
+from nose.tools import eq_, ok_, raises
+
+from archivant import compression
+from archivant.compression import is_compressible, ingest_compressed, decode, deflate_member, GzipReader, SeekableGzipReader
+
+
+TEXT = ''.join('line {} of a very repetitive text\n'.format(i % 50) for i in range(5000))
+
+
+def test_is_compressible():
+    ok_(is_compressible('text/plain'))
+    ok_(is_compressible('text/html; charset=utf-8'))
+    ok_(is_compressible('application/pdf'))
+    ok_(not is_compressible('application/epub+zip'))
+    ok_(not is_compressible('image/jpeg'))
+    ok_(is_compressible(None, 'book.txt'))
+    ok_(not is_compressible(None, 'book'))
+
+
+class TestCompression():
+
+    def setUp(self):
+        self.tmpDir = mkdtemp(prefix='archivant_test_compression_')
+        self.fsdb = Fsdb(os.path.join(self.tmpDir, 'fsdb'))
+
+    def tearDown(self):
+        rmtree(self.tmpDir)
+
+    def test_ingest(self):
+        stored = ingest_compressed(self.fsdb, StringIO(TEXT))
+        ok_(stored is not None)
+        eq_(stored.size, len(TEXT))
+        eq_(stored.hexdigest('sha1'), hashlib.sha1(TEXT).hexdigest())
+        ok_(stored.stored_size < len(TEXT) / 10)
+        ok_(not stored.deduplicated)
+        path = self.fsdb.get_file_path(stored.fsdb_id)
+        eq_(os.path.getsize(path), stored.stored_size)
+        # stored content is a regular gzip file
+        eq_(gzip.open(path).read(), TEXT)
+
+    def test_ingest_path_twice(self):
+        path = os.path.join(self.tmpDir, 'text')
+        with open(path, 'wb') as f:
+            f.write(TEXT)
+        first = ingest_compressed(self.fsdb, path)
+        second = ingest_compressed(self.fsdb, path)
+        eq_(first.fsdb_id, second.fsdb_id)
+        ok_(second.deduplicated)
+        eq_(len(self.fsdb), 1)
+
+    def test_not_worth(self):
+        data = os.urandom(10000)
+        origin = StringIO('header' + data)
+        origin.read(6)
+        ok_(ingest_compressed(self.fsdb, origin) is None)
+        eq_(origin.read(), data)
+        eq_(len(self.fsdb), 0)
+        eq_(os.listdir(os.path.join(self.fsdb.fsdbRoot, '.spool')), [])
+
+    def test_not_worth_sample(self):
+        old = compression.SAMPLE_SIZE
+        compression.SAMPLE_SIZE = 2**20
+        try:
+            origin = StringIO(os.urandom(2**20) + TEXT * 100)
+            ok_(ingest_compressed(self.fsdb, origin) is None)
+            eq_(origin.tell(), 0)
+        finally:
+            compression.SAMPLE_SIZE = old
+
+    def test_not_seekable(self):
+        class Stream(object):
+            def read(self, size=-1):
+                return ''
+        ok_(ingest_compressed(self.fsdb, Stream()) is None)
+
+    def test_decode(self):
+        stored = ingest_compressed(self.fsdb, StringIO(TEXT))
+        f = decode(self.fsdb[stored.fsdb_id], 'gzip')
+        ok_(isinstance(f, SeekableGzipReader))
+        eq_(f.read(10), TEXT[:10])
+        eq_(f.tell(), 10)
+        f.seek(1000)
+        eq_(f.read(10), TEXT[1000:1010])
+        f.seek(5)
+        eq_(f.read(10), TEXT[5:15])
+        eq_(f.read(), TEXT[15:])
+        eq_(f.read(), '')
+        f.close()
+
+    def test_decode_stream(self):
+        stored = ingest_compressed(self.fsdb, StringIO(TEXT))
+        f = self.fsdb[stored.fsdb_id]
+
+        class Stream(object):
+            read = f.read
+            close = f.close
+        reader = decode(Stream(), 'gzip')
+        ok_(type(reader) is GzipReader)
+        eq_(reader.read(), TEXT)
+
+    def test_decode_small_reads(self):
+        stored = ingest_compressed(self.fsdb, StringIO(TEXT))
+        f = decode(self.fsdb[stored.fsdb_id], 'gzip')
+        pieces = []
+        while True:
+            piece = f.read(7)
+            if not piece:
+                break
+            pieces.append(piece)
+        eq_(''.join(pieces), TEXT)
+        eq_(f.tell(), len(TEXT))
+        f.close()
+
+    def test_deflate_member(self):
+        stored = ingest_compressed(self.fsdb, StringIO(TEXT))
+        f = self.fsdb[stored.fsdb_id]
+        crc, offset, length = deflate_member(f, stored.stored_size)
+        eq_(crc, zlib.crc32(TEXT) & 0xFFFFFFFF)
+        f.seek(offset)
+        eq_(zlib.decompress(f.read(length), -zlib.MAX_WBITS), TEXT)
+        f.close()
+
+    def test_deflate_member_header_fields(self):
+        data = StringIO()
+        with gzip.GzipFile('named.txt', 'wb', fileobj=data) as g:
+            g.write(TEXT)
+        ok_(deflate_member(data, len(data.getvalue())) is None)
+
+    @raises(ValueError)
+    def test_decode_unknown(self):
+        decode(StringIO(''), 'br')
@@ -0,0 +1,67 @@
+from nose.tools import eq_, ok_
+
+from archivant.contentcache import ContentCache
+
+
+def request(cache, key, content):
+    '''simulate the way contents are requested by webant'''
+    entry = cache.get(key)
+    if entry is None and cache.admits(key, len(content)):
+        cache.put(key, content)
+    return entry
+
+
+def test_admission():
+    cache = ContentCache(100, min_hits=2)
+    ok_(request(cache, 'a', 'x' * 10) is None)
+    ok_('a' not in cache)
+    ok_(request(cache, 'a', 'x' * 10) is None)
+    ok_('a' in cache)
+    eq_(request(cache, 'a', 'x' * 10), ('x' * 10, None))
+    stats = cache.stats
+    eq_(stats['hits'], 1)
+    eq_(stats['misses'], 2)
+    eq_(stats['admissions'], 1)
+    eq_(stats['size'], 10)
+
+
+def test_max_item_size():
+    cache = ContentCache(100, max_item_size=5, min_hits=1)
+    cache.get('a')
+    ok_(not cache.admits('a', 10))
+    ok_(cache.admits('a', 5))
+    cache.put('b', 'x' * 10)
+    ok_('b' not in cache)
+
+
+def test_lru_eviction():
+    cache = ContentCache(25, min_hits=1)
+    cache.put('a', 'a' * 10)
+    cache.put('b', 'b' * 10)
+    cache.get('a')
+    cache.put('c', 'c' * 10)
+    ok_('a' in cache)
+    ok_('b' not in cache)
+    ok_('c' in cache)
+    eq_(cache.stats['evictions'], 1)
+    eq_(cache.stats['size'], 20)
+
+
+def test_replace():
+    cache = ContentCache(100)
+    cache.put('a', 'a' * 10, 'yesterday')
+    cache.put('a', 'a' * 20, 'today')
+    eq_(cache.stats['size'], 20)
+    eq_(cache.get('a'), ('a' * 20, 'today'))
+
+
+def test_history_size():
+    cache = ContentCache(100, min_hits=2, history_size=2)
+    cache.get('a')
+    cache.get('b')
+    cache.get('c')
+    # requests of 'a' have been forgotten
+    cache.get('a')
+    ok_(not cache.admits('a', 1))
+    cache.get('c')
+    ok_(cache.admits('c', 1))
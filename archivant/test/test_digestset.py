@@ -0,0 +1,58 @@
+from hashlib import sha1, sha256
+
+from nose.tools import eq_, ok_, raises
+
+from archivant.digestset import DigestSet
+
+
+def digests(n, start=0):
+    return [sha1(str(i)).hexdigest() for i in xrange(start, start + n)]
+
+
+def test_empty():
+    s = DigestSet([])
+    eq_(len(s), 0)
+    ok_(digests(1)[0] not in s)
+
+
+def test_membership():
+    present = digests(50)
+    s = DigestSet(present)
+    eq_(len(s), 50)
+    for d in present:
+        ok_(d in s)
+    for d in digests(50, start=50):
+        ok_(d not in s)
+
+
+def test_chunked_merge():
+    present = digests(95)
+    s = DigestSet(present + present[:10], chunk_size=10)
+    eq_(len(s), 95)
+    eq_(list(s), sorted(present))
+    for d in present:
+        ok_(d in s)
+
+
+def test_invalid_lookup():
+    s = DigestSet(digests(1))
+    ok_('notanhex' not in s)
+    ok_('abcd' not in s)
+
+
+@raises(ValueError)
+def test_invalid_digest():
+    DigestSet([digests(1)[0], 'notanhex'])
+
+
+@raises(ValueError)
+def test_digest_of_another_length():
+    DigestSet([digests(1)[0], 'abcd'])
+
+
+def test_hash_alg():
+    present = [sha256(str(i)).hexdigest() for i in xrange(10)]
+    s = DigestSet(present, hash_alg='sha256')
+    eq_(len(s), 10)
+    ok_(present[0] in s)
+    ok_(digests(1)[0] not in s)
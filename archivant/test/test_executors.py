@@ -0,0 +1,39 @@
+import threading
+
+from nose.tools import eq_, ok_, raises
+
+from archivant.executors import ThreadExecutor
+
+
+def test_order():
+    executor = ThreadExecutor()
+    eq_(executor.map(lambda x: x * 2, range(20), 4), [x * 2 for x in range(20)])
+    eq_(executor.stats.as_dict()['tasks'], 20)
+
+
+def test_serial_in_caller_thread():
+    threads = ThreadExecutor().map(lambda _: threading.current_thread(), range(3), 1)
+    ok_(all(t is threading.current_thread() for t in threads))
+
+
+def test_first_error_after_all_calls():
+    calls = []
+
+    def func(x):
+        calls.append(x)
+        if x in (3, 5):
+            raise ValueError(x)
+        return x
+
+    try:
+        ThreadExecutor().map(func, range(10), 4)
+    except ValueError as e:
+        eq_(e.args, (3,))
+    else:
+        ok_(False, 'an error should have been raised')
+    eq_(sorted(calls), range(10))
+
+
+@raises(KeyError)
+def test_error_serial():
+    ThreadExecutor().map(lambda x: {}[x], [1], 1)
@@ -0,0 +1,73 @@
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+from StringIO import StringIO
+
+from fsdb import Fsdb
+from nose.tools import eq_
+
+from archivant.fsck import Fsck, FsckState, verify_file
+
+
+class TestFsck():
+
+    def setUp(self):
+        self.tmpDir = mkdtemp(prefix='archivant_test_fsck_')
+        self.fsdb = Fsdb(os.path.join(self.tmpDir, 'fsdb'))
+        self.statePath = os.path.join(self.tmpDir, 'state')
+        self.digests = [self.fsdb.add(StringIO('content {}'.format(i))) for i in range(20)]
+
+    def tearDown(self):
+        rmtree(self.tmpDir)
+
+    def corrupt(self, digest):
+        path = self.fsdb.get_file_path(digest)
+        os.chmod(path, 0o600)
+        with open(path, 'ab') as f:
+            f.write('garbage')
+
+    def fsck(self, **kwargs):
+        kwargs.setdefault('state_path', self.statePath)
+        return Fsck(self.fsdb, **kwargs)
+
+    def test_no_corrupted(self):
+        checker = self.fsck(processes=1)
+        eq_(list(checker.corrupted()), [])
+        eq_(checker.stats['verified'], 20)
+
+    def test_corrupted_parallel(self):
+        self.corrupt(self.digests[3])
+        checker = self.fsck(processes=3, read_ahead=2)
+        eq_(list(checker.corrupted()), [self.digests[3]])
+        eq_(checker.stats['verified'], 20)
+        eq_(checker.stats['corrupted'], 1)
+
+    def test_only_changed_reverified(self):
+        list(self.fsck(processes=1).run())
+        self.corrupt(self.digests[5])
+        checker = self.fsck(processes=1)
+        eq_(list(checker.corrupted()), [self.digests[5]])
+        eq_(checker.stats['verified'], 1)
+        eq_(checker.stats['skipped'], 19)
+
+    def test_max_age(self):
+        list(self.fsck(processes=1).run())
+        checker = self.fsck(processes=1, max_age=0)
+        list(checker.run())
+        eq_(checker.stats['verified'], 20)
+
+    def test_resume(self):
+        results = self.fsck(processes=1).run()
+        for _ in range(8):
+            next(results)
+        results.close()
+        checker = self.fsck(processes=1)
+        list(checker.run())
+        eq_(checker.stats['verified'], 12)
+        eq_(len(FsckState(self.statePath).records), 20)
+
+    def test_vanished_not_corrupted(self):
+        path = self.fsdb.get_file_path(self.digests[0])
+        eq_(verify_file((self.digests[0], path, 'sha1'))[1], True)
+        os.remove(path)
+        eq_(verify_file((self.digests[0], path, 'sha1'))[1], None)
@@ -23,3 +23,14 @@ class TestArchivantGetAttachment(TestArchivant):
         added_volume = self.arc.get_volume(volumeID)
         file = self.arc.get_file(volumeID, added_volume['attachments'][0]['id'])
         eq_(file.read(), content)
+
+    def test_get_attachment_file(self):
+        content = "unascrittaperprovare"
+        volume_metadata = self.generate_volume_metadata()
+        attachments = [{'file': StringIO(content), 'name': 'I_love.json'}]
+        volumeID = self.arc.insert_volume(volume_metadata, attachments=attachments)
+        attachmentID = self.arc.get_volume(volumeID)['attachments'][0]['id']
+        attachment, file = self.arc.get_attachment_file(volumeID, attachmentID)
+        eq_(attachment['id'], attachmentID)
+        eq_(attachment['metadata']['name'], 'I_love.json')
+        eq_(file.read(), content)
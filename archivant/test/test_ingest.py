@@ -0,0 +1,118 @@
+from archivant.ingest import ingest, SpoolFile, StoredFile, get_spool_dir
+from fsdb import Fsdb
+from fsdb.hashtools import calc_file_digest
+
+from nose.tools import eq_, ok_, raises
+from tempfile import mkdtemp, mkstemp
+from shutil import rmtree
+from StringIO import StringIO
+import hashlib
+import os
+
+
+class TestIngest():
+
+    def setUp(self):
+        self.tmpDir = mkdtemp(prefix='archivant_ingest_test_')
+        self.fsdb = Fsdb(os.path.join(self.tmpDir, 'fsdb'))
+
+    def tearDown(self):
+        rmtree(self.tmpDir)
+
+    def generate_file(self, content='some content'):
+        fd, path = mkstemp(dir=self.tmpDir)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        return path
+
+    def test_ingest_path(self):
+        path = self.generate_file()
+        stored = ingest(self.fsdb, path)
+        eq_(stored.fsdb_id, calc_file_digest(path, algorithm='sha1'))
+        eq_(stored.hexdigest('sha1'), calc_file_digest(path, algorithm='sha1'))
+        eq_(stored.size, os.path.getsize(path))
+        ok_(stored.fsdb_id in self.fsdb)
+        ok_(self.fsdb.check(stored.fsdb_id))
+
+    def test_ingest_file_object(self):
+        content = 'x' * 10 + 'y' * 10
+        f = StringIO(content)
+        f.seek(10)
+        stored = ingest(self.fsdb, f)
+        eq_(stored.size, 10)
+        eq_(stored.hexdigest('sha1'), hashlib.sha1('y' * 10).hexdigest())
+        eq_(self.fsdb[stored.fsdb_id].read(), 'y' * 10)
+
+    def test_ingest_extra_algorithm(self):
+        stored = ingest(self.fsdb, StringIO('content'), algorithms=['sha1', 'md5'])
+        eq_(stored.hexdigest('md5'), hashlib.md5('content').hexdigest())
+
+    def test_ingest_already_stored(self):
+        path = self.generate_file()
+        first = ingest(self.fsdb, path)
+        second = ingest(self.fsdb, path)
+        eq_(first.fsdb_id, second.fsdb_id)
+        ok_(not first.deduplicated)
+        ok_(second.deduplicated)
+        eq_(second.size, first.size)
+        eq_(second.hexdigest('sha1'), first.hexdigest('sha1'))
+        eq_(len(self.fsdb), 1)
+        eq_(os.listdir(get_spool_dir(self.fsdb)), [])
+
+    def test_ingest_prehash(self):
+        path = self.generate_file()
+        first = ingest(self.fsdb, path, prehash=True)
+        ok_(not first.deduplicated)
+        second = ingest(self.fsdb, path, prehash=True)
+        ok_(isinstance(second, StoredFile))
+        eq_(second.fsdb_id, first.fsdb_id)
+        eq_(second.hexdigest('sha1'), first.hexdigest('sha1'))
+        eq_(len(self.fsdb), 1)
+
+    def test_ingest_file_object_already_stored(self):
+        first = ingest(self.fsdb, StringIO('content'))
+        second = ingest(self.fsdb, StringIO('content'))
+        eq_(first.fsdb_id, second.fsdb_id)
+        ok_(second.deduplicated)
+        eq_(len(self.fsdb), 1)
+        eq_(os.listdir(get_spool_dir(self.fsdb)), [])
+
+    def test_spool_discard(self):
+        spool = SpoolFile(self.fsdb)
+        spool.write('content')
+        spool.discard()
+        eq_(len(self.fsdb), 0)
+        eq_(os.listdir(get_spool_dir(self.fsdb)), [])
+
+    @raises(IOError)
+    def test_ingest_error_cleanup(self):
+        class BrokenFile(object):
+            def read(self, size):
+                raise IOError('broken')
+        try:
+            ingest(self.fsdb, BrokenFile())
+        finally:
+            eq_(os.listdir(get_spool_dir(self.fsdb)), [])
+
+    def test_spool_rollback(self):
+        spool = SpoolFile(self.fsdb)
+        spool.write('first')
+        checkpoint = spool.checkpoint()
+        spool.write('broken')
+        spool.rollback(checkpoint)
+        spool.write(' second')
+        eq_(spool.size, len('first second'))
+        eq_(spool.hexdigest('sha1'), hashlib.sha1('first second').hexdigest())
+        spool.commit()
+        eq_(self.fsdb[spool.fsdb_id].read(), 'first second')
+
+    def test_spool_reopen(self):
+        spool = SpoolFile(self.fsdb)
+        spool.write('first partial')
+        spool.close()
+        spool = SpoolFile.reopen(self.fsdb, spool.path, len('first'))
+        spool.write(' second')
+        eq_(spool.size, len('first second'))
+        eq_(spool.hexdigest('sha1'), hashlib.sha1('first second').hexdigest())
+        spool.commit()
+        eq_(self.fsdb[spool.fsdb_id].read(), 'first second')
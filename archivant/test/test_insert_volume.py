@@ -1,8 +1,10 @@
 from archivant.test.class_template import TestArchivant
+from archivant.ingest import SpoolFile, get_spool_dir
 from fsdb.hashtools import calc_file_digest, calc_digest
 
 from nose.tools import raises, ok_, eq_
 import os
+import threading
 from StringIO import StringIO
 
 
@@ -90,6 +92,35 @@ class TestArchivantInsertVolume(TestArchivant):
         added_attachments = (self.arc.get_volume(id))['attachments']
         eq_(len(added_attachments), num)
 
+    def test_insert_volume_same_file_twice(self):
+        attachments = self.generate_attachments(1)
+        id1 = self.arc.insert_volume(self.generate_volume_metadata(), attachments=attachments)
+        eq_(self.arc.dedup_stats, {'files': 0, 'bytes': 0})
+        id2 = self.arc.insert_volume(self.generate_volume_metadata(), attachments=attachments)
+        size = os.path.getsize(attachments[0]['file'])
+        eq_(self.arc.dedup_stats, {'files': 1, 'bytes': size})
+        url1 = self.arc.get_volume(id1)['attachments'][0]['url']
+        url2 = self.arc.get_volume(id2)['attachments'][0]['url']
+        eq_(url1, url2)
+        eq_(len(self.arc._fsdb), 1)
+
+    def test_insert_volume_same_path_prehashed(self):
+        self.arc._config['PREHASH_LOCAL_FILES'] = True
+        attachments = self.generate_attachments(1)
+        self.arc.insert_volume(self.generate_volume_metadata(), attachments=attachments)
+
+        def copy_from(*args, **kargs):
+            raise AssertionError('stored content copied again')
+        original = SpoolFile.copy_from
+        SpoolFile.copy_from = copy_from
+        try:
+            id = self.arc.insert_volume(self.generate_volume_metadata(), attachments=attachments)
+        finally:
+            SpoolFile.copy_from = original
+        eq_(self.arc.dedup_stats['files'], 1)
+        eq_(self.arc.get_volume(id)['attachments'][0]['metadata']['size'], os.path.getsize(attachments[0]['file']))
+        eq_(os.listdir(get_spool_dir(self.arc._fsdb)), [])
+
     @raises(ValueError)
     def test_insert_volume_with_readable_no_name(self):
         s = StringIO('unascrittaperprovare')
@@ -134,3 +165,61 @@ class TestArchivantInsertVolume(TestArchivant):
         volume_metadata = self.generate_volume_metadata()
         attachments = [{'file': "macheneso"}]
         self.arc.insert_volume(volume_metadata, attachments=attachments)
+
+    def test_insert_volume_compressed(self):
+        self.arc._config['COMPRESS_ATTACHMENTS'] = True
+        content = 'compressible content ' * 1000
+        attachments = [{'file': StringIO(content), 'name': 'book.txt', 'mime': 'text/plain'}]
+        id = self.arc.insert_volume(self.generate_volume_metadata(), attachments=attachments)
+        attachment = self.arc.get_volume(id)['attachments'][0]
+        eq_(attachment['metadata']['content_encoding'], 'gzip')
+        eq_(attachment['metadata']['size'], len(content))
+        eq_(attachment['metadata']['sha1'], calc_digest(StringIO(content), algorithm='sha1'))
+        ok_(os.path.getsize(self.arc._fsdb.get_file_path(attachment['url'][len('fsdb:///'):])) < len(content))
+        eq_(self.arc.get_file(id, attachment['id']).read(), content)
+        eq_(self.arc.open_attachment_file(attachment, decode_content=False).read()[:2], '\x1f\x8b')
+        # the uncompressed sha1 still identifies the stored content
+        eq_(self.arc.find_stored_file(attachment['metadata']['sha1'], len(content)),
+            attachment['url'][len('fsdb:///'):])
+
+    def test_insert_volume_concurrent_order(self):
+        self.arc._config['INGEST_CONCURRENCY'] = 4
+        contents = ['content number {}'.format(i) * (50 - i) for i in range(12)]
+        attachments = [{'file': StringIO(c), 'name': '{}.txt'.format(i)} for i, c in enumerate(contents)]
+        id = self.arc.insert_volume(self.generate_volume_metadata(), attachments=attachments)
+        inserted = self.arc.get_volume(id)['attachments']
+        eq_([a['metadata']['name'] for a in inserted], ['{}.txt'.format(i) for i in range(12)])
+        for a, c in zip(inserted, contents):
+            eq_(self.arc.get_file(id, a['id']).read(), c)
+
+    def test_insert_volume_hold_on_calling_thread(self):
+        self.arc._config['INGEST_CONCURRENCY'] = 4
+        attachments = [{'file': StringIO('content {}'.format(i)), 'name': '{}.txt'.format(i)} for i in range(4)]
+        self.arc.insert_volume(self.generate_volume_metadata(), attachments=attachments)
+        threads = []
+        hold = self.arc._hold_blob
+
+        def record_thread(blobID):
+            threads.append(threading.current_thread())
+            hold(blobID)
+        self.arc._hold_blob = record_thread
+        attachments = [{'file': StringIO('content {}'.format(i)), 'name': '{}.txt'.format(i)} for i in range(4)]
+        self.arc.insert_volume(self.generate_volume_metadata(), attachments=attachments)
+        eq_(threads, [threading.current_thread()] * 4)
+        eq_(self.arc.dedup_stats['files'], 4)
+
+    def test_insert_volume_concurrent_failure(self):
+        self.arc._config['INGEST_CONCURRENCY'] = 4
+        attachments = [{'file': StringIO('valid content {}'.format(i)), 'name': '{}.txt'.format(i)} for i in range(6)]
+        attachments.insert(3, {'file': 'not a file'})
+        try:
+            self.arc.insert_volume(self.generate_volume_metadata(), attachments=attachments)
+        except ValueError:
+            pass
+        else:
+            ok_(False, 'insertion should have failed')
+        self.refresh_index()
+        eq_(len(list(self.arc.iter_all_volumes())), 0)
+        # stored contents are left to the garbage collector
+        stored = list(self.arc._fsdb)
+        eq_(self.arc.collect_garbage(grace_period=0), len(stored))
@@ -0,0 +1,182 @@
+import os
+import threading
+from shutil import rmtree
+from tempfile import mkdtemp
+from StringIO import StringIO
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+from nose.tools import eq_, ok_, raises
+
+from archivant import Archivant
+from archivant.diskcache import DiskCache
+from archivant.resolvers import ObjectStoreResolver
+
+
+class ObjectStoreHandler(BaseHTTPRequestHandler):
+    '''minimal stand-in of an S3 compatible object store'''
+
+    def log_message(self, *args):
+        pass
+
+    def _authorized(self):
+        auth = self.headers.getheader('Authorization', '')
+        if not auth.startswith('AWS4-HMAC-SHA256 Credential={}/'.format(self.server.access_key)):
+            self.send_response(403)
+            self.end_headers()
+            return False
+        return True
+
+    def do_PUT(self):
+        if not self._authorized():
+            return
+        length = int(self.headers.getheader('Content-Length'))
+        self.server.objects[self.path] = self.rfile.read(length)
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self, body=True):
+        if not self._authorized():
+            return
+        self.server.gets += 1
+        if self.path not in self.server.objects:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        data = self.server.objects[self.path]
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if body:
+            self.wfile.write(data)
+
+    def do_HEAD(self):
+        self.do_GET(body=False)
+
+
+class TestObjectStore():
+
+    def setUp(self):
+        self.tmpDir = mkdtemp(prefix='archivant_test_resolvers_')
+        self.server = HTTPServer(('127.0.0.1', 0), ObjectStoreHandler)
+        self.server.objects = dict()
+        self.server.gets = 0
+        self.server.access_key = 'testkey'
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.endpoint = 'http://127.0.0.1:{}'.format(self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        rmtree(self.tmpDir)
+
+    def resolver(self, cache=None, access_key='testkey'):
+        return ObjectStoreResolver(self.endpoint, 'books', access_key, 'secret', cache=cache)
+
+    def test_store_and_open(self):
+        store = self.resolver()
+        url = store.store('abc', StringIO('some content'), 12)
+        eq_(url, 's3://books/abc')
+        eq_(self.server.objects['/books/abc'], 'some content')
+        ok_(store.exists(url))
+        ok_(not store.exists('s3://books/missing'))
+        eq_(store.open(url).read(), 'some content')
+
+    @raises(KeyError)
+    def test_open_missing(self):
+        self.resolver().open('s3://books/missing')
+
+    def test_bad_credentials(self):
+        store = self.resolver(access_key='wrong')
+        try:
+            store.store('abc', StringIO('x'), 1)
+        except Exception as e:
+            eq_(e.code, 403)
+        else:
+            ok_(False, 'upload should have been refused')
+
+    def test_cache_miss_then_hit(self):
+        cache = DiskCache(os.path.join(self.tmpDir, 'cache'), 100)
+        store = self.resolver(cache=cache)
+        url = store.store('abc', StringIO('x' * 30), 30)
+        with store.open(url) as f:
+            eq_(f.read(7), 'x' * 7)
+            eq_(f.read(), 'x' * 23)
+        eq_(self.server.gets, 1)
+        ok_(url in cache)
+        eq_(cache.size, 30)
+        # served from local disk
+        f = store.open(url)
+        eq_(f.read(), 'x' * 30)
+        ok_(hasattr(f, 'fileno'))
+        f.close()
+        eq_(self.server.gets, 1)
+
+    def test_partial_read_not_cached(self):
+        cache = DiskCache(os.path.join(self.tmpDir, 'cache'), 100)
+        store = self.resolver(cache=cache)
+        url = store.store('abc', StringIO('x' * 30), 30)
+        f = store.open(url)
+        f.read(10)
+        f.close()
+        ok_(url not in cache)
+        eq_(os.listdir(cache.path), [])
+
+    def test_archivant_resolver(self):
+        arc = Archivant({'ES_INDEXNAME': 'test-resolvers',
+                         'OBJECT_STORE': {'endpoint': self.endpoint, 'bucket': 'books',
+                                          'access_key': 'testkey', 'secret_key': 'secret'},
+                         'OBJECT_CACHE_PATH': os.path.join(self.tmpDir, 'cache')})
+        self.server.objects['/books/abc'] = 'stored remotely'
+        eq_(arc._resolve_url('s3://books/abc').read(), 'stored remotely')
+
+    @raises(Exception)
+    def test_archivant_unknown_scheme(self):
+        Archivant({'ES_INDEXNAME': 'test-resolvers'})._resolve_url('ftp://host/file')
+
+
+class TestDiskCache():
+
+    def setUp(self):
+        self.tmpDir = mkdtemp(prefix='archivant_test_diskcache_')
+
+    def tearDown(self):
+        rmtree(self.tmpDir)
+
+    def put(self, cache, key, data):
+        f = cache.tee(key, StringIO(data), len(data))
+        f.read()
+        f.close()
+
+    def test_eviction(self):
+        cache = DiskCache(self.tmpDir, 25)
+        self.put(cache, 'a', 'a' * 10)
+        self.put(cache, 'b', 'b' * 10)
+        # 'a' becomes the most recently used
+        cache.get('a').close()
+        self.put(cache, 'c', 'c' * 10)
+        ok_('a' in cache)
+        ok_('b' not in cache)
+        ok_('c' in cache)
+        eq_(cache.size, 20)
+        eq_(len(os.listdir(self.tmpDir)), 2)
+        ok_(cache.get('b') is None)
+
+    def test_too_big(self):
+        cache = DiskCache(self.tmpDir, 5)
+        self.put(cache, 'a', 'a' * 10)
+        ok_('a' not in cache)
+        eq_(os.listdir(self.tmpDir), [])
+
+    def test_reload(self):
+        cache = DiskCache(self.tmpDir, 100)
+        self.put(cache, 'a', 'a' * 10)
+        open(os.path.join(self.tmpDir, 'leftover.tmp'), 'w').close()
+        cache = DiskCache(self.tmpDir, 100)
+        eq_(len(cache), 1)
+        eq_(cache.size, 10)
+        eq_(cache.get('a').read(), 'a' * 10)
+        ok_(not os.path.exists(os.path.join(self.tmpDir, 'leftover.tmp')))
@@ -0,0 +1,86 @@
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+from StringIO import StringIO
+
+from nose.tools import eq_, ok_, raises
+
+from archivant import shards
+from archivant.shards import ShardedFsdb
+from archivant.ingest import ingest
+from archivant.fsck import Fsck
+
+
+class TestShardedFsdb():
+
+    def setUp(self):
+        self.tmpDir = mkdtemp(prefix='archivant_test_shards_')
+        self.paths = [os.path.join(self.tmpDir, str(i)) for i in range(3)]
+
+    def tearDown(self):
+        rmtree(self.tmpDir)
+
+    def fill(self, fsdb, n=60):
+        return [ingest(fsdb, StringIO('content {}'.format(i))).fsdb_id for i in range(n)]
+
+    def test_store_and_read(self):
+        fsdb = ShardedFsdb(self.paths)
+        digests = self.fill(fsdb)
+        eq_(len(fsdb), len(digests))
+        eq_(sorted(fsdb), sorted(digests))
+        for i, digest in enumerate(digests):
+            ok_(digest in fsdb)
+            eq_(fsdb[digest].read(), 'content {}'.format(i))
+            ok_(fsdb.locate(digest) is fsdb.ranking(digest)[0])
+        # blobs are spread over all the shards
+        ok_(all(len(shard) > 0 for shard in fsdb.shards))
+
+    def test_weights(self):
+        fsdb = ShardedFsdb([(self.paths[0], 1), (self.paths[1], 20)])
+        self.fill(fsdb)
+        ok_(len(fsdb.shards[1]) > len(fsdb.shards[0]))
+
+    def test_remove(self):
+        fsdb = ShardedFsdb(self.paths)
+        digest = self.fill(fsdb, 1)[0]
+        fsdb.remove(digest)
+        ok_(digest not in fsdb)
+
+    @raises(IOError)
+    def test_no_free_space(self):
+        fsdb = ShardedFsdb(self.paths, reserve=2**80)
+        self.fill(fsdb, 1)
+
+    def test_placement_checks_size(self):
+        fsdb = ShardedFsdb(self.paths)
+        freeSpace = shards.free_space
+        shards.free_space = lambda path: 100
+        try:
+            ingest(fsdb, StringIO('x' * 50))
+            try:
+                ingest(fsdb, StringIO('y' * 200))
+                ok_(False, 'blob should not fit any shard')
+            except IOError:
+                pass
+        finally:
+            shards.free_space = freeSpace
+        eq_(len(fsdb), 1)
+
+    def test_rebalance(self):
+        digests = self.fill(ShardedFsdb(self.paths[:2]))
+        fsdb = ShardedFsdb(self.paths)
+        for digest in digests:
+            ok_(digest in fsdb)
+        moved, _ = fsdb.rebalance()
+        ok_(moved > 0)
+        eq_(len(fsdb.shards[2]), moved)
+        for digest in digests:
+            ok_(fsdb.locate(digest) is fsdb.ranking(digest)[0])
+            ok_(fsdb.check(digest))
+        eq_(fsdb.rebalance(), (0, 0))
+
+    def test_fsck(self):
+        fsdb = ShardedFsdb(self.paths)
+        digests = self.fill(fsdb, 20)
+        checker = Fsck(fsdb, processes=1)
+        eq_(sorted(d for d, ok in checker.run()), sorted(digests))
@@ -14,7 +14,6 @@ class TestArchivantUpdateVolume(TestArchivant):
         rawVolume = self.arc._req_raw_volume(id)
         normalized = self.arc.normalize_volume(deepcopy(rawVolume))
         denom_id, denormalized = self.arc.denormalize_volume(normalized)
-        del(rawVolume['_source']['_text_' + rawVolume['_source']['_language']])
         eq_(denom_id, id)
         eq_(denormalized, rawVolume['_source'])
 
@@ -0,0 +1,193 @@
+import os
+import time
+import hashlib
+from shutil import rmtree
+from tempfile import mkdtemp
+from StringIO import StringIO
+
+from fsdb import Fsdb
+from nose.tools import eq_, ok_, raises, assert_raises
+
+from archivant.ingest import ingest, get_spool_dir
+from archivant.uploads import UploadManager
+from archivant.exceptions import NotFoundException, ConflictException
+from archivant.test.class_template import TestArchivant
+
+
+CONTENT = ''.join('chunk {} '.format(i) for i in range(1000))
+
+
+class TestUploads():
+
+    def setUp(self):
+        self.tmpDir = mkdtemp(prefix='archivant_test_uploads_')
+        self.fsdb = Fsdb(os.path.join(self.tmpDir, 'fsdb'))
+        self.uploads = UploadManager(self.fsdb, expire=60)
+
+    def tearDown(self):
+        rmtree(self.tmpDir)
+
+    def send(self, session, number, start, end):
+        return self.uploads.write_chunk(session.id, number, start, StringIO(CONTENT[start:end]), end - start)
+
+    def test_upload(self):
+        session = self.uploads.create('volume', len(CONTENT), {'name': 'file.txt'})
+        self.send(session, 0, 0, 1000)
+        self.send(session, 1, 1000, len(CONTENT))
+        ok_(session.complete)
+        status = session.status(self.uploads.expire)
+        eq_(status['received'], len(CONTENT))
+        eq_(status['chunks'], [0, 1])
+        eq_(session.spool.hexdigest('sha1'), hashlib.sha1(CONTENT).hexdigest())
+        stored = ingest(self.fsdb, session.spool)
+        eq_(self.fsdb[stored.fsdb_id].read(), CONTENT)
+        self.uploads.remove(session)
+        eq_(os.listdir(self.uploads.path), [])
+        eq_(os.listdir(get_spool_dir(self.fsdb)), [])
+
+    def test_chunk_sent_again(self):
+        session = self.uploads.create('volume', len(CONTENT), {'name': 'file.txt'})
+        self.send(session, 0, 0, 1000)
+        self.send(session, 0, 0, 1000)
+        eq_(session.received, 1000)
+
+    @raises(ConflictException)
+    def test_chunk_gap(self):
+        session = self.uploads.create('volume', len(CONTENT), {'name': 'file.txt'})
+        self.send(session, 1, 1000, 2000)
+
+    @raises(ValueError)
+    def test_chunk_too_big(self):
+        session = self.uploads.create('volume', 10, {'name': 'file.txt'})
+        self.send(session, 0, 0, 11)
+
+    def test_interrupted_chunk(self):
+        session = self.uploads.create('volume', len(CONTENT), {'name': 'file.txt'})
+        self.send(session, 0, 0, 1000)
+        try:
+            # the stream ends before the declared length
+            self.uploads.write_chunk(session.id, 1, 1000, StringIO(CONTENT[1000:1500]), 1000)
+        except IOError:
+            pass
+        else:
+            ok_(False, 'interrupted chunk has been accepted')
+        eq_(session.received, 1000)
+        self.send(session, 1, 1000, len(CONTENT))
+        eq_(session.spool.hexdigest('sha1'), hashlib.sha1(CONTENT).hexdigest())
+
+    def test_killed_chunk(self):
+        class Killed(BaseException):
+            pass
+
+        class Stream(object):
+            def read(self, size):
+                raise Killed()
+        session = self.uploads.create('volume', len(CONTENT), {'name': 'file.txt'})
+        self.send(session, 0, 0, 1000)
+        try:
+            self.uploads.write_chunk(session.id, 1, 1000, Stream(), 1000)
+        except Killed:
+            pass
+        eq_(session.received, 1000)
+        ok_(not session.lock.locked())
+
+    def test_resume_after_restart(self):
+        session = self.uploads.create('volume', len(CONTENT), {'name': 'file.txt'})
+        self.send(session, 0, 0, 1000)
+        session.spool.close()
+        uploads = UploadManager(self.fsdb, expire=60)
+        resumed = uploads.get(session.id)
+        eq_(resumed.volume_id, 'volume')
+        eq_(resumed.metadata, {'name': 'file.txt'})
+        eq_(resumed.received, 1000)
+        uploads.write_chunk(session.id, 1, 1000, StringIO(CONTENT[1000:]), len(CONTENT) - 1000)
+        eq_(resumed.spool.hexdigest('sha1'), hashlib.sha1(CONTENT).hexdigest())
+
+    @raises(NotFoundException)
+    def test_unknown(self):
+        self.uploads.get('0123456789abcdef')
+
+    def test_expire(self):
+        session = self.uploads.create('volume', len(CONTENT), {'name': 'file.txt'})
+        self.send(session, 0, 0, 1000)
+        session.updated = time.time() - 120
+        eq_(self.uploads.expire_sessions(), 1)
+        eq_(os.listdir(self.uploads.path), [])
+        eq_(os.listdir(get_spool_dir(self.fsdb)), [])
+
+    def test_expire_busy_session(self):
+        session = self.uploads.create('volume', len(CONTENT), {'name': 'file.txt'})
+        session.updated = time.time() - 120
+        # a chunk is being written
+        session.lock.acquire()
+        eq_(self.uploads.expire_sessions(), 0)
+        ok_(self.uploads.get(session.id) is session)
+        session.lock.release()
+        eq_(self.uploads.expire_sessions(), 1)
+        ok_(session.removed)
+
+    def test_stale_offset_rejected(self):
+        session = self.uploads.create('volume', len(CONTENT), {'name': 'file.txt'})
+        # another request appended its chunk after this one checked the offset
+        self.send(session, 0, 0, 1000)
+        assert_raises(ConflictException, self.send, session, 1, 500, 1500)
+        eq_(session.received, 1000)
+
+    def test_expire_stored_session(self):
+        session = self.uploads.create('volume', len(CONTENT), {'name': 'file.txt'})
+        session.updated = time.time() - 120
+        self.uploads._save(session)
+        session.spool.close()
+        uploads = UploadManager(self.fsdb, expire=60)
+        eq_(uploads.expire_sessions(), 1)
+        eq_(os.listdir(uploads.path), [])
+        eq_(os.listdir(get_spool_dir(self.fsdb)), [])
+
+
+class TestArchivantUploads(TestArchivant):
+
+    def test_finalize_upload(self):
+        volumeID = self.arc.insert_volume(self.generate_volume_metadata())
+        status = self.arc.create_upload(volumeID, len(CONTENT), {'name': 'file.txt', 'notes': 'big'})
+        self.arc.write_upload_chunk(volumeID, status['id'], 0, 0, StringIO(CONTENT), len(CONTENT))
+        attachmentID = self.arc.finalize_upload(volumeID, status['id'], sha1=hashlib.sha1(CONTENT).hexdigest())
+        attachment = self.arc.get_attachment(volumeID, attachmentID)
+        eq_(attachment['metadata']['sha1'], hashlib.sha1(CONTENT).hexdigest())
+        eq_(attachment['metadata']['size'], len(CONTENT))
+        eq_(attachment['metadata']['notes'], 'big')
+        eq_(self.arc.get_attachment_file(volumeID, attachmentID).read(), CONTENT)
+
+    @raises(ConflictException)
+    def test_finalize_incomplete_upload(self):
+        volumeID = self.arc.insert_volume(self.generate_volume_metadata())
+        status = self.arc.create_upload(volumeID, len(CONTENT), {'name': 'file.txt'})
+        self.arc.finalize_upload(volumeID, status['id'])
+
+    @raises(ConflictException)
+    def test_finalize_while_finalizing(self):
+        volumeID = self.arc.insert_volume(self.generate_volume_metadata())
+        status = self.arc.create_upload(volumeID, len(CONTENT), {'name': 'file.txt'})
+        self.arc.write_upload_chunk(volumeID, status['id'], 0, 0, StringIO(CONTENT), len(CONTENT))
+        self.arc._uploads.get(status['id']).lock.acquire()
+        self.arc.finalize_upload(volumeID, status['id'])
+
+    def test_finalize_upload_not_compressed(self):
+        self.arc._config['COMPRESS_ATTACHMENTS'] = True
+        volumeID = self.arc.insert_volume(self.generate_volume_metadata())
+        status = self.arc.create_upload(volumeID, len(CONTENT), {'name': 'file.txt', 'mime': 'text/plain'})
+        self.arc.write_upload_chunk(volumeID, status['id'], 0, 0, StringIO(CONTENT), len(CONTENT))
+        attachmentID = self.arc.finalize_upload(volumeID, status['id'])
+        ok_('content_encoding' not in self.arc.get_attachment(volumeID, attachmentID)['metadata'])
+
+    @raises(ConflictException)
+    def test_abort_while_receiving(self):
+        volumeID = self.arc.insert_volume(self.generate_volume_metadata())
+        status = self.arc.create_upload(volumeID, len(CONTENT), {'name': 'file.txt'})
+        self.arc._uploads.get(status['id']).lock.acquire()
+        self.arc.abort_upload(volumeID, status['id'])
+
+    @raises(NotFoundException)
+    def test_upload_of_another_volume(self):
+        volumeID = self.arc.insert_volume(self.generate_volume_metadata())
+        status = self.arc.create_upload(volumeID, len(CONTENT), {'name': 'file.txt'})
+        self.arc.get_upload('another', status['id'])
@@ -0,0 +1,267 @@
+'''Resumable uploads of big attachment files
+
+An upload session receives the content of a file in chunks, that can be
+sent over many requests: when a transfer is interrupted the client asks for
+the session status and resumes from the first byte not received.
+
+Chunks must be sent in order: each one is appended to a
+:py:class:`~archivant.ingest.SpoolFile` and hashed while it is received,
+so that once the upload is complete the file can be moved into fsdb
+without being read again.
+A chunk that is interrupted is rolled back, and chunks already received
+can be sent again.
+
+Sessions are saved in the fsdb root, so they survive restarts
+(in that case the received content is hashed again once), and
+sessions that have not been updated for `expire` seconds are removed.
+'''
+import os
+import json
+import time
+import errno
+from threading import Lock
+from uuid import uuid4
+
+from ingest import SpoolFile, makedirs, BLOCK_SIZE
+from exceptions import NotFoundException, ConflictException
+
+from logging import getLogger
+log = getLogger('archivant')
+
+
+UPLOADS_DIR = '.uploads'
+
+
+class UploadSession(object):
+    '''State of a resumable upload
+
+       :param volume_id: id of the volume the file will be attached to
+       :param size: total size of the file
+       :param metadata: attachment metadata (name, mime, notes)
+    '''
+
+    def __init__(self, id, volume_id, size, metadata, spool, created=None, updated=None, chunks=None):
+        self.id = id
+        self.volume_id = volume_id
+        self.size = size
+        self.metadata = metadata
+        self.spool = spool
+        self.created = created or time.time()
+        self.updated = updated or self.created
+        # chunk number -> [offset, length]
+        self.chunks = chunks or {}
+        # held while a chunk is written and while the session is finalized or removed
+        self.lock = Lock()
+        self.removed = False
+
+    @property
+    def received(self):
+        return self.spool.size
+
+    @property
+    def complete(self):
+        return self.received == self.size
+
+    def status(self, expire):
+        return {'id': self.id,
+                'volume_id': self.volume_id,
+                'size': self.size,
+                'received': self.received,
+                'chunks': sorted(int(n) for n in self.chunks),
+                'metadata': self.metadata,
+                'expires': self.updated + expire}
+
+    def to_json(self):
+        return json.dumps({'volume_id': self.volume_id,
+                           'size': self.size,
+                           'metadata': self.metadata,
+                           'path': self.spool.path,
+                           'received': self.received,
+                           'created': self.created,
+                           'updated': self.updated,
+                           'chunks': self.chunks})
+
+
+class UploadManager(object):
+    '''Upload sessions of an fsdb
+
+       :param expire: seconds after which inactive sessions are removed
+    '''
+
+    def __init__(self, fsdb, expire=24 * 3600):
+        self._fsdb = fsdb
+        self.expire = expire
+        self.path = os.path.join(fsdb.fsdbRoot, UPLOADS_DIR)
+        self._sessions = dict()
+
+    def _session_path(self, uploadID):
+        return os.path.join(self.path, uploadID + '.json')
+
+    def _save(self, session):
+        makedirs(self._fsdb, self.path)
+        path = self._session_path(session.id)
+        with open(path + '.tmp', 'w') as f:
+            f.write(session.to_json())
+        os.rename(path + '.tmp', path)
+
+    def _load(self, uploadID):
+        try:
+            with open(self._session_path(uploadID)) as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            return None
+        try:
+            spool = SpoolFile.reopen(self._fsdb, state['path'], state['received'])
+        except IOError:
+            log.warning("content of upload '{}' has been lost".format(uploadID))
+            self._remove(uploadID)
+            return None
+        if spool.size != state['received']:
+            spool.close()
+            log.warning("content of upload '{}' is incomplete".format(uploadID))
+            self._remove(uploadID, spool)
+            return None
+        log.debug("resumed upload '{}' from disk".format(uploadID))
+        return UploadSession(uploadID, state['volume_id'], state['size'], state['metadata'], spool,
+                             created=state['created'], updated=state['updated'], chunks=state['chunks'])
+
+    def _remove(self, uploadID, spool=None):
+        self._sessions.pop(uploadID, None)
+        if spool is not None and not spool.committed:
+            spool.discard()
+        try:
+            os.remove(self._session_path(uploadID))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def create(self, volumeID, size, metadata):
+        '''start a new upload session and return it'''
+        if size < 0:
+            raise ValueError("'size' must not be negative")
+        self.expire_sessions()
+        session = UploadSession(uuid4().hex, volumeID, size, metadata, SpoolFile(self._fsdb))
+        self._save(session)
+        self._sessions[session.id] = session
+        log.debug("created upload '{}' of {} bytes for volume '{}'".format(session.id, size, volumeID))
+        return session
+
+    def get(self, uploadID):
+        '''return an active session, raising NotFoundException if it does not exist or has expired'''
+        session = self._sessions.get(uploadID)
+        if session is None and uploadID.isalnum():
+            session = self._load(uploadID)
+            if session is not None:
+                self._sessions[uploadID] = session
+        if session is None:
+            raise NotFoundException("could not found upload '{}'".format(uploadID))
+        # a session being written is not abandoned
+        if session.updated + self.expire < time.time() and self.remove(session):
+            raise NotFoundException("upload '{}' has expired".format(uploadID))
+        return session
+
+    def write_chunk(self, uploadID, number, offset, stream, length):
+        '''append `length` bytes read from `stream` to the content of the upload
+
+           `offset` is the position of the chunk in the file: it must be
+           the number of bytes received so far, a chunk already received is ignored.
+           Raises ConflictException if the chunk does not fit the received content,
+           or if another chunk of the same upload is being written.
+        '''
+        session = self.get(uploadID)
+        if length < 0 or offset < 0 or offset + length > session.size:
+            raise ValueError('chunk exceeds the size of the file')
+        # do not wait: the holder could be waiting for its request body
+        if not session.lock.acquire(False):
+            raise ConflictException('another chunk of this upload is being received')
+        try:
+            # checked while holding the lock, as another chunk may have just been written
+            if session.removed:
+                raise NotFoundException("could not found upload '{}'".format(uploadID))
+            if offset + length <= session.received:
+                log.debug("chunk {} of upload '{}' already received".format(number, uploadID))
+                return session
+            if offset != session.received:
+                raise ConflictException('chunk starts at byte {} but {} bytes have been received'.format(offset, session.received))
+            checkpoint = session.spool.checkpoint()
+            written = False
+            try:
+                remaining = length
+                while remaining > 0:
+                    data = stream.read(min(BLOCK_SIZE, remaining))
+                    if not data:
+                        raise IOError('chunk interrupted after {} bytes'.format(length - remaining))
+                    session.spool.write(data)
+                    remaining -= len(data)
+                session.spool.flush()
+                written = True
+            finally:
+                # also when the request is killed
+                if not written:
+                    session.spool.rollback(checkpoint)
+            session.chunks[str(number)] = [offset, length]
+            session.updated = time.time()
+            self._save(session)
+        finally:
+            session.lock.release()
+        return session
+
+    def remove(self, session):
+        '''forget a session, discarding its content if it has not been stored
+
+           Returns False, leaving the session alone, if a chunk is being written
+           or the session is being finalized.
+        '''
+        # do not wait, see write_chunk
+        if not session.lock.acquire(False):
+            return False
+        try:
+            self.discard(session)
+        finally:
+            session.lock.release()
+        return True
+
+    def discard(self, session):
+        '''like :py:meth:`remove`, for callers already holding the session lock'''
+        session.removed = True
+        session.spool.close()
+        self._remove(session.id, session.spool)
+        log.debug("removed upload '{}'".format(session.id))
+
+    def expire_sessions(self):
+        '''remove the sessions that have not been updated for `expire` seconds
+
+           Returns the number of removed sessions.
+        '''
+        if not os.path.isdir(self.path):
+            return 0
+        count = 0
+        limit = time.time() - self.expire
+        for name in os.listdir(self.path):
+            if not name.endswith('.json'):
+                continue
+            uploadID = name[:-len('.json')]
+            session = self._sessions.get(uploadID)
+            if session is not None:
+                expired = session.updated < limit
+            else:
+                try:
+                    with open(os.path.join(self.path, name)) as f:
+                        state = json.load(f)
+                except (IOError, ValueError):
+                    continue
+                expired = state['updated'] < limit
+                if expired:
+                    try:
+                        os.remove(state['path'])
+                    except OSError:
+                        pass
+            if expired:
+                if session is not None:
+                    if not self.remove(session):
+                        continue
+                else:
+                    self._remove(uploadID)
+                log.info("upload '{}' expired".format(uploadID))
+                count += 1
+        return count
@@ -2,11 +2,12 @@ import click
 import logging
 import json
 import os
+import time
 import mimetypes
 
 from . import load_cfg, die, bye
 from archivant import Archivant
-from archivant.exceptions import NotFoundException, ConflictException
+from archivant.exceptions import NotFoundException, ConflictException, FileOpNotSupported
 from conf.defaults import get_def_conf, get_help
 from utils.loggers import initLoggers
 from custom_types import StringList
@@ -85,6 +86,45 @@ def upgrade(check_only, yes):
             else:
                 exit(0)
 
+        # Move download counters out of volumes into their own index
+        num_to_update = migration.elements_with_download_count(db.es, db.index_name)
+        if num_to_update > 0:
+            if check_only:
+                exit(123)
+
+            if yes or click.confirm("{} entries store download counters in the old format. Do you want to proceed and move them?".format(num_to_update),
+                             prompt_suffix='',
+                             default=False):
+                migration.migrate_download_counts(db)
+            else:
+                exit(0)
+
+        # Track which volumes reference each stored file
+        if not db.blob_refs_tracked():
+            if check_only:
+                exit(123)
+
+            num_to_update = migration.blob_refs_missing(db)
+            if yes or num_to_update == 0 or click.confirm("References to stored files of {} entries are not tracked. Do you want to proceed and index them?".format(num_to_update),
+                             prompt_suffix='',
+                             default=False):
+                migration.build_blob_refs(db)
+            else:
+                exit(0)
+
+        # Stop storing full text fields in the `_source` of books
+        num_to_update = migration.elements_storing_text(db)
+        if num_to_update > 0:
+            if check_only:
+                exit(123)
+
+            if yes or click.confirm("{} entries store their full text fields, or lack their term vectors. Do you want to proceed and reindex them?".format(num_to_update),
+                             prompt_suffix='',
+                             default=False):
+                migration.migrate_stored_text(db)
+            else:
+                exit(0)
+
         # Upgrade the index mappings and reindex if necessary
         try:
             db.update_mappings()
@@ -106,6 +146,81 @@ def upgrade(check_only, yes):
             die(str(e))
 
 
+@libreant_db.command(name="fsck")
+@click.option('-j', '--processes', type=click.INT, metavar='<n>', help='number of worker processes [default: number of cpus]')
+@click.option('--max-age', type=click.FLOAT, metavar='<days>', help='verify again files verified more than <days> ago')
+@click.option('--full', is_flag=True, help='ignore previous verifications and check every file')
+def fsck(processes, max_age, full):
+    '''
+    Verify the integrity of stored files.
+
+    Files are rehashed in parallel and every verification is recorded,
+    so that an interrupted check can be resumed by running it again
+    and later checks only verify files that changed since the previous one.
+    Digests of corrupted files are printed on standard output,
+    the command exits with code 1 if any is found.
+    '''
+    checker = arc.fsck(processes=processes,
+                       max_age=max_age * 24 * 3600 if max_age is not None else None,
+                       full=full)
+    stats = checker.stats
+    lastReport = time.time()
+    for digest, ok in checker.run():
+        if not ok:
+            click.echo(digest)
+        if time.time() - lastReport >= 5:
+            lastReport = time.time()
+            click.echo("verified {} files, {:.1f} MB/s".format(stats['verified'], checker.throughput / 2**20), err=True)
+    click.echo("{} files, {} verified, {} skipped, {} corrupted: {:.1f} MB in {:.1f}s ({:.1f} MB/s)".format(
+               stats['files'], stats['verified'], stats['skipped'], stats['corrupted'],
+               stats['bytes'] / float(2**20), stats['elapsed'], checker.throughput / 2**20), err=True)
+    if stats['corrupted']:
+        die("{} corrupted files found".format(stats['corrupted']))
+
+
+@libreant_db.command(name="gc")
+@click.option('--grace-period', type=click.INT, metavar='<seconds>', help='remove files unreferenced since at least <seconds> [default: GC_GRACE_PERIOD]')
+def gc(grace_period):
+    '''
+    Remove stored files no more attached to any volume.
+
+    Only files whose references are tracked are considered,
+    use "libreant-db upgrade" to track the ones of older volumes.
+    '''
+    removed = arc.collect_garbage(grace_period=grace_period)
+    click.echo("{} files removed".format(removed))
+
+
+@libreant_db.command(name="rebalance")
+@click.option('--dry-run', is_flag=True, help='only show how many files would be moved')
+def rebalance(dry_run):
+    '''
+    Move stored files to their preferred path.
+
+    To be run after a new path has been added to FSDB_PATH
+    or after weights have been changed.
+    '''
+    moved, movedBytes = arc.rebalance_local_fsdb(dryrun=dry_run)
+    click.echo("{} files moved ({} bytes)".format(moved, movedBytes))
+
+
+@libreant_db.command(name="move-to-object-store")
+@click.argument('volumeid')
+def move_to_object_store(volumeid):
+    '''
+    Upload the files of a volume to OBJECT_STORE.
+
+    Local copies are removed once no other volume references them.
+    '''
+    try:
+        volume = arc.get_volume(volumeid)
+        for attachment in volume['attachments']:
+            url = arc.move_to_object_store(volumeid, attachment['id'])
+            click.echo("{}: {}".format(attachment['id'], url))
+    except (NotFoundException, FileOpNotSupported) as e:
+        die(str(e))
+
+
 @libreant_db.command(name="export-volume", help="export a volume")
 @click.argument('volumeid')
 @click.option('-p', '--pretty', is_flag=True, help='format the output on multiple lines')
@@ -166,8 +281,9 @@ def delete_volume(volumeid):
 @click.argument('query')
 @click.option('-p', '--pretty', is_flag=True, help='format the output on multiple lines')
 def search(query, pretty):
-    results = arc._db.user_search(query)['hits']['hits']
+    results = arc._db.user_search(query, excludes=arc._db.text_fields)['hits']['hits']
     results = map(arc.normalize_volume, results)
+    arc.merge_download_counts(results)
     if not results:
         bye("No results found for '{}'".format(query), exit_code=4)
     indent = 3 if pretty else None
@@ -193,6 +309,7 @@ def append_file(volumeid, filepath, notes):
         arc.insert_attachments(volumeid, attachments)
     except Exception:
         die('An upload error occurred in updating an attachment!', exit_code=4)
+    report_dedup()
 
 
 @libreant_db.command(name='insert-volume')
@@ -240,9 +357,22 @@ def insert_volume(language, filepath, notes, metadata):
         out = arc.insert_volume(meta, attachments)
     except Exception:
         die('An upload error have occurred!', exit_code=4)
+    report_dedup()
     click.echo(out)
 
 
+def report_dedup():
+    '''tell how many of the inserted files were already stored'''
+    saved = arc.dedup_stats
+    if not saved['files']:
+        return
+    if arc._config['PREHASH_LOCAL_FILES']:
+        msg = "{} files were already stored, {} bytes have not been copied"
+    else:
+        msg = "{} files were already stored, {} bytes have been copied and then discarded"
+    click.echo(msg.format(saved['files'], saved['bytes']), err=True)
+
+
 def attach_list(filepaths, notes):
     '''
     all the arguments are lists
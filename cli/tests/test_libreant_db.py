@@ -8,6 +8,7 @@ from nose.tools import eq_, raises
 import click
 import click.testing
 from utils.es import Elasticsearch
+from fsdb import Fsdb
 
 from cli.libreant_db import attach_list, libreant_db
 
@@ -146,3 +147,15 @@ class TestInsert(TestDedicatedEs):
         volume_data = json.loads(export_res.output)
         eq_(len(volume_data['attachments']), 1)
         eq_(volume_data['attachments'][0]['metadata']['name'], 'empty')
+
+    def test_attach_already_stored(self):
+        path = self.generate('book.txt', {'content': 'stored once'})
+        res = self.cli.invoke(libreant_db, ('insert-volume', '-l', 'en', '-f', path, '--notes', 'first'))
+        eq_(res.exit_code, 0)
+        vid = [line for line in res.output.split('\n')
+               if line.strip()][-1].strip()
+        attach_res = self.cli.invoke(libreant_db, ('attach', '-f', path, '--notes', 'again', vid))
+        eq_(attach_res.exit_code, 0)
+        assert '1 files were already stored, {} bytes have not been copied'.format(os.path.getsize(path)) \
+            in attach_res.output
+        eq_(len(Fsdb(self.fsdbPath)), 1)
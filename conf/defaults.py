@@ -4,7 +4,7 @@ defConf = {
   'DEBUG':        (False, "operate in debug mode"),
   'PORT':         (5000, "port on which daemon will listen"),
   'ADDRESS':      ("0.0.0.0", "address on which daemon will listen"),
-  'FSDB_PATH':    (None, "path used for storing binary files"),
+  'FSDB_PATH':    (None, "path used for storing binary files, or list of paths (optionally [path, weight] pairs) to spread them over"),
   'ES_INDEXNAME': ('libreant', "index name to use for elasticsearch"),
   'ES_HOSTS':     (None, "list of elasticsearch nodes to connect to"),
   'PRESET_PATHS': ([], "list of paths where to look for presets definition"),
@@ -12,9 +12,31 @@ defConf = {
   'BOOTSTRAP_SERVE_LOCAL': (True, "decide to serve bootstrap related files as local content"),
   'RESULTS_PER_PAGE': (30, "number of results displayed per page"),
   'MAX_RESULTS_PER_PAGE': (100, "maximum number of results that can be delivered to one request"),
+  'SEARCH_CURSOR_THRESHOLD': (1000, "number of search results after which pages are only reached through cursors, following the next page links"),
   'USERS_DATABASE': (None, "url of the database used for users managment"),
   'PWD_SALT_SIZE': (16, "size of the salt used by password hashing algorithm"),
-  'PWD_ROUNDS': (pbkdf2_sha256.default_rounds, "number of rounds runs by password hashing algorithm")
+  'PWD_ROUNDS': (pbkdf2_sha256.default_rounds, "number of rounds runs by password hashing algorithm"),
+  'DOWNLOAD_OFFLOAD': (None, "let the front-end web server send attachment files, one of: 'x-sendfile', 'x-accel-redirect'"),
+  'DOWNLOAD_OFFLOAD_PREFIX': ('/fsdb', "internal location mapped onto FSDB_PATH, used by 'x-accel-redirect' offload mode"),
+  'DOWNLOAD_COUNT_FLUSH_INTERVAL': (5, "seconds between writes of the buffered download counters to the database"),
+  'DOWNLOAD_COUNT_JOURNAL': (None, "file where buffered download counters are saved in order to survive restarts"),
+  'GC_GRACE_PERIOD': (3600, "seconds after which files no more attached to any volume are removed, null disables automatic removal"),
+  'OBJECT_STORE': (None, "S3 compatible object store holding attachment files, a dict with keys: endpoint, bucket, access_key, secret_key, region"),
+  'OBJECT_CACHE_PATH': (None, "directory where files downloaded from OBJECT_STORE are cached"),
+  'OBJECT_CACHE_SIZE': (10 * 2**30, "maximum size in bytes of the OBJECT_CACHE_PATH content"),
+  'COMPRESS_ATTACHMENTS': (False, "store compressed the files whose mime type is compressible, e.g. text, html, xml, pdf, except the ones uploaded in chunks"),
+  'PREHASH_LOCAL_FILES': (True, "hash files inserted from local paths before copying them, so that the ones already stored are not written again, at the cost of reading new ones twice"),
+  'INGEST_CONCURRENCY': (4, "number of files of a volume that are hashed and stored at the same time"),
+  'UPLOAD_EXPIRE': (24 * 3600, "seconds after which an unfinished chunked upload is removed if no chunk is received"),
+  'QUERY_CACHE_SIZE': (0, "bytes of memory used to cache search results, 0 disables the cache"),
+  'QUERY_CACHE_TTL': (60, "seconds after which a cached search result is no more used"),
+  'SIMILAR_CACHE_SIZE': (1000, "number of volumes whose similar volumes are cached, 0 disables the cache"),
+  'SIMILAR_CACHE_TTL': (3600, "seconds after which the cached similar volumes of a volume are refreshed"),
+  'EVENT_LOOP_BLOCK_THRESHOLD': (0.5, "seconds after which the web server logs that its event loop has been blocked, null disables monitoring"),
+  'STATS_LOG_INTERVAL': (3600, "seconds between logs of the event loop, executor and caches statistics, null disables them"),
+  'MEMORY_CACHE_SIZE': (0, "bytes of memory used to cache frequently downloaded small files, 0 disables the cache"),
+  'MEMORY_CACHE_MAX_FILE_SIZE': (2 * 2**20, "size in bytes of the biggest file kept in the memory cache"),
+  'MEMORY_CACHE_MIN_HITS': (2, "downloads of a file needed before it is kept in the memory cache")
 }
 
 
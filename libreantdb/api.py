@@ -1,9 +1,9 @@
 import time
 import re
 
-from elasticsearch import NotFoundError, RequestError, TransportError
+from elasticsearch import NotFoundError, RequestError, TransportError, ConflictError
 from elasticsearch import __version__ as es_version
-from elasticsearch.helpers import scan, bulk, reindex
+from elasticsearch.helpers import scan, bulk
 
 from exceptions import MappingsException
 
@@ -15,6 +15,19 @@ TEXT = 'text' if es_version[0] >= 5 else 'string'
 
 FALSE = 'false' if es_version[0] >= 5 else 'no'
 
+# https://www.elastic.co/guide/en/elasticsearch/reference/6.0/breaking_60_scripting_changes.html
+SCRIPT_SOURCE = 'source' if es_version[0] >= 6 else 'inline'
+
+RETRY_ON_CONFLICT = 'retry_on_conflict' if es_version[0] >= 6 else '_retry_on_conflict'
+
+KEYWORD = {'type': 'keyword'} if es_version[0] >= 5 else {'type': 'string', 'index': 'not_analyzed'}
+
+# https://www.elastic.co/guide/en/elasticsearch/reference/5.0/search-request-search-after.html
+SEARCH_AFTER = es_version[0] >= 5
+
+# unique field used to break ties between hits with the same score
+TIEBREAKER = '_id' if es_version[0] >= 6 else '_uid'
+
 
 def current_time_millisec():
     return int(round(time.time() * 10**3))
@@ -37,6 +50,11 @@ def validate_book(body):
         if k.startswith('_text'):
             del(body[k])
 
+    # download counters are kept in a dedicated index
+    for attachment in body.get('_attachments', []):
+        if isinstance(attachment, dict):
+            attachment.pop('download_count', None)
+
     allfields = collectStrings(body)
     body['_text_%s' % body['_language']] = ' '.join(allfields)
     return body
@@ -74,7 +92,6 @@ class DB(object):
           "_version" : 1,
           "found" : true,
           "_source": {"_language": "en",
-                      "_text_en": "marco belletti pdf file latex manual",
                       "author": "marco belletti",
                       "type": "pdf file",
                       "title": "latex manual",
@@ -83,13 +100,32 @@ class DB(object):
                                         "url": "fsdb:///dc8dc34b3e0fec2377e5cf9ea7e4780d87ff18c5",
                                         "notes": "A n example bookLatex wikibook",
                                         "mime": "application/pdf",
-                                        "download_count": 7,
                                         "id": "17fd3d898a834e2689340cc8aacdebb4",
                                         "size": 23909451}]
                      }
         }
+
+    The `_text_<language>` field holds all the metadata strings of the book,
+    it is built by :py:func:`validate_book` whenever a book is written and it is
+    indexed, but the index mapping excludes it from the stored `_source`
+    (see :py:attr:`source_mapping`): books read back from the index do not have it.
+    Query methods accept `includes` and `excludes` lists of fields
+    (wildcards allowed) to filter the returned `_source`.
+
+    Download counters of the attachments are not stored in the book document,
+    they live in a dedicated index (:py:attr:`DB.counters_index_name`) where each
+    document is identified by the attachment id::
+
+        {"book": "AU4RleAfD1zQdqx6OQ8Y", "download_count": 7}
     '''
 
+    # fields built by validate_book for full text search
+    text_fields = ['_text_*']
+
+    # full text fields are indexed but not stored,
+    # their term vectors are kept for "more like this" queries
+    source_mapping = {'excludes': text_fields}
+
     properties = {
         "_insertion_date": {
             "type": "long",
@@ -99,10 +135,12 @@ class DB(object):
             "index": FALSE},
         "_text_en": {
             "type": TEXT,
-            "analyzer": "english"},
+            "analyzer": "english",
+            "term_vector": "yes"},
         "_text_it": {
             "type": TEXT,
-            "analyzer": "it_analyzer"},
+            "analyzer": "it_analyzer",
+            "term_vector": "yes"},
     }
 
     # Just like the default one
@@ -138,10 +176,27 @@ class DB(object):
         }
     }}
 
+    counters_mappings = {'counter': {'properties': {
+        'book': KEYWORD,
+        'download_count': {'type': 'long'}}}}
+
+    refs_mappings = {'blob': {'properties': {
+        'refs': KEYWORD,
+        'released': {'type': 'date'}}}}
+
+    # document of the references index telling that the blobs of all volumes are tracked
+    refs_tracked_id = 'all-volumes-tracked'
+
     # Setup {{{2
-    def __init__(self, es, index_name):
+    def __init__(self, es, index_name, query_cache=None, similar_cache=None):
         self.es = es
         self.index_name = index_name
+        # optional :py:class:`libreantdb.querycache.QueryCache` of search results
+        self.query_cache = query_cache
+        # optional :py:class:`libreantdb.querycache.SimilarCache` used by similar_books
+        self.similar_cache = similar_cache
+        self.counters_index_name = index_name + '-counters'
+        self.refs_index_name = index_name + '-refs'
         # book_validator can adjust the book, and raise if it's not valid
         self.book_validator = validate_book
 
@@ -159,19 +214,65 @@ class DB(object):
                 log.error(ex)
                 log.warn('An old or wrong properties mapping has been found for index: "{0}",\
                           this could led to some errors. It is recomanded to run "libreant-db upgrade"'.format(self.index_name))
+            if self.missing_term_vectors():
+                log.warn('Index "{0}" does not keep term vectors of full text fields, similar volumes '
+                         'will not be found until "libreant-db upgrade" is run'.format(self.index_name))
         else:
             log.debug("Index is missing: '{0}'".format(self.index_name))
             self.create_index()
 
+        self.setup_counters_index()
+        self.setup_refs_index()
+
         if wait_for_ready:
             log.debug('waiting for index "{}" to be ready'.format(self.index_name))
             self.es.cluster.health(index=self.index_name, level='index', wait_for_status='yellow')
             log.debug('index "{}" is now ready'.format(self.index_name))
 
+    def setup_counters_index(self):
+        '''create the index used to store download counters, if missing'''
+        if not self.es.indices.exists(self.counters_index_name):
+            log.debug("Creating download counters index: '{0}'".format(self.counters_index_name))
+            self.es.indices.create(index=self.counters_index_name,
+                                   body={'mappings': self.counters_mappings})
+
+    def setup_refs_index(self):
+        '''create the index used to store blob references, if missing
+
+           If there are no books yet, all of them will be tracked.
+        '''
+        if not self.es.indices.exists(self.refs_index_name):
+            log.debug("Creating blob references index: '{0}'".format(self.refs_index_name))
+            self.es.indices.create(index=self.refs_index_name,
+                                   body={'mappings': self.refs_mappings})
+            if not self.es.indices.exists(self.index_name) or self.es.count(index=self.index_name)['count'] == 0:
+                self.set_blob_refs_tracked()
+
+    def get_properties(self):
+        '''return the properties mapping of the book type in the current index'''
+        mappings = self.es.indices.get_mapping(index=self.index_name, doc_type='book')
+        for index in mappings.values():
+            return index['mappings'].get('book', {}).get('properties', {})
+        return {}
+
+    def missing_term_vectors(self):
+        '''return the full text fields whose term vectors are not kept by the current index
+
+           Term vectors can only be set when an index is created,
+           see :py:func:`libreantdb.migration.migrate_stored_text`.
+        '''
+        current = self.get_properties()
+        return sorted(k for k, m in self.properties.iteritems()
+                      if 'term_vector' in m and k in current and 'term_vector' not in current[k])
+
     def update_mappings(self):
         log.debug('updating index properties mappings')
+        missing = self.missing_term_vectors()
         errors = {}
         for prop_k, prop_m in self.properties.iteritems():
+            if prop_k in missing:
+                # elasticsearch refuses to add them to an existing field
+                prop_m = dict((k, v) for k, v in prop_m.iteritems() if k != 'term_vector')
             try:
                 self.es.indices.put_mapping(index=self.index_name, doc_type='book', body={'properties': { prop_k: prop_m}})
             except RequestError as re:
@@ -199,7 +300,8 @@ class DB(object):
         log.debug("Creating new index: '{0}'".format(indexname))
         if index_conf is None:
             index_conf = {'settings': self.settings,
-                          'mappings': {'book': {'properties': self.properties}}}
+                          'mappings': {'book': {'_source': self.source_mapping,
+                                                'properties': self.properties}}}
         try:
             self.es.indices.create(index=indexname, body=index_conf)
         except TransportError as te:
@@ -212,14 +314,23 @@ class DB(object):
         '''Clone current index
 
            All entries of the current index will be copied into the newly
-           created one named `new_indexname`
+           created one named `new_indexname`.
+           Entries are validated again, since their full text fields are not stored.
 
            :param index_conf: Configuration to be used in the new index creation.
                               This param will be passed directly to :py:func:`DB.create_index`
         '''
         log.debug("Cloning index '{}' into '{}'".format(self.index_name, new_indexname))
         self.create_index(indexname=new_indexname, index_conf=index_conf)
-        reindex(self.es, self.index_name, new_indexname)
+
+        def index_action_gen():
+            for v in scan(self.es, index=self.index_name):
+                yield {'_op_type': 'index',
+                       '_index': new_indexname,
+                       '_type': v['_type'],
+                       '_id': v['_id'],
+                       '_source': self.book_validator(v['_source'])}
+        bulk(self.es, index_action_gen())
 
     def reindex(self, new_index=None, index_conf=None):
         '''Rebuilt the current index
@@ -282,18 +393,51 @@ class DB(object):
     def __len__(self):
         return self.es.count(index=self.index_name)['count']
 
-    def _search(self, body, **kargs):
-        return self.es.search(index=self.index_name,
-                              body=body,
-                              doc_type='book',
-                              **kargs)
+    @staticmethod
+    def _source_filter(kargs, includes, excludes):
+        '''add the `_source` filtering parameters to the kargs of a request'''
+        if includes is not None:
+            kargs['_source_include'] = includes
+        if excludes is not None:
+            kargs['_source_exclude'] = excludes
+        return kargs
+
+    def _search(self, body, includes=None, excludes=None, **kargs):
+        self._source_filter(kargs, includes, excludes)
+        cache = self.query_cache
+        if cache is None:
+            return self.es.search(index=self.index_name,
+                                  body=body,
+                                  doc_type='book',
+                                  **kargs)
+        key = cache.make_key(self.index_name, body, **kargs)
+        res = cache.get(key)
+        if res is None:
+            generation = cache.generation
+            res = self.es.search(index=self.index_name,
+                                 body=body,
+                                 doc_type='book',
+                                 **kargs)
+            cache.put(key, res, generation)
+        return res
+
+    def _books_changed(self, id=None, all=False):
+        '''invalidate cached results after a change to the book `id`, or to `all` of them
+
+           Cached similar books are not invalidated when a book is added,
+           they expire instead.
+        '''
+        if self.query_cache is not None:
+            self.query_cache.invalidate()
+        if self.similar_cache is not None and (id is not None or all):
+            self.similar_cache.invalidate(None if all else id)
 
     def _get_search_field(self, field, value):
         return {'query':
                 {'match': {field: value}}
                 }
 
-    def mlt(self, _id):
+    def mlt(self, _id, **kargs):
         '''
         High-level method to do "more like this".
 
@@ -310,44 +454,116 @@ class DB(object):
             mlt = query['query']['more_like_this']
             mlt['ids'] = [_id]
             del mlt['like']
-        return self._search(query)
+        return self._search(query, **kargs)
 
-    def get_all_books(self, size=30):
-        return self._search({}, size=size)
+    def similar_books(self, _id, size=10, includes=None, spawn=None):
+        '''return the hits of the `size` books most similar to `_id`
+
+           Hits are cached per book if :py:attr:`similar_cache` is set.
+           Once expired they are still returned, while they are refreshed
+           calling `spawn(func)`, which should run `func` in the background;
+           without `spawn` they are refreshed before returning.
+        '''
+        cache = self.similar_cache
+        if cache is None:
+            return self.mlt(_id, size=size, includes=includes)['hits']['hits']
+        key = (_id, size, tuple(includes or ()))
+
+        def refresh():
+            generation = cache.generation
+            hits = self.mlt(_id, size=size, includes=includes)['hits']['hits']
+            cache.put(key, hits, generation)
+            return hits
+
+        def refresh_safely():
+            try:
+                refresh()
+            except Exception:
+                log.exception("Cannot refresh the books similar to '{}'".format(_id))
+
+        cached = cache.get(key)
+        if cached is None:
+            return refresh()
+        hits, stale = cached
+        if stale:
+            if spawn is None:
+                return refresh()
+            spawn(refresh_safely)
+        return hits
+
+    def get_all_books(self, size=30, **kargs):
+        return self._search({}, size=size, **kargs)
 
     def iterate_all(self):
         return scan(self.es, index=self.index_name)
 
-    def get_last_inserted(self, size=30):
+    def iter_attachment_urls(self):
+        '''iterate over the urls of the attachments of all books
+
+           A single scroll is used and only the urls are fetched.
+        '''
+        for v in scan(self.es, index=self.index_name, _source_include=['_attachments.url']):
+            for attachment in v.get('_source', {}).get('_attachments', []):
+                if 'url' in attachment:
+                    yield attachment['url']
+
+    def get_last_inserted(self, size=30, **kargs):
         query = {"query": {"match_all": {}},
                  "sort": [{"_insertion_date": {"order":"desc",
                                                 "missing": "_last"}}]}
-        return self._search(body=query, size=size)
+        return self._search(body=query, size=size, **kargs)
 
-    def get_books_simplequery(self, query):
+    def get_books_simplequery(self, query, **kargs):
         return self._search({'query': {'multi_match':
                                        {'query': query, 'fields': '_text_*'}
-                                       }})
+                                       }}, **kargs)
 
-    def get_books_by_title(self, title):
-        return self._search(self._get_search_field('title', title))
+    def get_books_by_title(self, title, **kargs):
+        return self._search(self._get_search_field('title', title), **kargs)
 
-    def get_books_by_actor(self, authorname):
-        return self._search(self._get_search_field('actors', authorname))
+    def get_books_by_actor(self, authorname, **kargs):
+        return self._search(self._get_search_field('actors', authorname), **kargs)
 
-    def get_book_by_id(self, id):
-        return self.es.get(index=self.index_name, id=id, doc_type='book')
+    def get_book_by_id(self, id, includes=None, excludes=None):
+        return self.es.get(index=self.index_name, id=id, doc_type='book',
+                           **self._source_filter({}, includes, excludes))
 
-    def get_books_querystring(self, query, **kargs):
-        q = {'query': query, 'fields': ['_text_*']}
-        return self._search({'query': dict(query_string=q)}, **kargs)
+    def get_book_attachments(self, id):
+        '''return the attachments of a book
+
+           Only the `_attachments` field is requested to elasticsearch
+        '''
+        return self.es.get(index=self.index_name, id=id, doc_type='book',
+                           _source_include='_attachments')['_source']['_attachments']
 
-    def user_search(self, query):
+    def get_books_querystring(self, query, search_after=None, **kargs):
+        '''
+        Search books with a query string, sorted by relevance
+
+        Hits with the same score are sorted by id, so that the order is stable
+        and the `sort` values of the last hit of a page can be given
+        as `search_after` to fetch the following page.
+        Unlike `from_`, that makes every shard collect and sort all the
+        previous hits, `search_after` keeps deep pages as cheap as the first one;
+        it is only supported with elasticsearch >= 5 (see :py:data:`SEARCH_AFTER`).
+        '''
+        q = {'query': query, 'fields': ['_text_*']}
+        body = {'query': dict(query_string=q)}
+        if SEARCH_AFTER:
+            body['sort'] = ['_score', {TIEBREAKER: 'asc'}]
+            body['track_scores'] = True
+        if search_after is not None:
+            if not SEARCH_AFTER:
+                raise NotImplementedError('search_after requires elasticsearch >= 5')
+            body['search_after'] = search_after
+        return self._search(body, **kargs)
+
+    def user_search(self, query, **kargs):
         '''
         This acts like a "wrapper" that always point to the recommended
         function for user searching.
         '''
-        return self.get_books_querystring(query)
+        return self.get_books_querystring(query, **kargs)
 
     def file_is_attached(self, url):
         '''return true if at least one book has
@@ -356,39 +572,77 @@ class DB(object):
         body = self._get_search_field('_attachments.url', url)
         return self.es.count(index=self.index_name, body=body)['count'] > 0
 
+    def get_attachment_by_sha1(self, sha1):
+        '''return an attachment with the given sha1, None if there is not any'''
+        body = self._get_search_field('_attachments.sha1', sha1)
+        res = self.es.search(index=self.index_name, body=body, size=1, _source_include=['_attachments'])
+        for hit in res['hits']['hits']:
+            for attachment in hit['_source']['_attachments']:
+                if attachment.get('sha1') == sha1:
+                    return attachment
+        return None
+
+    def get_download_counts(self, attachmentIDs):
+        '''return a dict containing the download count of each given attachment'''
+        if not attachmentIDs:
+            return {}
+        res = self.es.mget(index=self.counters_index_name, doc_type='counter',
+                           body={'ids': list(attachmentIDs)})
+        return {d['_id']: d['_source']['download_count'] for d in res['docs'] if d.get('found')}
+
     def autocomplete(self, fieldname, start):
         raise NotImplementedError()
     # End queries }}}
 
     # Operations {{{2
-    def add_book(self, body, doc_type='book'):
+    def add_book(self, body, doc_type='book', id=None):
         '''
         Call it like this:
             db.add_book(doc_type='book',
             body={'title': 'foobar', '_language': 'it'})
+
+        If `id` is given and a book with the same id already exists,
+        an `elasticsearch.ConflictError` will be raised
         '''
         body = validate_book(body)
         body['_insertion_date'] = current_time_millisec()
-        return self.es.index(index=self.index_name, doc_type=doc_type, body=body)
+        try:
+            if id is not None:
+                return self.es.index(index=self.index_name, doc_type=doc_type, body=body, id=id, op_type='create')
+            return self.es.index(index=self.index_name, doc_type=doc_type, body=body)
+        finally:
+            self._books_changed()
 
     def delete_book(self, id):
-        self.es.delete(index=self.index_name,
-                       id=id,
-                       doc_type='book')
+        try:
+            self.es.delete(index=self.index_name,
+                           id=id,
+                           doc_type='book')
+        finally:
+            self._books_changed(id)
 
     def delete_all(self):
-        '''Delete all books from the index'''
-        def delete_action_gen():
+        '''Delete all books from the index, with their counters and blob references'''
+        def delete_action_gen(index):
             scanner = scan(self.es,
-                           index=self.index_name,
+                           index=index,
                            query={'query': {'match_all':{}}})
             for v in scanner:
                 yield { '_op_type': 'delete',
-                        '_index': self.index_name,
+                        '_index': index,
                         '_type': v['_type'],
                         '_id': v['_id'],
                       }
-        bulk(self.es, delete_action_gen())
+        try:
+            bulk(self.es, delete_action_gen(self.index_name))
+        finally:
+            self._books_changed(all=True)
+        self.delete_download_counts()
+        self.setup_refs_index()
+        self.es.indices.refresh(index=self.refs_index_name)
+        bulk(self.es, delete_action_gen(self.refs_index_name))
+        # no book is left untracked
+        self.set_blob_refs_tracked()
 
     def update_book(self, id, body, doc_type='book'):
         ''' Update a book
@@ -403,8 +657,11 @@ class DB(object):
         book = self.get_book_by_id(id)
         book['_source'].update(body)
         validated = validate_book(book['_source'])
-        ret = self.es.index(index=self.index_name, id=id,
-                            doc_type=doc_type, body=validated, version=book['_version'])
+        try:
+            ret = self.es.index(index=self.index_name, id=id,
+                                doc_type=doc_type, body=validated, version=book['_version'])
+        finally:
+            self._books_changed(id)
         return ret
 
     def modify_book(self, id, body, doc_type='book', version=None):
@@ -422,24 +679,205 @@ class DB(object):
         params = dict(index=self.index_name, id=id, doc_type=doc_type, body=validatedBody)
         if version:
             params['version'] = version
-        ret = self.es.index(**params)
+        try:
+            ret = self.es.index(**params)
+        finally:
+            self._books_changed(id)
         return ret
 
     def increment_download_count(self, id, attachmentID, doc_type='book'):
         '''
         Increment the download counter of a specific file
         '''
-        body = self.es.get(index=self.index_name, id=id, doc_type='book', _source_include='_attachments')['_source']
-
-        for attachment in body['_attachments']:
-            if attachment['id'] == attachmentID:
-                attachment['download_count'] += 1
-                self.es.update(index=self.index_name,
-                               id=id,
-                               doc_type=doc_type,
-                               body={"doc": {'_attachments': body['_attachments']}})
-                return
-        raise NotFoundError("No attachment could be found with id: {}".format(attachmentID))
+        body = self.es.get(index=self.index_name, id=id, doc_type=doc_type, _source_include='_attachments')['_source']
+        if attachmentID not in [a['id'] for a in body['_attachments']]:
+            raise NotFoundError("No attachment could be found with id: {}".format(attachmentID))
+        self.add_download_counts({id: {attachmentID: 1}})
+
+    def add_download_counts(self, counts, retriable=None):
+        '''
+        Increment the download counters of several files at once
+
+        `counts` must be a dict in the form::
+
+            {bookID: {attachmentID: increment, ...}, ...}
+
+        With elasticsearch >= 5 all the counters are updated with a single bulk
+        request of scripted upserts; with older versions, where inline
+        scripting is disabled by default, counters are read and then rewritten.
+
+        Returns the list of book ids whose counters could not be updated.
+        If the list `retriable` is given, the (bookID, attachmentID) pairs
+        whose update failed for a transient reason, such as a version conflict
+        or an overloaded cluster, are appended to it instead, and only the books
+        with some update failed for any other reason are returned.
+        '''
+        if es_version[0] < 5:
+            current = self.get_download_counts([a for atts in counts.itervalues() for a in atts])
+            return self.set_download_counts({id: {a: current.get(a, 0) + n for a, n in atts.iteritems()}
+                                             for id, atts in counts.iteritems()},
+                                            retriable=retriable)
+
+        def update_action_gen():
+            for id, atts in counts.iteritems():
+                for attachmentID, n in atts.iteritems():
+                    yield {'_op_type': 'update',
+                           '_index': self.counters_index_name,
+                           '_type': 'counter',
+                           '_id': attachmentID,
+                           RETRY_ON_CONFLICT: 3,
+                           'script': {SCRIPT_SOURCE: 'ctx._source.download_count += params.n',
+                                      'lang': 'painless',
+                                      'params': {'n': n}},
+                           'upsert': {'book': id, 'download_count': n}
+                          }
+        _, errors = bulk(self.es, update_action_gen(), raise_on_error=False)
+        return self._failed_books(counts, errors, retriable)
+
+    def set_download_counts(self, counts, retriable=None):
+        '''
+        Overwrite the download counters of several files
+
+        `counts` and `retriable` are the same used by :py:meth:`add_download_counts`.
+        Returns the list of book ids whose counters could not be updated.
+        '''
+        def index_action_gen():
+            for id, atts in counts.iteritems():
+                for attachmentID, n in atts.iteritems():
+                    yield {'_op_type': 'index',
+                           '_index': self.counters_index_name,
+                           '_type': 'counter',
+                           '_id': attachmentID,
+                           '_source': {'book': id, 'download_count': n}
+                          }
+        _, errors = bulk(self.es, index_action_gen(), raise_on_error=False)
+        return self._failed_books(counts, errors, retriable)
+
+    # bulk item statuses worth retrying: version conflict, too many requests
+    RETRIABLE_STATUSES = (409, 429)
+
+    @classmethod
+    def _failed_books(cls, counts, errors, retriable=None):
+        failed = set()
+        transient = set()
+        for error in errors:
+            for item in error.values():
+                status = item.get('status')
+                if retriable is not None and (status in cls.RETRIABLE_STATUSES or status >= 500):
+                    transient.add(item['_id'])
+                else:
+                    failed.add(item['_id'])
+        if retriable is not None:
+            retriable.extend((id, a) for id, atts in counts.iteritems() for a in atts if a in transient)
+        return [id for id, atts in counts.iteritems() if failed.intersection(atts)]
+
+    def delete_download_counts(self, id=None, attachmentIDs=None):
+        '''
+        Delete download counters
+
+        If `attachmentIDs` is given only the counters of those attachments are deleted,
+        otherwise all the counters of the book with the given `id` are deleted.
+        If neither `id` nor `attachmentIDs` are given all counters are deleted.
+        '''
+        if not self.es.indices.exists(self.counters_index_name):
+            return
+        if attachmentIDs is not None:
+            ids = attachmentIDs
+        else:
+            query = {'query': {'match_all': {}}} if id is None else {'query': {'term': {'book': id}}}
+            # counters are updated often, make the latest ones visible to the scan
+            self.es.indices.refresh(index=self.counters_index_name)
+            ids = (v['_id'] for v in scan(self.es, index=self.counters_index_name, query=query))
+
+        def delete_action_gen():
+            for attachmentID in ids:
+                yield {'_op_type': 'delete',
+                       '_index': self.counters_index_name,
+                       '_type': 'counter',
+                       '_id': attachmentID}
+        bulk(self.es, delete_action_gen(), raise_on_error=False)
+
+    def blob_refs_tracked(self):
+        '''return True if the blob references of all the books are tracked
+
+           Books inserted before references were tracked are not,
+           until :py:func:`libreantdb.migration.build_blob_refs` is run.
+        '''
+        return self.es.exists(index=self.refs_index_name, doc_type='blob', id=self.refs_tracked_id)
+
+    def set_blob_refs_tracked(self):
+        '''record that the blob references of all the books are tracked'''
+        self.es.index(index=self.refs_index_name, doc_type='blob', id=self.refs_tracked_id,
+                      body={'refs': []})
+
+    def get_blob_refs(self, blobID):
+        '''return the references to the given blob, None if they are not tracked'''
+        try:
+            res = self.es.get(index=self.refs_index_name, doc_type='blob', id=blobID)
+        except NotFoundError:
+            return None
+        return res['_source']['refs']
+
+    def _update_blob_refs(self, blobID, update, create=True):
+        '''apply `update` to the references of a blob
+
+           `update` is called with the set of current references and must
+           return the new one. Documents are read in real time and written
+           with optimistic concurrency control, retrying on conflicts.
+           If `create` is False nothing is done for untracked blobs.
+           Returns the new references, or None if nothing has been done.
+        '''
+        while True:
+            try:
+                res = self.es.get(index=self.refs_index_name, doc_type='blob', id=blobID)
+                refs = set(res['_source']['refs'])
+                params = {'version': res['_version']}
+            except NotFoundError:
+                if not create:
+                    return None
+                refs = set()
+                params = {'op_type': 'create'}
+            refs = update(refs)
+            body = {'refs': sorted(refs)}
+            if not refs:
+                body['released'] = current_time_millisec()
+            try:
+                self.es.index(index=self.refs_index_name, doc_type='blob', id=blobID, body=body, **params)
+                return refs
+            except ConflictError:
+                log.debug("concurrent update of references of blob '{}', retrying".format(blobID))
+
+    def add_blob_refs(self, blobID, refs):
+        '''add references to a blob, `refs` is a list of strings'''
+        return self._update_blob_refs(blobID, lambda current: current | set(refs))
+
+    def remove_blob_refs(self, blobID, refs):
+        '''remove references to a blob
+
+           Returns the number of remaining references,
+           or None if the references of this blob are not tracked.
+        '''
+        res = self._update_blob_refs(blobID, lambda current: current - set(refs), create=False)
+        return None if res is None else len(res)
+
+    def iter_released_blobs(self, before):
+        '''iterate over (blobID, version) of blobs without references
+           since `before` (milliseconds since epoch)'''
+        query = {'query': {'range': {'released': {'lte': before}}}}
+        self.es.indices.refresh(index=self.refs_index_name)
+        for v in scan(self.es, index=self.refs_index_name, query=query, version=True):
+            yield v['_id'], v['_version']
+
+    def delete_released_blob(self, blobID, version):
+        '''forget a blob without references
+
+           Returns False if the blob has been referenced again in the meanwhile.
+        '''
+        try:
+            self.es.delete(index=self.refs_index_name, doc_type='blob', id=blobID, version=version)
+        except (ConflictError, NotFoundError):
+            return False
+        return True
 
     # End operations }}}
 
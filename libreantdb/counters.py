@@ -0,0 +1,124 @@
+import os
+import json
+import time
+from collections import defaultdict
+from threading import Lock
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class DownloadCounter(object):
+    '''
+    Write-coalescing buffer of download counters
+
+    Increments are aggregated in memory per (book, attachment) and
+    written to the database with :py:meth:`DB.add_download_counts` by :py:meth:`flush`.
+    A flush is triggered by :py:meth:`increment` itself once `flush_interval`
+    seconds have passed since the previous one; long-running processes
+    should also call :py:meth:`flush` periodically and before exiting.
+
+    If `journal_path` is given, every increment is appended to that file
+    and the pending increments found there are restored on initialization,
+    so that they survive restarts. Counters are updated at least once:
+    a crash right after a flush could count the flushed increments twice.
+    '''
+
+    def __init__(self, db, flush_interval=5, journal_path=None):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.journal_path = journal_path
+        self._pending = defaultdict(int)
+        self._lock = Lock()
+        self._journal = None
+        self._last_flush = time.time()
+        if journal_path:
+            self._load_journal()
+            self._journal = open(journal_path, 'a')
+
+    def _load_journal(self):
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path) as journal:
+            for line in journal:
+                try:
+                    bookID, attachmentID, n = json.loads(line)
+                except ValueError:
+                    # an incomplete line could be left by a crash
+                    log.warning("skipping malformed download counter journal entry: {!r}".format(line))
+                    continue
+                self._pending[(bookID, attachmentID)] += n
+        log.debug('restored {} pending download counters from journal'.format(len(self._pending)))
+
+    def _write_journal(self):
+        '''rewrite the journal with the current pending increments'''
+        tmpPath = self.journal_path + '.tmp'
+        with open(tmpPath, 'w') as tmp:
+            for (bookID, attachmentID), n in self._pending.iteritems():
+                tmp.write(json.dumps([bookID, attachmentID, n]) + '\n')
+        self._journal.close()
+        os.rename(tmpPath, self.journal_path)
+        self._journal = open(self.journal_path, 'a')
+
+    @property
+    def pending(self):
+        '''number of increments not yet written to the database'''
+        return sum(self._pending.itervalues())
+
+    def increment(self, bookID, attachmentID, n=1):
+        self.increment_many(bookID, [attachmentID], n)
+
+    def increment_many(self, bookID, attachmentIDs, n=1):
+        '''increment the counters of several attachments of the same book at once'''
+        with self._lock:
+            for attachmentID in attachmentIDs:
+                self._pending[(bookID, attachmentID)] += n
+                if self._journal is not None:
+                    self._journal.write(json.dumps([bookID, attachmentID, n]) + '\n')
+            if self._journal is not None:
+                self._journal.flush()
+        if time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        '''write all the pending increments to the database
+
+           Increments rejected by the database are dropped, the ones that failed
+           for a transient reason, like a version conflict, and all of them in case
+           of any other error are kept for the next flush.
+        '''
+        with self._lock:
+            self._last_flush = time.time()
+            if not self._pending:
+                return
+            snapshot = self._pending
+            self._pending = defaultdict(int)
+
+        counts = defaultdict(dict)
+        for (bookID, attachmentID), n in snapshot.iteritems():
+            counts[bookID][attachmentID] = n
+        try:
+            retriable = []
+            failed = self.db.add_download_counts(counts, retriable=retriable)
+            if retriable:
+                log.info('{} download counters will be retried'.format(len(retriable)))
+                with self._lock:
+                    for k in retriable:
+                        self._pending[k] += snapshot[k]
+            if failed:
+                log.warning('could not update download counters of books: {}'.format(failed))
+        except Exception:
+            log.exception('error while flushing download counters, they will be retried')
+            with self._lock:
+                for k, n in snapshot.iteritems():
+                    self._pending[k] += n
+        finally:
+            if self._journal is not None:
+                with self._lock:
+                    self._write_journal()
+
+    def close(self):
+        self.flush()
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
@@ -37,3 +37,90 @@ def migrate_timestamp(es, indexname):
                     'doc':{'_insertion_date': timestamp}
                   }
     return bulk(es, update_action_gen())
+
+
+# Migration of download counters from book documents to the dedicated index
+
+stored_download_count_query = {
+        "constant_score": {
+            "filter": {"exists": {"field": "_attachments.download_count"}}
+        }
+    }
+
+
+def elements_with_download_count(es, indexname):
+    return es.count(index=indexname, body={'query': stored_download_count_query})['count']
+
+
+def migrate_download_counts(db):
+    '''move the download counters stored in book documents into the counters index
+
+       Counters are moved at least once: if the migration is interrupted
+       and run again, the counters of some books could be added twice.
+    '''
+    db.setup_counters_index()
+    scanner = scan(db.es,
+                   index=db.index_name,
+                   query={'query': stored_download_count_query})
+    for v in scanner:
+        counts = {a['id']: a['download_count'] for a in v['_source']['_attachments']
+                  if a.get('download_count')}
+        if counts:
+            db.add_download_counts({v['_id']: counts})
+        # validation removes download_count from attachments
+        db.modify_book(v['_id'], v['_source'], doc_type=v['_type'])
+
+
+# Reverse index of blob references, built for volumes inserted before it existed
+
+def blob_refs_missing(db):
+    '''return the number of volumes with attachments whose blob references could be untracked
+
+       Volumes inserted since references are tracked are counted too,
+       0 is returned only once :py:func:`build_blob_refs` has completed.
+    '''
+    if db.blob_refs_tracked():
+        return 0
+    query = {"constant_score": {"filter": {"exists": {"field": "_attachments.url"}}}}
+    return db.es.count(index=db.index_name, body={'query': query})['count']
+
+
+def build_blob_refs(db):
+    '''record the references of all the attachments of all volumes
+
+       Adding a reference is idempotent, so this can safely be run again.
+       Once completed, references are marked as tracked for all the volumes,
+       enabling garbage collection.
+    '''
+    db.setup_refs_index()
+    scanner = scan(db.es, index=db.index_name, _source_include=['_attachments.url', '_attachments.id'])
+    for v in scanner:
+        for a in v['_source'].get('_attachments', []):
+            if a.get('url', '').startswith('fsdb:///'):
+                db.add_blob_refs(a['url'][len('fsdb:///'):], ['{}/{}'.format(v['_id'], a['id'])])
+    db.set_blob_refs_tracked()
+
+
+# Full text fields, once stored in the `_source` of books, are now only indexed,
+# keeping their term vectors
+
+def elements_storing_text(db):
+    '''return the number of books if the index mapping still stores full text fields,
+       or does not keep their term vectors'''
+    mappings = db.es.indices.get_mapping(index=db.index_name, doc_type='book')
+    for index in mappings.values():
+        excludes = index['mappings'].get('book', {}).get('_source', {}).get('excludes', [])
+        if not set(db.text_fields).issubset(excludes):
+            return db.es.count(index=db.index_name)['count']
+    if db.missing_term_vectors():
+        return db.es.count(index=db.index_name)['count']
+    return 0
+
+
+def migrate_stored_text(db):
+    '''rebuild the index with the new mapping, dropping full text fields from stored books
+
+       Neither the `_source` mapping nor the term vectors of an existing index
+       can be changed, so books are copied into a new index; see :py:func:`DB.reindex`.
+    '''
+    db.reindex()
@@ -0,0 +1,197 @@
+'''Memory budgeted cache of search results
+
+Results are kept serialized, so that their size can be accounted and
+every hit returns a fresh copy that callers are free to modify.
+
+Cached results are tied to the generation they were computed in:
+each change to the books bumps the generation, making all the
+previous results stale at once. Since changes become visible to searches
+only after the index is refreshed, no result is cached until then.
+Changes made by other processes are not seen, so entries also expire
+after a fixed time.
+
+"More like this" queries are expensive and their results change slowly,
+so they are also cached per book by :py:class:`SimilarCache`, which
+drops only the entries involving a changed book.
+'''
+import time
+import json
+from collections import OrderedDict
+from threading import Lock
+
+
+class QueryCache(object):
+    '''LRU cache of search results with a per entry time to live
+
+       :param max_size: total bytes of the serialized results
+       :param ttl: seconds after which a result is no more used
+       :param refresh_interval: seconds needed by a change to be visible to searches
+    '''
+
+    def __init__(self, max_size, ttl=60, refresh_interval=1):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self._changed = 0
+        self._lock = Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+        self._generation = 0
+        self._stats = dict(hits=0, misses=0, expirations=0, evictions=0, invalidations=0)
+
+    @property
+    def stats(self):
+        '''hit, miss, expiration, eviction and invalidation counts together with the current size'''
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['size'] = self._size
+        return stats
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def make_key(*args, **kargs):
+        '''return the key of a query, equal for equivalent bodies and parameters'''
+        return json.dumps([args, kargs], sort_keys=True, separators=(',', ':'))
+
+    def get(self, key):
+        '''return a copy of the result cached for `key`, None on cache miss'''
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                expire, data = entry
+                if expire > time.time():
+                    self._entries[key] = entry
+                    self._stats['hits'] += 1
+                    return json.loads(data)
+                self._size -= len(data)
+                self._stats['expirations'] += 1
+            self._stats['misses'] += 1
+            return None
+
+    def put(self, key, result, generation):
+        '''cache `result`, evicting the least recently used ones
+
+           `generation` must be the one read before running the query:
+           if books changed in the meantime the result is discarded.
+        '''
+        data = json.dumps(result, separators=(',', ':'))
+        if len(data) > self.max_size:
+            return
+        with self._lock:
+            if generation != self._generation or time.time() < self._changed + self.refresh_interval:
+                return
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old[1])
+            self._entries[key] = (time.time() + self.ttl, data)
+            self._size += len(data)
+            while self._size > self.max_size:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+                self._stats['evictions'] += 1
+
+    def invalidate(self):
+        '''drop all the cached results, and the ones of queries still running'''
+        with self._lock:
+            self._generation += 1
+            self._changed = time.time()
+            self._entries.clear()
+            self._size = 0
+            self._stats['invalidations'] += 1
+
+
+class SimilarCache(object):
+    '''LRU cache of the books similar to each book
+
+       The entry of a book is dropped when the book, or any of the books
+       similar to it, changes. Like in :py:class:`QueryCache`, nothing is
+       cached until the change is visible to searches.
+       Expired entries are still returned, marked as stale,
+       so that they can be refreshed lazily.
+
+       :param max_entries: number of books whose similar books are kept
+       :param ttl: seconds after which an entry is stale
+       :param refresh_interval: seconds needed by a change to be visible to searches
+    '''
+
+    def __init__(self, max_entries, ttl=3600, refresh_interval=1):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self._changed = 0
+        self._lock = Lock()
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._stats = dict(hits=0, misses=0, stale=0, invalidations=0)
+
+    @property
+    def stats(self):
+        '''hit, miss, stale hit and invalidation counts together with the number of entries'''
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+        return stats
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        '''return a tuple (hits, stale) for `key`, None on cache miss
+
+           A stale entry is returned as such only once per `ttl`,
+           so that a single caller refreshes it.
+        '''
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            expire, ids, hits = entry
+            stale = expire <= time.time()
+            if stale:
+                self._stats['stale'] += 1
+                entry = (time.time() + self.ttl, ids, hits)
+            else:
+                self._stats['hits'] += 1
+            self._entries[key] = entry
+            return json.loads(hits), stale
+
+    def put(self, key, hits, generation):
+        '''cache the list of `hits` for `key`
+
+           `generation` must be the one read before running the query:
+           if books changed in the meantime the hits are discarded.
+        '''
+        ids = frozenset(h['_id'] for h in hits)
+        entry = (time.time() + self.ttl, ids, json.dumps(hits, separators=(',', ':')))
+        with self._lock:
+            if generation != self._generation or time.time() < self._changed + self.refresh_interval:
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, bookID=None):
+        '''drop the entries of `bookID` and of the books similar to it, or all of them'''
+        with self._lock:
+            self._generation += 1
+            self._changed = time.time()
+            self._stats['invalidations'] += 1
+            if bookID is None:
+                self._entries.clear()
+                return
+            for key, (_, ids, _) in self._entries.items():
+                if key[0] == bookID or bookID in ids:
+                    del self._entries[key]
@@ -14,6 +14,8 @@ def setUpPackage():
 def tearDownPackage():
     if es.indices.exists('test-book'):
         es.indices.delete('test-book')
+    es.indices.delete(db.counters_index_name, ignore=[404])
+    es.indices.delete(db.refs_index_name, ignore=[404])
 
 
 def cleanall():
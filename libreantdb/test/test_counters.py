@@ -0,0 +1,122 @@
+from nose.tools import eq_
+from tempfile import mkdtemp
+from shutil import rmtree
+import os
+
+from libreantdb import DB
+from libreantdb.counters import DownloadCounter
+
+
+class FakeDB(object):
+    def __init__(self, fail=False, conflicts=(), rejected=()):
+        self.calls = []
+        self.fail = fail
+        self.conflicts = list(conflicts)
+        self.rejected = list(rejected)
+
+    def add_download_counts(self, counts, retriable=None):
+        if self.fail:
+            raise Exception('database unreachable')
+        self.calls.append(dict((k, dict(v)) for k, v in counts.items()))
+        errors = [{'update': {'_id': a, 'status': 409}} for _, a in self.conflicts] + \
+                 [{'update': {'_id': a, 'status': 400}} for _, a in self.rejected]
+        self.conflicts, self.rejected = [], []
+        return DB._failed_books(counts, errors, retriable)
+
+
+class TestDownloadCounter():
+
+    def setUp(self):
+        self.tmpDir = mkdtemp(prefix='libreantdb_counters_test_')
+        self.journal = os.path.join(self.tmpDir, 'journal')
+
+    def tearDown(self):
+        rmtree(self.tmpDir)
+
+    def test_coalesce(self):
+        db = FakeDB()
+        counter = DownloadCounter(db, flush_interval=3600)
+        for _ in range(3):
+            counter.increment('book1', 'att1')
+        counter.increment('book1', 'att2')
+        counter.increment('book2', 'att3')
+        eq_(db.calls, [])
+        eq_(counter.pending, 5)
+        counter.flush()
+        eq_(db.calls, [{'book1': {'att1': 3, 'att2': 1}, 'book2': {'att3': 1}}])
+        eq_(counter.pending, 0)
+
+    def test_write_through(self):
+        db = FakeDB()
+        counter = DownloadCounter(db, flush_interval=0)
+        counter.increment('book1', 'att1')
+        eq_(db.calls, [{'book1': {'att1': 1}}])
+
+    def test_increment_many(self):
+        db = FakeDB()
+        counter = DownloadCounter(db, flush_interval=0)
+        counter.increment_many('book1', ['att1', 'att2'])
+        eq_(db.calls, [{'book1': {'att1': 1, 'att2': 1}}])
+
+    def test_flush_empty(self):
+        db = FakeDB()
+        DownloadCounter(db).flush()
+        eq_(db.calls, [])
+
+    def test_failure_keeps_pending(self):
+        db = FakeDB(fail=True)
+        counter = DownloadCounter(db, flush_interval=3600)
+        counter.increment('book1', 'att1')
+        counter.flush()
+        eq_(counter.pending, 1)
+        db.fail = False
+        counter.flush()
+        eq_(db.calls, [{'book1': {'att1': 1}}])
+
+    def test_conflicts_retried(self):
+        db = FakeDB(conflicts=[('book1', 'att1')])
+        counter = DownloadCounter(db, flush_interval=3600)
+        counter.increment_many('book1', ['att1', 'att2'], n=2)
+        counter.flush()
+        eq_(counter.pending, 2)
+        counter.flush()
+        eq_(db.calls[-1], {'book1': {'att1': 2}})
+        eq_(counter.pending, 0)
+
+    def test_journal_restore(self):
+        counter = DownloadCounter(FakeDB(), flush_interval=3600, journal_path=self.journal)
+        counter.increment('book1', 'att1')
+        counter.increment('book1', 'att1')
+        # simulate a crash: the counter is never flushed
+        db = FakeDB()
+        restored = DownloadCounter(db, flush_interval=3600, journal_path=self.journal)
+        eq_(restored.pending, 2)
+        restored.flush()
+        eq_(db.calls, [{'book1': {'att1': 2}}])
+
+    def test_journal_cleared_on_flush(self):
+        counter = DownloadCounter(FakeDB(), flush_interval=3600, journal_path=self.journal)
+        counter.increment('book1', 'att1')
+        counter.flush()
+        eq_(DownloadCounter(FakeDB(), journal_path=self.journal).pending, 0)
+
+    def test_conflicts_and_rejections(self):
+        db = FakeDB(conflicts=[('book1', 'att1')], rejected=[('book1', 'att2')])
+        counter = DownloadCounter(db, flush_interval=3600)
+        counter.increment_many('book1', ['att1', 'att2', 'att3'])
+        counter.flush()
+        # only the conflicting increment is kept, the rejected one is dropped
+        eq_(counter.pending, 1)
+        counter.flush()
+        eq_(db.calls[-1], {'book1': {'att1': 1}})
+
+
+def test_failed_books():
+    counts = {'book1': {'att1': 1, 'att2': 1}, 'book2': {'att3': 1}}
+    errors = [{'update': {'_id': 'att1', 'status': 409}},
+              {'update': {'_id': 'att2', 'status': 400}},
+              {'update': {'_id': 'att3', 'status': 503}}]
+    retriable = []
+    eq_(DB._failed_books(counts, errors, retriable), ['book1'])
+    eq_(sorted(retriable), [('book1', 'att1'), ('book2', 'att3')])
+    eq_(sorted(DB._failed_books(counts, errors)), ['book1', 'book2'])
@@ -0,0 +1,36 @@
+'''
+Index mappings upgrade
+'''
+
+from nose.tools import eq_, with_setup
+
+from libreantdb import DB
+from libreantdb.migration import elements_storing_text
+from . import db
+
+OLD_INDEX = 'test-book-old'
+
+
+def delete_old_index():
+    db.es.indices.delete(OLD_INDEX, ignore=[404])
+
+
+@with_setup(delete_old_index, delete_old_index)
+def test_update_mappings_without_term_vectors():
+    properties = dict((k, dict((kk, vv) for kk, vv in m.items() if kk != 'term_vector'))
+                      for k, m in DB.properties.items())
+    oldDB = DB(db.es, index_name=OLD_INDEX)
+    oldDB.create_index(index_conf={'settings': DB.settings,
+                                   'mappings': {'book': {'_source': DB.source_mapping,
+                                                         'properties': properties}}})
+    eq_(oldDB.missing_term_vectors(), ['_text_en', '_text_it'])
+    # term vectors cannot be added in place, they are left to the upgrade
+    oldDB.update_mappings()
+    oldDB.add_book(body=dict(title='La fine', _language='it'))
+    oldDB.es.indices.refresh(index=OLD_INDEX)
+    eq_(elements_storing_text(oldDB), 1)
+
+
+def test_new_index_term_vectors():
+    eq_(db.missing_term_vectors(), [])
+    db.update_mappings()
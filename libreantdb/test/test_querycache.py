@@ -0,0 +1,134 @@
+from nose.tools import eq_, ok_, with_setup
+
+from libreantdb import DB
+from libreantdb.querycache import QueryCache, SimilarCache
+from . import db, cleanall
+
+
+def test_key_normalized():
+    eq_(QueryCache.make_key('idx', {'a': 1, 'b': [1, 2]}, size=10, from_=0),
+        QueryCache.make_key('idx', {'b': [1, 2], 'a': 1}, from_=0, size=10))
+    ok_(QueryCache.make_key('idx', {'a': 1}, size=10) != QueryCache.make_key('idx', {'a': 1}, size=20))
+
+
+def test_hit_returns_copy():
+    cache = QueryCache(1000, refresh_interval=0)
+    ok_(cache.get('k') is None)
+    cache.put('k', {'hits': [1, 2]}, cache.generation)
+    res = cache.get('k')
+    eq_(res, {'hits': [1, 2]})
+    res['hits'].pop()
+    eq_(cache.get('k'), {'hits': [1, 2]})
+    stats = cache.stats
+    eq_(stats['hits'], 2)
+    eq_(stats['misses'], 1)
+    eq_(stats['entries'], 1)
+
+
+def test_ttl():
+    cache = QueryCache(1000, ttl=-1, refresh_interval=0)
+    cache.put('k', [1], cache.generation)
+    ok_(cache.get('k') is None)
+    eq_(cache.stats['expirations'], 1)
+    eq_(cache.stats['size'], 0)
+
+
+def test_lru_eviction():
+    cache = QueryCache(20, refresh_interval=0)
+    cache.put('a', 'a' * 5, cache.generation)
+    cache.put('b', 'b' * 5, cache.generation)
+    cache.get('a')
+    cache.put('c', 'c' * 5, cache.generation)
+    ok_(cache.get('b') is None)
+    ok_(cache.get('a') is not None)
+    ok_(cache.get('c') is not None)
+    eq_(cache.stats['evictions'], 1)
+
+
+def test_invalidate():
+    cache = QueryCache(1000, refresh_interval=0)
+    generation = cache.generation
+    cache.put('a', [1], generation)
+    cache.invalidate()
+    ok_(cache.get('a') is None)
+    # results of queries started before the change are discarded
+    cache.put('b', [1], generation)
+    ok_(cache.get('b') is None)
+    cache.put('b', [1], cache.generation)
+    ok_(cache.get('b') is not None)
+
+
+def test_not_cached_before_refresh():
+    cache = QueryCache(1000, refresh_interval=3600)
+    cache.put('a', [1], cache.generation)
+    ok_(cache.get('a') is not None)
+    cache.invalidate()
+    cache.put('a', [1], cache.generation)
+    ok_(cache.get('a') is None)
+
+
+@with_setup(cleanall, cleanall)
+def test_db_invalidation():
+    cachedDB = DB(db.es, index_name=db.index_name, query_cache=QueryCache(2**20, refresh_interval=0))
+    id = cachedDB.add_book(body=dict(title='La fine', _language='it'))['_id']
+    db.es.indices.refresh(index=db.index_name)
+    eq_(cachedDB.get_books_simplequery('fine')['hits']['total'], 1)
+    eq_(cachedDB.get_books_simplequery('fine')['hits']['total'], 1)
+    eq_(cachedDB.query_cache.stats['hits'], 1)
+    cachedDB.delete_book(id)
+    db.es.indices.refresh(index=db.index_name)
+    eq_(cachedDB.get_books_simplequery('fine')['hits']['total'], 0)
+
+
+def test_similar_invalidation():
+    cache = SimilarCache(10)
+    cache.put(('a',), [{'_id': 'b'}, {'_id': 'c'}], cache.generation)
+    cache.put(('d',), [{'_id': 'e'}], cache.generation)
+    eq_(cache.get(('a',)), ([{'_id': 'b'}, {'_id': 'c'}], False))
+    cache.invalidate('c')
+    ok_(cache.get(('a',)) is None)
+    ok_(cache.get(('d',)) is not None)
+    cache.invalidate('d')
+    ok_(cache.get(('d',)) is None)
+
+
+def test_similar_not_cached_before_refresh():
+    cache = SimilarCache(10, refresh_interval=3600)
+    cache.put(('a',), [{'_id': 'b'}], cache.generation)
+    ok_(cache.get(('a',)) is not None)
+    cache.invalidate('b')
+    # hits found right after the change could still include 'b'
+    cache.put(('a',), [{'_id': 'b'}], cache.generation)
+    ok_(cache.get(('a',)) is None)
+
+
+def test_similar_stale_once():
+    cache = SimilarCache(10, ttl=3600)
+    cache.put(('a',), [{'_id': 'b'}], cache.generation)
+    cache._entries[('a',)] = (0,) + cache._entries[('a',)][1:]
+    eq_(cache.get(('a',)), ([{'_id': 'b'}], True))
+    # the first caller refreshes it, the others get it as it is
+    eq_(cache.get(('a',)), ([{'_id': 'b'}], False))
+    eq_(cache.stats['stale'], 1)
+
+
+def test_similar_lru():
+    cache = SimilarCache(2)
+    for key in 'abc':
+        cache.put((key,), [], cache.generation)
+    ok_(cache.get(('a',)) is None)
+    eq_(len(cache), 2)
+
+
+@with_setup(cleanall, cleanall)
+def test_db_similar_books():
+    cachedDB = DB(db.es, index_name=db.index_name, similar_cache=SimilarCache(10))
+    first = cachedDB.add_book(body=dict(title='La fine del mondo', _language='it'))['_id']
+    second = cachedDB.add_book(body=dict(title='La fine della storia', _language='it'))['_id']
+    db.es.indices.refresh(index=db.index_name)
+    eq_([h['_id'] for h in cachedDB.similar_books(first)], [second])
+    cachedDB.similar_books(first)
+    eq_(cachedDB.similar_cache.stats['hits'], 1)
+    cachedDB.delete_book(second)
+    db.es.indices.refresh(index=db.index_name)
+    eq_(cachedDB.similar_books(first), [])
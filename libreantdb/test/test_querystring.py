@@ -1,8 +1,10 @@
 from __future__ import print_function
 
 from nose.tools import eq_, with_setup
+from nose.plugins.skip import SkipTest
 
 from . import db, cleanall
+from libreantdb.api import SEARCH_AFTER
 
 
 @with_setup(cleanall, cleanall)
@@ -70,3 +72,35 @@ def test_quotedfield():
     res = db.user_search('actors:"karl marx"')['hits']
     eq_(res['total'], 1)
     eq_(res['hits'][0]['_id'], bookid1)
+
+
+@with_setup(cleanall, cleanall)
+def test_search_after():
+    '''Pages fetched with search_after cover all the hits once'''
+    if not SEARCH_AFTER:
+        raise SkipTest('search_after requires elasticsearch >= 5')
+    ids = set()
+    for i in range(7):
+        ids.add(db.add_book(doc_type='book', body=dict(title='same title', _language='en'))['_id'])
+    db.es.indices.refresh(index=db.index_name)
+    seen = []
+    searchAfter = None
+    while True:
+        hits = db.get_books_querystring('title', search_after=searchAfter, size=3)['hits']['hits']
+        if not hits:
+            break
+        seen.extend(h['_id'] for h in hits)
+        searchAfter = hits[-1]['sort']
+    eq_(len(seen), 7)
+    eq_(set(seen), ids)
+
+
+@with_setup(cleanall, cleanall)
+def test_source_filtering():
+    '''Only the requested fields are returned'''
+    db.add_book(doc_type='book', body=dict(title='Un libro', actors=['Qualcuno'], _language='it'))
+    db.es.indices.refresh(index=db.index_name)
+    src = db.get_books_querystring('libro', excludes=db.text_fields)['hits']['hits'][0]['_source']
+    eq_(set(src.keys()), set(['title', 'actors', '_language', '_insertion_date']))
+    src = db.get_books_querystring('libro', includes=['title'])['hits']['hits'][0]['_source']
+    eq_(src, {'title': 'Un libro'})
@@ -55,10 +55,11 @@ def test_update_book_merge_fts_correct():
     db.es.indices.refresh(index=db.index_name)
     db.update_book(id_, dict(foo='Ciao mondo'))
     db.es.indices.refresh(index=db.index_name)
-    res = db.get_books_simplequery('mondo')
-    src = res['hits']['hits'][0]['_source']
-    ok_('mondo' in src['_text_it'])
-    ok_('fine' in src['_text_it'])
+    res = db._search(db._get_search_field('_text_it', 'mondo'))
+    eq_(res['hits']['total'], 1)
+    res = db._search(db._get_search_field('_text_it', 'fine'))
+    eq_(res['hits']['total'], 1)
+    ok_('_text_it' not in res['hits']['hits'][0]['_source'])
 
 
 @with_setup(cleanall, cleanall)
@@ -80,9 +81,11 @@ def test_modify_book_fts_correct():
     del(book['_source']['title'])
     book['_source']['author'] = 'Sally Niser'
     db.modify_book(id, book['_source'])
-    mod_book = db.get_book_by_id(id)['_source']
-    ok_('fine' not in mod_book['_text_it'])
-    ok_('Niser' in mod_book['_text_it'])
+    db.es.indices.refresh(index=db.index_name)
+    res = db._search(db._get_search_field('_text_it', 'fine'))
+    eq_(res['hits']['total'], 0)
+    res = db._search(db._get_search_field('_text_it', 'Niser'))
+    eq_(res['hits']['total'], 1)
 
 
 @with_setup(cleanall, cleanall)
@@ -108,3 +111,11 @@ def test_modify_book_wrong_version():
     mod_book = db.get_book_by_id(id)['_source']
     ok_('title' not in mod_book)
     eq_(mod_book['author'], 'author_one')
+
+
+@with_setup(cleanall, cleanall)
+def test_text_fields_not_stored():
+    id = db.add_book(body=dict(title='La fine', _language='it'))['_id']
+    book = db.get_book_by_id(id)['_source']
+    ok_('_text_it' not in book)
+    eq_(book['title'], 'La fine')
@@ -1,5 +1,5 @@
 from uuid import uuid4
-from nose.tools import eq_, with_setup, raises
+from nose.tools import eq_, ok_, with_setup, raises
 from elasticsearch import NotFoundError
 
 from . import db, cleanall
@@ -11,8 +11,7 @@ def generate_book_body(attachments=0):
             '_attachments': []}
     for _ in range(attachments):
         attachment = {'id': uuid4().hex,
-                      'name': 'foo',
-                      'download_count': 0}
+                      'name': 'foo'}
         body['_attachments'].append(attachment)
     return body
 
@@ -36,17 +35,14 @@ def test_download_count_wrong_attachmentid():
     db.increment_download_count(bookID, uuid4())
 
 
-@raises(Exception)
 @with_setup(cleanall, cleanall)
-def test_download_count_mandatory():
+def test_download_count_not_in_book():
     '''
-    if you omit the field download_count, increment_download_count will fail
+    download counters must not be stored inside the book document
     '''
-    bookID = db.add_book(body=dict(title='La fine',
-                                   _language='it',
-                                   _attachments=[dict(name='foo')]
-                                   ))['_id']
-    db.increment_download_count(bookID, uuid4().hex)
+    bookID = db.add_book(body=generate_book_body(attachments=1))['_id']
+    book = db.get_book_by_id(bookID)
+    ok_('download_count' not in book['_source']['_attachments'][0])
 
 
 @with_setup(cleanall, cleanall)
@@ -54,20 +50,61 @@ def test_update_download_count():
     body = generate_book_body(attachments=1)
     attachmentID = body['_attachments'][0]['id']
     bookID = db.add_book(body=body)['_id']
+    eq_(db.get_download_counts([attachmentID]), {})
     for i in xrange(1, 5):
         db.increment_download_count(bookID, attachmentID)
-        book = db.get_book_by_id(bookID)
-        eq_(book['_source']['_attachments'][0]['download_count'], i)
+        eq_(db.get_download_counts([attachmentID]), {attachmentID: i})
 
 
 @with_setup(cleanall, cleanall)
 def test_update_download_count_no_other():
-    ''' download count shouldn't modify other fields '''
+    ''' download count shouldn't modify the book '''
     body = generate_book_body(attachments=1)
     attachmentID = body['_attachments'][0]['id']
     bookID = db.add_book(body=body)['_id']
     prev = db.get_book_by_id(bookID)
     db.increment_download_count(bookID, attachmentID)
     after = db.get_book_by_id(bookID)
-    prev['_source']['_attachments'][0]['download_count'] += 1
     eq_(prev['_source'], after['_source'])
+    eq_(prev['_version'], after['_version'])
+
+
+@with_setup(cleanall, cleanall)
+def test_add_download_counts():
+    bookID = db.add_book(body=generate_book_body(attachments=3))['_id']
+    atts = [a['id'] for a in db.get_book_by_id(bookID)['_source']['_attachments']]
+    failed = db.add_download_counts({bookID: {atts[0]: 3, atts[1]: 1}})
+    eq_(failed, [])
+    failed = db.add_download_counts({bookID: {atts[1]: 2}})
+    eq_(failed, [])
+    eq_(db.get_download_counts(atts), {atts[0]: 3, atts[1]: 3})
+
+
+@with_setup(cleanall, cleanall)
+def test_set_download_counts():
+    bookID = db.add_book(body=generate_book_body(attachments=1))['_id']
+    attachmentID = db.get_book_by_id(bookID)['_source']['_attachments'][0]['id']
+    db.add_download_counts({bookID: {attachmentID: 3}})
+    db.set_download_counts({bookID: {attachmentID: 10}})
+    eq_(db.get_download_counts([attachmentID]), {attachmentID: 10})
+
+
+@with_setup(cleanall, cleanall)
+def test_delete_download_counts():
+    bookID = db.add_book(body=generate_book_body(attachments=2))['_id']
+    atts = [a['id'] for a in db.get_book_by_id(bookID)['_source']['_attachments']]
+    db.add_download_counts({bookID: {atts[0]: 1, atts[1]: 1}, 'other': {'foo': 1}})
+    db.delete_download_counts(attachmentIDs=[atts[0]])
+    eq_(db.get_download_counts(atts), {atts[1]: 1})
+    db.delete_download_counts(bookID)
+    eq_(db.get_download_counts(atts + ['foo']), {'foo': 1})
+
+
+@with_setup(cleanall, cleanall)
+def test_delete_download_counts_without_index():
+    db.es.indices.delete(db.counters_index_name)
+    try:
+        db.delete_download_counts()
+        db.delete_download_counts(id='any')
+    finally:
+        db.setup_counters_index()
@@ -1,11 +1,9 @@
 import json
-import tempfile
-import os
 from werkzeug import secure_filename
-from webant.util import send_attachment_file, routes_collector
+from webant.util import send_attachment_file, send_volume_archive, routes_collector, next_cursor, parse_cursor
 from flask import request, current_app, url_for, jsonify
 from archivant import Archivant
-from archivant.exceptions import NotFoundException
+from archivant.exceptions import NotFoundException, ConflictException
 from util import ApiError, on_json_load_error, make_success_response
 from users import Action
 
@@ -15,6 +13,11 @@ route = routes_collector(routes)
 
 @route('/volumes/')
 def get_volumes():
+    '''search volumes
+
+       Results are paged with the opaque cursor given in `link_next`,
+       the `from` parameter is only accepted up to `SEARCH_CURSOR_THRESHOLD` results.
+    '''
     current_app.authz.perform_authorization(('/volumes/*', Action.READ))
     q = request.args.get('q', "*:*")
     try:
@@ -27,14 +30,35 @@ def get_volumes():
         raise ApiError("Bad Request", 400, details="could not covert 'size' parameter to number")
     if size > current_app.config['MAX_RESULTS_PER_PAGE']:
         raise ApiError("Request Entity Too Large", 413, details="'size' parameter is too high")
+    # without search_after support cursors hold offsets, bounded like 'from'
+    maxOffset = current_app.config['SEARCH_CURSOR_THRESHOLD'] - size
+    cursor = request.args.get('cursor')
+    if cursor is not None:
+        try:
+            searchArgs = parse_cursor(cursor, maxOffset)
+        except ValueError, e:
+            raise ApiError("Bad Request", 400, details=str(e))
+    else:
+        if from_ + size > current_app.config['SEARCH_CURSOR_THRESHOLD']:
+            raise ApiError("Bad Request", 400, details="'from' parameter is too high, follow 'link_next' to get further results")
+        searchArgs = {'from_': from_}
 
-    q_res = current_app.archivant._db.get_books_querystring(query=q, from_=from_, size=size)
-    volumes = map(Archivant.normalize_volume, q_res['hits']['hits'])
-    next_args = "?q={}&from={}&size={}".format(q, from_ + size, size)
-    prev_args = "?q={}&from={}&size={}".format(q, from_ - size if ((from_ - size) > -1) else 0, size)
-    base_url = url_for('.get_volumes', _external=True)
-    res = {'link_prev': base_url + prev_args,
-           'link_next': base_url + next_args,
+    db = current_app.archivant._db
+    q_res = db.get_books_querystring(query=q, size=size, excludes=db.text_fields, **searchArgs)
+    hits = q_res['hits']['hits']
+    volumes = map(Archivant.normalize_volume, hits)
+    current_app.archivant.merge_download_counts(volumes)
+    link_next = link_prev = None
+    nextCursor = None
+    if len(hits) == size and size > 0:
+        nextCursor = next_cursor(hits, searchArgs.get('from_', 0), maxOffset)
+    if nextCursor is not None:
+        link_next = url_for('.get_volumes', q=q, size=size, cursor=nextCursor, _external=True)
+    if cursor is None:
+        link_prev = url_for('.get_volumes', q=q, size=size, _external=True,
+                            **{'from': from_ - size if ((from_ - size) > -1) else 0})
+    res = {'link_prev': link_prev,
+           'link_next': link_next,
            'total': q_res['hits']['total'],
            'data': volumes}
     return jsonify(res)
@@ -106,25 +130,33 @@ def get_attachments(volumeID):
 def add_attachments(volumeID):
     current_app.authz.perform_authorization(('/volumes/{}/attachments/*'.format(volumeID), Action.CREATE))
     metadata = receive_metadata(optional=True)
-    if 'file' not in request.files:
+    if 'file' in request.files:
+        upFile = request.files['file']
+        fileInfo = {}
+        fileInfo['file'] = upFile.stream
+        fileInfo['name'] = secure_filename(upFile.filename)
+        fileInfo['mime'] = upFile.mimetype
+    elif 'sha1' in metadata:
+        # attach content already stored, without uploading it
+        fileInfo = {}
+        fileInfo['sha1'] = metadata['sha1']
+        fileInfo['size'] = metadata.get('size')
+        fileInfo['name'] = secure_filename(metadata.get('name', ''))
+        fileInfo['mime'] = metadata.get('mime')
+        try:
+            if current_app.archivant.find_stored_file(fileInfo['sha1'], fileInfo['size']) is None:
+                raise ApiError("file not found", 404, details="no stored content matches the given sha1 and size")
+        except ValueError, e:
+            raise ApiError("malformed metadata", 400, details=str(e))
+    else:
         raise ApiError("malformed request", 400, details="file not found under 'file' key")
-    upFile = request.files['file']
-    tmpFileFd, tmpFilePath = tempfile.mkstemp()
-    upFile.save(tmpFilePath)
-    fileInfo = {}
-    fileInfo['file'] = tmpFilePath
-    fileInfo['name'] = secure_filename(upFile.filename)
-    fileInfo['mime'] = upFile.mimetype
     fileInfo['notes'] = metadata.get('notes', '')
-    # close fileDescriptor
-    os.close(tmpFileFd)
     try:
         attachmentID = current_app.archivant.insert_attachments(volumeID, attachments=[fileInfo])[0]
     except NotFoundException, e:
         raise ApiError("volume not found", 404, details=str(e))
-    finally:
-        # remove temp files
-        os.remove(fileInfo['file'])
+    except ValueError, e:
+        raise ApiError("malformed metadata", 400, details=str(e))
     link_self = url_for('.get_attachment', volumeID=volumeID, attachmentID=attachmentID, _external=True)
     response = jsonify({'data': {'id': attachmentID, 'link_self': link_self}})
     response.status_code = 201
@@ -132,6 +164,140 @@ def add_attachments(volumeID):
     return response
 
 
+@route('/files/<sha1>', methods=['GET'])
+def get_stored_file(sha1):
+    '''tell if a content is already stored, so that it can be attached without uploading it'''
+    current_app.authz.perform_authorization(('/volumes/*', Action.CREATE))
+    try:
+        size = int(request.args['size'])
+    except KeyError:
+        raise ApiError("Bad Request", 400, details="missing 'size' parameter")
+    except ValueError:
+        raise ApiError("Bad Request", 400, details="could not covert 'size' parameter to number")
+    try:
+        fsdbID = current_app.archivant.find_stored_file(sha1, size)
+    except ValueError, e:
+        raise ApiError("Bad Request", 400, details=str(e))
+    if fsdbID is None:
+        raise ApiError("file not found", 404, details="no stored content matches the given sha1 and size")
+    return jsonify({'data': {'sha1': sha1, 'size': size}})
+
+
+@route('/volumes/<volumeID>/uploads/', methods=['POST'])
+def create_upload(volumeID):
+    '''start a resumable upload of a big file, whose content is sent in chunks'''
+    current_app.authz.perform_authorization(('/volumes/{}/attachments/*'.format(volumeID), Action.CREATE))
+    metadata = receive_metadata()
+    try:
+        size = int(metadata['size'])
+    except KeyError:
+        raise ApiError("malformed metadata", 400, details="Required field 'size' is missing in metadata")
+    except (TypeError, ValueError):
+        raise ApiError("malformed metadata", 400, details="could not covert 'size' to number")
+    fileInfo = {'name': secure_filename(metadata.get('name', '')),
+                'mime': metadata.get('mime'),
+                'notes': metadata.get('notes', '')}
+    try:
+        status = current_app.archivant.create_upload(volumeID, size, fileInfo)
+    except NotFoundException, e:
+        raise ApiError("volume not found", 404, details=str(e))
+    except (KeyError, ValueError), e:
+        raise ApiError("malformed metadata", 400, details=str(e))
+    link_self = url_for('.get_upload', volumeID=volumeID, uploadID=status['id'], _external=True)
+    status['link_self'] = link_self
+    response = jsonify({'data': status})
+    response.status_code = 201
+    response.headers['Location'] = link_self
+    return response
+
+
+@route('/volumes/<volumeID>/uploads/<uploadID>', methods=['GET'])
+def get_upload(volumeID, uploadID):
+    current_app.authz.perform_authorization(('/volumes/{}/attachments/*'.format(volumeID), Action.CREATE))
+    try:
+        status = current_app.archivant.get_upload(volumeID, uploadID)
+    except NotFoundException, e:
+        raise ApiError("upload not found", 404, details=str(e))
+    return jsonify({'data': status})
+
+
+@route('/volumes/<volumeID>/uploads/<uploadID>', methods=['DELETE'])
+def delete_upload(volumeID, uploadID):
+    current_app.authz.perform_authorization(('/volumes/{}/attachments/*'.format(volumeID), Action.CREATE))
+    try:
+        current_app.archivant.abort_upload(volumeID, uploadID)
+    except NotFoundException, e:
+        raise ApiError("upload not found", 404, details=str(e))
+    except ConflictException, e:
+        raise ApiError("Conflict", 409, details=str(e))
+    return make_success_response("upload has been successfully deleted")
+
+
+@route('/volumes/<volumeID>/uploads/<uploadID>/chunks/<int:number>', methods=['PUT'])
+def put_upload_chunk(volumeID, uploadID, number):
+    '''append the raw request body to the upload
+
+       The 'offset' parameter is the position of the chunk in the file,
+       it must be equal to the number of bytes received so far.
+    '''
+    current_app.authz.perform_authorization(('/volumes/{}/attachments/*'.format(volumeID), Action.CREATE))
+    try:
+        offset = int(request.args['offset'])
+    except KeyError:
+        raise ApiError("Bad Request", 400, details="missing 'offset' parameter")
+    except ValueError:
+        raise ApiError("Bad Request", 400, details="could not covert 'offset' parameter to number")
+    if request.content_length is None:
+        raise ApiError("Length Required", 411, details="chunk size must be given with Content-Length")
+    try:
+        status = current_app.archivant.write_upload_chunk(volumeID, uploadID, number, offset,
+                                                          request.stream, request.content_length)
+    except NotFoundException, e:
+        raise ApiError("upload not found", 404, details=str(e))
+    except ConflictException, e:
+        try:
+            received = current_app.archivant.get_upload(volumeID, uploadID)['received']
+        except NotFoundException, notFound:
+            # removed in the meanwhile
+            raise ApiError("upload not found", 404, details=str(notFound))
+        raise ApiError("Conflict", 409, details={'message': str(e), 'received': received})
+    except ValueError, e:
+        raise ApiError("Bad Request", 400, details=str(e))
+    return jsonify({'data': status})
+
+
+@route('/volumes/<volumeID>/uploads/<uploadID>/finalize', methods=['POST'])
+def finalize_upload(volumeID, uploadID):
+    '''attach the uploaded file to the volume
+
+       If the optional 'sha1' parameter is given, it is checked against the received content.
+    '''
+    current_app.authz.perform_authorization(('/volumes/{}/attachments/*'.format(volumeID), Action.CREATE))
+    try:
+        attachmentID = current_app.archivant.finalize_upload(volumeID, uploadID, sha1=request.values.get('sha1'))
+    except NotFoundException, e:
+        raise ApiError("upload not found", 404, details=str(e))
+    except ConflictException, e:
+        raise ApiError("upload not complete", 409, details=str(e))
+    except ValueError, e:
+        raise ApiError("Bad Request", 400, details=str(e))
+    link_self = url_for('.get_attachment', volumeID=volumeID, attachmentID=attachmentID, _external=True)
+    response = jsonify({'data': {'id': attachmentID, 'link_self': link_self}})
+    response.status_code = 201
+    response.headers['Location'] = link_self
+    return response
+
+
+@route('/volumes/<volumeID>/attachments/all', methods=['GET'])
+def get_all_files(volumeID):
+    '''send the files of all the attachments as a ZIP archive'''
+    current_app.authz.perform_authorization(('/volumes/{}/attachments/*'.format(volumeID), Action.READ))
+    try:
+        return send_volume_archive(current_app.archivant, volumeID)
+    except NotFoundException, e:
+        raise ApiError("volume not found", 404, details=str(e))
+
+
 @route('/volumes/<volumeID>/attachments/<attachmentID>', methods=['GET'])
 def get_attachment(volumeID, attachmentID):
     current_app.authz.perform_authorization(('/volumes/{}/attachments/{}'.format(volumeID, attachmentID), Action.READ))
@@ -183,7 +349,7 @@ def receive_volume_metadata():
 
 
 def receive_metadata(optional=False):
-    if optional and 'metdata' not in request.values:
+    if optional and 'metadata' not in request.values:
         return {}
     try:
         metadata = json.loads(request.values['metadata'])
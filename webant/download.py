@@ -0,0 +1,168 @@
+'''
+This module provides the machinery used to serve attachment files,
+with support for conditional requests and byte ranges (RFC 7232, RFC 7233)
+and for delegating the actual transfer to a front-end web server.
+'''
+from uuid import uuid4
+
+from flask import current_app, request
+from werkzeug.http import parse_range_header, parse_date, is_resource_modified, quote_etag
+from werkzeug.wsgi import wrap_file, ClosingIterator
+
+
+BLOCK_SIZE = 2**16
+
+# requests asking for more ranges than this limit are served with the whole file
+MAX_RANGES = 32
+
+# supported offload modes and the response header used by each of them
+OFFLOAD_HEADERS = {'x-sendfile': 'X-Sendfile',
+                   'x-accel-redirect': 'X-Accel-Redirect'}
+
+
+def iter_file_range(f, start, stop, block_size=BLOCK_SIZE):
+    '''iterate over the content of `f` in the byte range [start, stop)'''
+    f.seek(start)
+    remaining = stop - start
+    while remaining > 0:
+        chunk = f.read(min(block_size, remaining))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        yield chunk
+
+
+def resolve_ranges(ranges, size):
+    '''convert parsed byte ranges to absolute [start, stop) intervals
+
+       Unsatisfiable ranges are discarded.
+    '''
+    res = []
+    for start, stop in ranges:
+        if start < 0:
+            # suffix range: last `-start` bytes
+            start = max(size + start, 0)
+            stop = size
+        else:
+            stop = size if stop is None else min(stop, size)
+        if start < stop:
+            res.append((start, stop))
+    return res
+
+
+def content_range(start, stop, size):
+    return 'bytes {}-{}/{}'.format(start, stop - 1, size)
+
+
+def if_range_matches(etag, last_modified):
+    '''evaluate the If-Range precondition of the current request'''
+    if_range = request.headers.get('If-Range')
+    if not if_range:
+        return True
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        # weak etags must not be used with If-Range
+        return if_range == quote_etag(etag)
+    date = parse_date(if_range)
+    return date is not None and last_modified is not None and \
+        date == last_modified.replace(microsecond=0)
+
+
+def make_file_response(f, size, mimetype=None, filename=None, etag=None, last_modified=None, offload=None,
+                       content_encoding=None):
+    '''build the response used to send the content of the file object `f`
+
+       Handles `If-None-Match`, `If-Modified-Since`, `Range` and `If-Range` request headers.
+       The returned response takes care of closing `f`.
+       If `f` is not seekable, e.g. it is streamed from a remote storage,
+       byte ranges are ignored and the whole content is sent.
+
+       :param size: the size in bytes of the content of `f`
+       :param filename: if given, the file is sent as an attachment with this name
+       :param etag: the strong entity tag of the content
+       :param last_modified: datetime of the last modification of the content
+       :param offload: a tuple (mode, target) where `mode` is one of :py:data:`OFFLOAD_HEADERS`.
+                       If given, no content is sent: the front-end web server is asked to send
+                       `target` instead, and byte ranges are left to it.
+    :param content_encoding: the encoding of the content of `f`, e.g. 'gzip'.
+                             In this case `size` and `etag` refer to the encoded content.
+    '''
+    if mimetype is None:
+        mimetype = 'application/octet-stream'
+    response_class = current_app.response_class
+    seekable = hasattr(f, 'seek')
+
+    def set_common_headers(rv):
+        rv.headers['Accept-Ranges'] = 'bytes' if seekable else 'none'
+        if etag is not None:
+            rv.set_etag(etag)
+        if last_modified is not None:
+            rv.last_modified = last_modified
+        if filename is not None:
+            rv.headers.add('Content-Disposition', 'attachment', filename=filename)
+        if content_encoding is not None:
+            rv.content_encoding = content_encoding
+        return rv
+
+    if request.method in ('GET', 'HEAD') and \
+            not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        f.close()
+        return set_common_headers(response_class(status=304))
+
+    if offload is not None:
+        mode, target = offload
+        f.close()
+        rv = response_class(mimetype=mimetype)
+        rv.headers[OFFLOAD_HEADERS[mode]] = target
+        return set_common_headers(rv)
+
+    rng = None
+    if seekable and 'Range' in request.headers and if_range_matches(etag, last_modified):
+        rng = parse_range_header(request.headers['Range'])
+    if rng is not None and rng.units == 'bytes' and len(rng.ranges) <= MAX_RANGES:
+        ranges = resolve_ranges(rng.ranges, size)
+        if not ranges:
+            f.close()
+            rv = response_class(status=416)
+            rv.headers['Content-Range'] = 'bytes */{}'.format(size)
+            return set_common_headers(rv)
+
+        if len(ranges) == 1:
+            start, stop = ranges[0]
+            # the server gets the iterable as it is, so it has to close `f` itself
+            rv = response_class(ClosingIterator(iter_file_range(f, start, stop), f.close), status=206,
+                                mimetype=mimetype, direct_passthrough=True)
+            rv.headers['Content-Range'] = content_range(start, stop, size)
+            rv.content_length = stop - start
+        else:
+            boundary = uuid4().hex
+            parts = []
+            length = 0
+            for start, stop in ranges:
+                head = '--{}\r\nContent-Type: {}\r\nContent-Range: {}\r\n\r\n'.format(
+                    boundary, mimetype, content_range(start, stop, size))
+                parts.append((head, start, stop))
+                length += len(head) + (stop - start) + 2
+            tail = '--{}--\r\n'.format(boundary)
+            length += len(tail)
+
+            def multipart():
+                for head, start, stop in parts:
+                    yield head
+                    for chunk in iter_file_range(f, start, stop):
+                        yield chunk
+                    yield '\r\n'
+                yield tail
+
+            rv = response_class(ClosingIterator(multipart(), f.close), status=206, direct_passthrough=True,
+                                mimetype='multipart/byteranges; boundary=' + boundary)
+            rv.content_length = length
+        return set_common_headers(rv)
+
+    rv = response_class(wrap_file(request.environ, f), mimetype=mimetype, direct_passthrough=True)
+    rv.content_length = size
+    return set_common_headers(rv)
+
+
+def is_offloaded(rv):
+    '''return true if the transfer of the response body has been delegated to the front-end'''
+    return any(h in rv.headers for h in OFFLOAD_HEADERS.values())
@@ -22,6 +22,8 @@ class WebantTestCase(unittest.TestCase):
     def tearDownClass(cls):
         es = Elasticsearch(cls.conf['ES_HOSTS'])
         es.indices.delete(cls.conf['ES_INDEXNAME'], ignore=[404])
+        es.indices.delete(cls.conf['ES_INDEXNAME'] + '-counters', ignore=[404])
+        es.indices.delete(cls.conf['ES_INDEXNAME'] + '-refs', ignore=[404])
 
     def setUp(self):
         self.wtc = create_app(self.conf).test_client()
@@ -1,3 +1,6 @@
+import json
+from base64 import urlsafe_b64encode
+
 from webant.test import WebantTestCase
 from nose.tools import eq_
 
@@ -8,3 +11,21 @@ class TestApiArchivant(WebantTestCase):
 
     def test_get_volumes(self):
         eq_(self.wtc.get(self.API_PREFIX + '/volumes/').status_code, 200)
+
+    def test_stored_file_bad_request(self):
+        eq_(self.wtc.get(self.API_PREFIX + '/files/notasha1?size=10').status_code, 400)
+        eq_(self.wtc.get(self.API_PREFIX + '/files/' + 'a' * 40).status_code, 400)
+
+    def test_upload_chunk_bad_request(self):
+        uri = self.API_PREFIX + '/volumes/volume/uploads/0123456789abcdef/chunks/0'
+        eq_(self.wtc.put(uri, data='content').status_code, 400)
+        eq_(self.wtc.put(uri + '?offset=first', data='content').status_code, 400)
+
+    def test_get_volumes_cursor(self):
+        eq_(self.wtc.get(self.API_PREFIX + '/volumes/?cursor=notacursor').status_code, 400)
+        eq_(self.wtc.get(self.API_PREFIX + '/volumes/?from=100000').status_code, 400)
+        # sort values of the wrong number or types
+        forged = urlsafe_b64encode(json.dumps({'after': [{}, 'a', 1]}))
+        eq_(self.wtc.get(self.API_PREFIX + '/volumes/?cursor=' + forged).status_code, 400)
+        offset = urlsafe_b64encode(json.dumps({'from': 100000}))
+        eq_(self.wtc.get(self.API_PREFIX + '/volumes/?cursor=' + offset).status_code, 400)
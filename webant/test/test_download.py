@@ -0,0 +1,156 @@
+from webant.download import make_file_response, resolve_ranges, is_offloaded
+from flask import Flask
+from datetime import datetime
+from StringIO import StringIO
+
+from nose.tools import eq_, ok_
+
+
+CONTENT = ''.join(chr(ord('a') + (i % 26)) for i in range(1000))
+ETAG = '624bffa8a6f90813b7982d0e5b4c1475ebec40e3'
+LAST_MODIFIED = datetime(2017, 1, 1, 12, 0, 0)
+
+
+class TestMakeFileResponse():
+
+    def setUp(self):
+        self.app = Flask(__name__)
+
+    def get(self, headers={}):
+        with self.app.test_request_context('/', headers=headers):
+            rv = make_file_response(StringIO(CONTENT), size=len(CONTENT),
+                                    mimetype='text/plain', filename='test.txt',
+                                    etag=ETAG, last_modified=LAST_MODIFIED)
+            rv.direct_passthrough = False
+            return rv, rv.get_data()
+
+    def test_full(self):
+        rv, data = self.get()
+        eq_(rv.status_code, 200)
+        eq_(data, CONTENT)
+        eq_(rv.headers['Accept-Ranges'], 'bytes')
+        eq_(rv.headers['ETag'], '"{}"'.format(ETAG))
+        ok_(rv.headers['Content-Disposition'].startswith('attachment'))
+
+    def test_if_none_match(self):
+        rv, data = self.get({'If-None-Match': '"{}"'.format(ETAG)})
+        eq_(rv.status_code, 304)
+        eq_(data, '')
+
+    def test_if_none_match_changed(self):
+        rv, _ = self.get({'If-None-Match': '"other"'})
+        eq_(rv.status_code, 200)
+
+    def test_if_modified_since(self):
+        rv, _ = self.get({'If-Modified-Since': 'Sun, 01 Jan 2017 12:00:00 GMT'})
+        eq_(rv.status_code, 304)
+
+    def test_single_range(self):
+        rv, data = self.get({'Range': 'bytes=10-19'})
+        eq_(rv.status_code, 206)
+        eq_(data, CONTENT[10:20])
+        eq_(rv.headers['Content-Range'], 'bytes 10-19/1000')
+        eq_(rv.content_length, 10)
+
+    def test_open_range(self):
+        rv, data = self.get({'Range': 'bytes=990-'})
+        eq_(data, CONTENT[990:])
+        eq_(rv.headers['Content-Range'], 'bytes 990-999/1000')
+
+    def test_suffix_range(self):
+        rv, data = self.get({'Range': 'bytes=-5'})
+        eq_(rv.status_code, 206)
+        eq_(data, CONTENT[-5:])
+
+    def test_multi_range(self):
+        rv, data = self.get({'Range': 'bytes=0-4,10-14'})
+        eq_(rv.status_code, 206)
+        ok_(rv.mimetype.startswith('multipart/byteranges'))
+        eq_(rv.content_length, len(data))
+        ok_('Content-Range: bytes 0-4/1000\r\n\r\n' + CONTENT[0:5] in data)
+        ok_('Content-Range: bytes 10-14/1000\r\n\r\n' + CONTENT[10:15] in data)
+
+    def test_range_file_closed(self):
+        for ranges in ('bytes=10-19', 'bytes=0-4,10-14'):
+            f = StringIO(CONTENT)
+            with self.app.test_request_context('/', headers={'Range': ranges}):
+                rv = make_file_response(f, size=len(CONTENT), etag=ETAG)
+                # what a WSGI server does with a direct passthrough response
+                app_iter = rv.get_app_iter(self.app.test_request_context('/').request.environ)
+                ''.join(app_iter)
+                app_iter.close()
+            ok_(f.closed)
+
+    def test_unsatisfiable_range(self):
+        rv, _ = self.get({'Range': 'bytes=2000-'})
+        eq_(rv.status_code, 416)
+        eq_(rv.headers['Content-Range'], 'bytes */1000')
+
+    def test_if_range_mismatch(self):
+        rv, data = self.get({'Range': 'bytes=10-19', 'If-Range': '"other"'})
+        eq_(rv.status_code, 200)
+        eq_(data, CONTENT)
+
+    def test_if_range_match(self):
+        rv, _ = self.get({'Range': 'bytes=10-19', 'If-Range': '"{}"'.format(ETAG)})
+        eq_(rv.status_code, 206)
+
+    def test_range_not_seekable(self):
+        class Stream(object):
+            def __init__(self):
+                self._f = StringIO(CONTENT)
+                self.read = self._f.read
+                self.close = self._f.close
+
+        with self.app.test_request_context('/', headers={'Range': 'bytes=10-19'}):
+            rv = make_file_response(Stream(), size=len(CONTENT), etag=ETAG)
+            rv.direct_passthrough = False
+            eq_(rv.status_code, 200)
+            eq_(rv.get_data(), CONTENT)
+            eq_(rv.headers['Accept-Ranges'], 'none')
+
+    def test_content_encoding(self):
+        with self.app.test_request_context('/'):
+            rv = make_file_response(StringIO(CONTENT), size=len(CONTENT), etag=ETAG, content_encoding='gzip')
+            eq_(rv.headers['Content-Encoding'], 'gzip')
+            eq_(rv.content_length, len(CONTENT))
+
+
+def test_resolve_ranges():
+    eq_(resolve_ranges([(0, 10), (-5, None), (5, None), (2000, None)], 100),
+        [(0, 10), (95, 100), (5, 100)])
+
+
+class TestOffloadResponse():
+
+    def setUp(self):
+        self.app = Flask(__name__)
+
+    def get(self, offload, headers={}):
+        with self.app.test_request_context('/', headers=headers):
+            return make_file_response(StringIO(CONTENT), size=len(CONTENT),
+                                      mimetype='text/plain', filename='test.txt',
+                                      etag=ETAG, last_modified=LAST_MODIFIED,
+                                      offload=offload)
+
+    def test_x_sendfile(self):
+        rv = self.get(('x-sendfile', '/srv/fsdb/62/4b/ff'))
+        eq_(rv.status_code, 200)
+        eq_(rv.headers['X-Sendfile'], '/srv/fsdb/62/4b/ff')
+        eq_(rv.get_data(), '')
+        ok_(is_offloaded(rv))
+
+    def test_x_accel_redirect(self):
+        rv = self.get(('x-accel-redirect', '/fsdb/62/4b/ff'))
+        eq_(rv.headers['X-Accel-Redirect'], '/fsdb/62/4b/ff')
+        ok_(rv.headers['Content-Disposition'].startswith('attachment'))
+
+    def test_offload_not_modified(self):
+        rv = self.get(('x-sendfile', '/srv/fsdb/62/4b/ff'), {'If-None-Match': '"{}"'.format(ETAG)})
+        eq_(rv.status_code, 304)
+        ok_(not is_offloaded(rv))
+
+    def test_offload_range_left_to_frontend(self):
+        rv = self.get(('x-sendfile', '/srv/fsdb/62/4b/ff'), {'Range': 'bytes=10-19'})
+        eq_(rv.status_code, 200)
+        ok_(is_offloaded(rv))
@@ -1,3 +1,5 @@
+from nose.tools import eq_, ok_
+
 from webant import create_app
 from conf.defaults import get_def_conf
 
@@ -14,3 +16,10 @@ def test_init_debug():
     c = get_def_conf()
     c.update(dict(DEFAULT=True))
     create_app(c)
+
+
+def test_stats():
+    stats = create_app(dict(MEMORY_CACHE_SIZE=1024)).stats
+    ok_(stats['executor'] is None)
+    eq_(stats['content_cache']['hits'], 0)
+    eq_(stats['dedup'], dict(files=0, bytes=0))
@@ -27,3 +27,10 @@ class WebantMainRoutes(WebantTestCase):
                       ), follow_redirects=True)
         eq_(rv.status_code, 200)
         assert 'I am a canary' in rv.data
+
+    def test_download_all_missing_volume(self):
+        eq_(self.wtc.get('/download/notavolume/all').status_code, 404)
+
+    def test_search_deep_page(self):
+        eq_(self.wtc.get('/search?q=*&size=10&page=1000').status_code, 400)
+        eq_(self.wtc.get('/search?q=*&cursor=notacursor').status_code, 400)
@@ -0,0 +1,48 @@
+from webant import create_app
+from flask import request
+from archivant.ingest import SpoolFile, get_spool_dir
+from conf.defaults import get_def_conf
+
+from nose.tools import eq_, ok_
+from tempfile import mkdtemp
+from shutil import rmtree
+from StringIO import StringIO
+import hashlib
+import os
+
+
+class TestSpoolingRequest():
+
+    def setUp(self):
+        self.tmpDir = mkdtemp(prefix='webant_spool_test_')
+        conf = get_def_conf()
+        conf.update({'TESTING': True, 'FSDB_PATH': self.tmpDir})
+        self.app = create_app(conf)
+        self.fsdb = self.app.archivant._fsdb
+
+    def tearDown(self):
+        rmtree(self.tmpDir)
+
+    def upload_context(self, content):
+        return self.app.test_request_context('/add', method='POST',
+                                             data={'file': (StringIO(content), 'test.txt')})
+
+    def test_upload_is_spooled(self):
+        with self.upload_context('some content'):
+            stream = request.files['file'].stream
+            ok_(isinstance(stream, SpoolFile))
+            eq_(stream.size, len('some content'))
+            eq_(stream.hexdigest('sha1'), hashlib.sha1('some content').hexdigest())
+            eq_(len(os.listdir(get_spool_dir(self.fsdb))), 1)
+
+    def test_uncommitted_spool_removed(self):
+        with self.upload_context('some content'):
+            request.files['file']
+        eq_(os.listdir(get_spool_dir(self.fsdb)), [])
+        eq_(len(self.fsdb), 0)
+
+    def test_committed_spool_moved(self):
+        with self.upload_context('some content'):
+            fsdb_id = request.files['file'].stream.commit()
+        eq_(os.listdir(get_spool_dir(self.fsdb)), [])
+        eq_(self.fsdb[fsdb_id].read(), 'some content')
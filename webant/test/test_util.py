@@ -0,0 +1,41 @@
+import json
+from base64 import urlsafe_b64encode
+
+from webant.util import next_cursor, parse_cursor, get_centered_pagination
+from nose.tools import eq_, raises, assert_raises
+
+
+def test_cursor_search_after():
+    cursor = next_cursor([{'sort': [0.5, 'a']}, {'sort': [0.25, 'b']}])
+    eq_(parse_cursor(cursor), {'search_after': [0.25, 'b']})
+
+
+def test_cursor_offset():
+    # without search_after support hits have no sort values
+    cursor = next_cursor([{}, {}], 10)
+    eq_(parse_cursor(cursor), {'from_': 12})
+
+
+def test_cursor_offset_limit():
+    eq_(next_cursor([{}, {}], 10, max_offset=11), None)
+    cursor = next_cursor([{}, {}], 10)
+    eq_(parse_cursor(cursor, max_offset=12), {'from_': 12})
+    assert_raises(ValueError, parse_cursor, cursor, max_offset=11)
+
+
+@raises(ValueError)
+def test_malformed_cursor():
+    parse_cursor('bm90IGEgY3Vyc29y')
+
+
+def test_forged_cursor():
+    for state in ({'after': []}, {'after': [0.5]}, {'after': [0.5, 'a', 'b']},
+                  {'after': ['a', 0.5]}, {'after': [0.5, {}]}, {'after': [True, 'a']},
+                  {'from': -1}, {'from': '10'}, {'from': True}, [0.5, 'a']):
+        cursor = urlsafe_b64encode(json.dumps(state))
+        assert_raises(ValueError, parse_cursor, cursor)
+
+
+def test_centered_pagination():
+    eq_(get_centered_pagination(1, 3), dict(prev=None, first=1, current=1, last=3, next=2))
+    eq_(get_centered_pagination(10, 20), dict(prev=9, first=8, current=10, last=12, next=11))
@@ -0,0 +1,82 @@
+import time
+import gzip
+import hashlib
+import logging
+import tempfile
+from StringIO import StringIO
+
+import gevent
+from nose.tools import eq_, ok_
+
+from archivant.compression import GzipReader
+from webant.webserver_utils import GeventExecutor, LoopMonitor, SendfileWrapper
+
+
+def hash_a_lot(x):
+    data = 'x' * 2**20
+    for _ in range(30):
+        hashlib.sha1(data).hexdigest()
+    return x
+
+
+def test_gevent_executor_order():
+    executor = GeventExecutor()
+    eq_(executor.map(hash_a_lot, range(6), 3), range(6))
+    eq_(executor.stats.as_dict()['tasks'], 6)
+
+
+def test_gevent_executor_error():
+    def func(x):
+        if x == 2:
+            raise ValueError(x)
+        return x
+    try:
+        GeventExecutor().map(func, range(4), 2)
+    except ValueError as e:
+        eq_(e.args, (2,))
+    else:
+        ok_(False, 'an error should have been raised')
+
+
+def test_gevent_executor_keeps_loop_running():
+    ticks = []
+
+    def ticker():
+        while True:
+            ticks.append(time.time())
+            gevent.sleep(0.001)
+
+    t = gevent.spawn(ticker)
+    gevent.sleep(0)
+    start = time.time()
+    GeventExecutor().map(hash_a_lot, range(4), 2)
+    elapsed = time.time() - start
+    t.kill()
+    # the ticker kept running while the work was done in other threads
+    ok_(len([tick for tick in ticks if tick >= start]) > 1, (elapsed, len(ticks)))
+
+
+def test_loop_monitor():
+    monitor = LoopMonitor(logging.getLogger('test'), interval=0.01, threshold=0.05)
+    g = monitor.start()
+    gevent.sleep(0.05)
+    # block the event loop
+    time.sleep(0.1)
+    gevent.sleep(0.05)
+    g.kill()
+    ok_(monitor.stats['checks'] > 0)
+    eq_(monitor.stats['slow'], 1)
+    ok_(monitor.stats['max_blocked'] >= 0.05)
+
+
+def test_sendfile_only_regular_files():
+    with tempfile.NamedTemporaryFile(suffix='.gz') as tmp:
+        with gzip.GzipFile(fileobj=tmp, mode='wb') as gz:
+            gz.write('x' * 100)
+        tmp.flush()
+        with open(tmp.name, 'rb') as f:
+            ok_(SendfileWrapper(f).fileno() is not None)
+        # the decompressed content is not the one of the file descriptor
+        with GzipReader(open(tmp.name, 'rb')) as f:
+            ok_(SendfileWrapper(f).fileno() is None)
+    ok_(SendfileWrapper(StringIO('x')).fileno() is None)
@@ -0,0 +1,87 @@
+from webant import zipstream
+from webant.zipstream import ZipEntry, iter_zip
+from webant.util import unique_name
+from StringIO import StringIO
+from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
+import zlib
+
+from nose.tools import eq_, ok_, raises
+
+
+TEXT = ''.join('line {} of a text\n'.format(i % 50) for i in range(2000))
+BINARY = ''.join(chr(i % 256) for i in range(5000))
+
+
+def make_zip(entries):
+    return ZipFile(StringIO(''.join(iter_zip(entries))))
+
+
+def entry(name, content, **kwargs):
+    return ZipEntry(name, len(content), lambda: StringIO(content), **kwargs)
+
+
+def test_stored_and_deflated():
+    archive = make_zip([entry('text.txt', TEXT, compress=True),
+                        entry('image.jpg', BINARY)])
+    ok_(archive.testzip() is None)
+    eq_(archive.namelist(), ['text.txt', 'image.jpg'])
+    eq_(archive.getinfo('text.txt').compress_type, ZIP_DEFLATED)
+    ok_(archive.getinfo('text.txt').compress_size < len(TEXT))
+    eq_(archive.getinfo('image.jpg').compress_type, ZIP_STORED)
+    eq_(archive.read('text.txt'), TEXT)
+    eq_(archive.read('image.jpg'), BINARY)
+
+
+def test_empty():
+    archive = make_zip([])
+    eq_(archive.namelist(), [])
+
+
+def test_unicode_name():
+    archive = make_zip([entry(u'libro \xe8.txt', TEXT)])
+    eq_(archive.namelist(), [u'libro \xe8.txt'])
+
+
+def test_already_deflated():
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(TEXT) + compressor.flush()
+    f = StringIO('header' + deflated + 'trailer')
+    f.seek(len('header'))
+
+    def open_deflated():
+        return f, zlib.crc32(TEXT) & 0xFFFFFFFF, len(deflated)
+    archive = make_zip([ZipEntry('text.txt', len(TEXT), open=None, open_deflated=open_deflated)])
+    ok_(f.closed)
+    ok_(archive.testzip() is None)
+    eq_(archive.getinfo('text.txt').compress_size, len(deflated))
+    eq_(archive.read('text.txt'), TEXT)
+
+
+def test_already_deflated_fallback():
+    archive = make_zip([entry('text.txt', TEXT, open_deflated=lambda: None)])
+    eq_(archive.read('text.txt'), TEXT)
+
+
+def test_zip64():
+    old = zipstream.ZIP64_LIMIT
+    zipstream.ZIP64_LIMIT = 1000
+    try:
+        archive = make_zip([entry('first', BINARY), entry('second', TEXT, compress=True)])
+    finally:
+        zipstream.ZIP64_LIMIT = old
+    ok_(archive.testzip() is None)
+    eq_(archive.read('first'), BINARY)
+    eq_(archive.read('second'), TEXT)
+
+
+@raises(IOError)
+def test_size_mismatch():
+    list(iter_zip([ZipEntry('short', 10, lambda: StringIO('12345'))]))
+
+
+def test_unique_name():
+    names = set()
+    eq_(unique_name('book.pdf', names), 'book.pdf')
+    eq_(unique_name('book.pdf', names), 'book (1).pdf')
+    eq_(unique_name('../etc/passwd', names), '_etc_passwd')
+    eq_(unique_name('', names), 'attachment')
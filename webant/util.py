@@ -1,5 +1,20 @@
+import os
+import json
 import functools
-from flask import send_file
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from contextlib import closing
+import gevent
+import gevent.monkey
+from datetime import datetime
+from urlparse import urlparse
+from cStringIO import StringIO
+from flask import Request, current_app, request
+from werkzeug.datastructures import iter_multi_items
+
+from archivant.ingest import SpoolFile
+from archivant.compression import GZIP, is_compressible, deflate_member
+from download import make_file_response, is_offloaded
+from zipstream import ZipEntry, iter_zip
 
 
 def memoize(obj):
@@ -41,13 +56,190 @@ def requestedFormat(request,acceptedFormat):
 
 
 def send_attachment_file(archivant, volumeID, attachmentID):
-    f = archivant.get_file(volumeID, attachmentID)
-    attachment = archivant.get_attachment(volumeID, attachmentID)
-    archivant._db.increment_download_count(volumeID, attachmentID)
-    return send_file(f,
-                     mimetype=attachment['metadata']['mime'],
-                     attachment_filename=attachment['metadata']['name'],
-                     as_attachment=True)
+    '''send the file of an attachment as response to the current request
+
+       The sha1 of the attachment is used as ETag, conditional
+       and byte range requests are supported.
+       If `DOWNLOAD_OFFLOAD` is configured the transfer of files stored in fsdb
+       is delegated to the front-end web server, otherwise frequently requested
+       small files are served from the content cache of the app, if any.
+       Files stored compressed are sent as they are, with a `Content-Encoding` header,
+       to clients accepting their encoding, and decompressed on the fly to the others.
+       The download counter is incremented only for whole file transfers,
+       without waiting for the update to complete.
+    '''
+    attachment = archivant.get_attachment(volumeID, attachmentID, download_count=False)
+    metadata = attachment['metadata']
+    local = urlparse(attachment['url']).scheme == 'fsdb'
+    encoding = metadata.get('content_encoding')
+    # the stored content is sent only if its size is known
+    passthrough = local and encoding is not None and 'Range' not in request.headers and \
+        request.accept_encodings[encoding] > 0
+    size = metadata['size']
+    etag = key = metadata.get('sha1')
+    cache = getattr(current_app, 'contentCache', None)
+    if key is None or passthrough or \
+            (local and encoding is None and current_app.config.get('DOWNLOAD_OFFLOAD')):
+        cache = None
+    entry = cache.get(key) if cache is not None else None
+    if entry is not None:
+        content, lastModified = entry
+        f, offload = StringIO(content), None
+    else:
+        f = archivant.open_attachment_file(attachment, decode_content=not passthrough)
+        lastModified = offload = None
+        if local:
+            # decoded contents have no file descriptor
+            lastModified = datetime.utcfromtimestamp(os.stat(f.name).st_mtime)
+            if encoding is None:
+                offload = get_offload(archivant, f.name)
+        if passthrough:
+            size = os.fstat(f.fileno()).st_size
+            if etag is not None:
+                etag = '{}-{}'.format(etag, encoding)
+        if cache is not None and cache.admits(key, metadata['size']):
+            with closing(f):
+                content = f.read()
+            if len(content) == metadata['size']:
+                cache.put(key, content, lastModified)
+            f = StringIO(content)
+    rv = make_file_response(f,
+                            size=size,
+                            mimetype=metadata['mime'],
+                            filename=metadata['name'],
+                            etag=etag,
+                            last_modified=lastModified,
+                            offload=offload,
+                            content_encoding=encoding if passthrough else None)
+    if encoding is not None:
+        rv.vary.add('Accept-Encoding')
+    if rv.status_code == 200 and not (is_offloaded(rv) and 'Range' in request.headers):
+        run_in_background(archivant.increment_download_count, volumeID, attachmentID)
+    return rv
+
+
+def send_volume_archive(archivant, volumeID):
+    '''send all the attachments of a volume as a ZIP archive built while it is sent
+
+       Contents of a compressible type are deflated, the others are stored as they are.
+       Contents stored gzip compressed in fsdb are added without being compressed again.
+       A download of each attachment is counted, with a single update of the counters.
+    '''
+    volume = archivant.get_volume(volumeID, download_count=False)
+    attachments = volume['attachments']
+    insertionDate = volume['metadata'].get('_insertion_date')
+    mtime = insertionDate / 1000.0 if insertionDate else None
+    names = set()
+    entries = []
+    for attachment in attachments:
+        name = unique_name(attachment['metadata']['name'], names)
+        entries.append(make_zip_entry(archivant, attachment, name, mtime))
+    rv = current_app.response_class(iter_zip(entries), mimetype='application/zip', direct_passthrough=True)
+    rv.headers.add('Content-Disposition', 'attachment', filename='{}.zip'.format(volumeID))
+    if attachments:
+        run_in_background(archivant.increment_download_counts, volumeID, [a['id'] for a in attachments])
+    return rv
+
+
+def unique_name(name, names):
+    '''return a name for a file of an archive, different from the ones in `names`, and add it there'''
+    name = (name or 'attachment').replace('/', '_').replace('\\', '_').lstrip('.') or 'attachment'
+    base, ext = os.path.splitext(name)
+    candidate = name
+    n = 1
+    while candidate in names:
+        candidate = '{} ({}){}'.format(base, n, ext)
+        n += 1
+    names.add(candidate)
+    return candidate
+
+
+def make_zip_entry(archivant, attachment, name, mtime=None):
+    '''return the :py:class:`~webant.zipstream.ZipEntry` of an attachment'''
+    metadata = attachment['metadata']
+    openDeflated = None
+    if urlparse(attachment['url']).scheme == 'fsdb' and metadata.get('content_encoding') == GZIP:
+        def openDeflated():
+            f = archivant.open_attachment_file(attachment, decode_content=False)
+            member = deflate_member(f, os.fstat(f.fileno()).st_size)
+            if member is None:
+                f.close()
+                return None
+            crc, offset, length = member
+            f.seek(offset)
+            return f, crc, length
+    return ZipEntry(name, metadata['size'],
+                    open=lambda: archivant.open_attachment_file(attachment),
+                    compress=is_compressible(metadata.get('mime'), metadata['name']),
+                    mtime=mtime,
+                    open_deflated=openDeflated)
+
+
+def run_in_background(func, *args, **kwargs):
+    '''run `func` without waiting for its completion
+
+       The function is run in a new greenlet when the server runs on gevent
+       (see :py:func:`~webant.webserver_utils.gevent_run`), otherwise it is run synchronously.
+       Exceptions are logged and never propagated.
+    '''
+    logger = current_app.logger
+
+    def wrapper():
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            logger.exception("error in background task: {}".format(func.__name__))
+
+    if 'socket' in getattr(gevent.monkey, 'saved', {}):
+        gevent.spawn(wrapper)
+    else:
+        wrapper()
+
+
+def get_offload(archivant, path):
+    '''return the offload parameter for :py:func:`~webant.download.make_file_response`
+
+       according to the `DOWNLOAD_OFFLOAD` configuration of the current app
+    '''
+    mode = current_app.config.get('DOWNLOAD_OFFLOAD')
+    if not mode:
+        return None
+    if mode == 'x-accel-redirect':
+        prefix = current_app.config['DOWNLOAD_OFFLOAD_PREFIX'].rstrip('/')
+        roots = [shard.fsdbRoot for shard in getattr(archivant._fsdb, 'shards', [])]
+        if roots:
+            # sharded storage: each root is mapped onto prefix/<index of the root>
+            index, root = next((i, r) for i, r in enumerate(roots) if path.startswith(r + os.sep))
+            prefix = '{}/{}'.format(prefix, index)
+        else:
+            root = archivant._fsdb.fsdbRoot
+        relPath = os.path.relpath(path, root)
+        return mode, prefix + '/' + relPath.replace(os.sep, '/')
+    return mode, path
+
+
+class SpoolingRequest(Request):
+    '''Request that streams uploaded files directly into fsdb
+
+       Multipart file parts are written into a :py:class:`~archivant.ingest.SpoolFile`
+       while the request body is parsed, so that they are hashed on the fly
+       and can be moved into the fsdb tree without any further copy.
+       Spooled files that have not been committed are removed
+       when the request is closed.
+    '''
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if current_app.archivant.is_file_op_supported():
+            return current_app.archivant.spool_file()
+        return super(SpoolingRequest, self)._get_file_stream(total_content_length, content_type,
+                                                             filename=filename, content_length=content_length)
+
+    def close(self):
+        files = self.__dict__.get('files', ())
+        for _, upFile in iter_multi_items(files):
+            if isinstance(upFile.stream, SpoolFile) and not upFile.stream.committed:
+                upFile.stream.discard()
+        super(SpoolingRequest, self).close()
 
 
 def routes_collector(gatherer):
@@ -96,6 +288,53 @@ def add_routes(fapp, routes, prefix=""):
         fapp.add_url_rule(**r)
 
 
+def next_cursor(hits, from_=0, max_offset=None):
+    '''return an opaque cursor pointing to the search results that follow `hits`
+
+       `hits` must have been returned by :py:meth:`libreantdb.DB.get_books_querystring`
+       starting from offset `from_`, or from a cursor (in that case `from_` is 0).
+       When elasticsearch does not support `search_after`, the cursor holds an offset:
+       None is returned if it would be greater than `max_offset`.
+    '''
+    last = hits[-1]
+    if 'sort' in last:
+        state = {'after': last['sort']}
+    else:
+        state = {'from': from_ + len(hits)}
+        if max_offset is not None and state['from'] > max_offset:
+            return None
+    return urlsafe_b64encode(json.dumps(state, separators=(',', ':')))
+
+
+def _is_sort_value(value, types):
+    return isinstance(value, types) and not isinstance(value, bool)
+
+
+def parse_cursor(cursor, max_offset=None):
+    '''return the arguments of :py:meth:`libreantdb.DB.get_books_querystring`
+       that fetch the results pointed by a cursor made by :py:func:`next_cursor`
+
+       Raises ValueError if the cursor is malformed,
+       or if it holds an offset greater than `max_offset`.
+    '''
+    try:
+        state = json.loads(urlsafe_b64decode(cursor.encode('ascii')))
+    except (TypeError, UnicodeError):
+        raise ValueError('malformed cursor')
+    if not isinstance(state, dict):
+        raise ValueError('malformed cursor')
+    after = state.get('after')
+    # sort values of the last hit: its score and id
+    if isinstance(after, list) and len(after) == 2 and \
+            _is_sort_value(after[0], (int, long, float)) and _is_sort_value(after[1], basestring):
+        return {'search_after': after}
+    if _is_sort_value(state.get('from'), (int, long)) and state['from'] >= 0:
+        if max_offset is not None and state['from'] > max_offset:
+            raise ValueError('cursor points past the last available result')
+        return {'from_': state['from']}
+    raise ValueError('malformed cursor')
+
+
 def get_centered_pagination(current, total, visible=5):
     ''' Return the range of pages to render in a pagination menu.
 
@@ -1,6 +1,4 @@
-import tempfile
-import os
-
+import gevent
 from flask import Flask, render_template, request, Response, redirect, url_for
 from werkzeug import secure_filename
 from flask_bootstrap import Bootstrap
@@ -12,19 +10,30 @@ from logging import getLogger
 
 from presets import PresetManager
 from constants import isoLangs
-from util import requestedFormat, send_attachment_file
+from util import requestedFormat, send_attachment_file, send_volume_archive, SpoolingRequest
+from download import OFFLOAD_HEADERS
 from archivant import Archivant
+from archivant.contentcache import ContentCache
 from archivant.exceptions import NotFoundException, FileOpNotSupported
 from agherant import agherant
 from api.blueprint_api import get_blueprint_api
-from webserver_utils import gevent_run
+from webserver_utils import gevent_run, GeventExecutor, LoopMonitor
 import users
 from . import util
 from . import auth
 from authbone.authorization import CapabilityMissingException
 
 
+# fields of the volumes used by the templates listing them,
+# only these are requested to elasticsearch
+LIST_FIELDS = ['title', 'actors', '_language', '_attachments.id']
+RECENTS_FIELDS = LIST_FIELDS + ['_insertion_date']
+SIMILAR_FIELDS = ['title', 'actors']
+
+
 class LibreantCoreApp(Flask):
+    request_class = SpoolingRequest
+
     def __init__(self, import_name, conf={}):
         super(LibreantCoreApp, self).__init__(import_name)
         defaults = {
@@ -35,20 +44,68 @@ class LibreantCoreApp(Flask):
             'ES_INDEXNAME': 'libreant',
             'USERS_DATABASE': "",
             'PWD_ROUNDS': None,
-            'PWD_SALT_SIZE': None
+            'PWD_SALT_SIZE': None,
+            'DOWNLOAD_OFFLOAD': None,
+            'DOWNLOAD_OFFLOAD_PREFIX': '/fsdb',
+            'DOWNLOAD_COUNT_FLUSH_INTERVAL': 5,
+            'DOWNLOAD_COUNT_JOURNAL': None,
+            'GC_GRACE_PERIOD': 3600,
+            'OBJECT_STORE': None,
+            'OBJECT_CACHE_PATH': None,
+            'OBJECT_CACHE_SIZE': 10 * 2**30,
+            'COMPRESS_ATTACHMENTS': False,
+            'INGEST_CONCURRENCY': 4,
+            'UPLOAD_EXPIRE': 24 * 3600,
+            'QUERY_CACHE_SIZE': 0,
+            'QUERY_CACHE_TTL': 60,
+            'SIMILAR_CACHE_SIZE': 1000,
+            'SIMILAR_CACHE_TTL': 3600,
+            'EVENT_LOOP_BLOCK_THRESHOLD': 0.5,
+            'STATS_LOG_INTERVAL': 3600,
+            'MEMORY_CACHE_SIZE': 0,
+            'MEMORY_CACHE_MAX_FILE_SIZE': 2 * 2**20,
+            'MEMORY_CACHE_MIN_HITS': 2
         }
         defaults.update(conf)
         self.config.update(defaults)
 
+        if self.config['DOWNLOAD_OFFLOAD'] and self.config['DOWNLOAD_OFFLOAD'] not in OFFLOAD_HEADERS:
+            raise ValueError("DOWNLOAD_OFFLOAD must be one of {}".format(OFFLOAD_HEADERS.keys()))
+
         '''dirty trick: prevent default flask handler to be created
            in flask version > 0.10.1 will be a nicer way to disable default loggers
            tanks to this new code mitsuhiko/flask@84ad89ffa4390d3327b4d35983dbb4d84293b8e2
         '''
         self._logger = getLogger(self.import_name)
 
-        self.archivant = Archivant(conf={k: self.config[k] for k in ('FSDB_PATH', 'ES_HOSTS', 'ES_INDEXNAME')})
+        self.archivant = Archivant(conf={k: self.config[k] for k in ('FSDB_PATH', 'ES_HOSTS', 'ES_INDEXNAME',
+                                                                      'DOWNLOAD_COUNT_FLUSH_INTERVAL',
+                                                                      'DOWNLOAD_COUNT_JOURNAL',
+                                                                      'GC_GRACE_PERIOD',
+                                                                      'OBJECT_STORE',
+                                                                      'OBJECT_CACHE_PATH',
+                                                                      'OBJECT_CACHE_SIZE',
+                                                                      'COMPRESS_ATTACHMENTS',
+                                                                      'INGEST_CONCURRENCY',
+                                                                      'UPLOAD_EXPIRE',
+                                                                      'QUERY_CACHE_SIZE',
+                                                                      'QUERY_CACHE_TTL',
+                                                                      'SIMILAR_CACHE_SIZE',
+                                                                      'SIMILAR_CACHE_TTL')})
         self.presetManager = PresetManager(self.config['PRESET_PATHS'])
 
+        # set when running on gevent, see main()
+        self.executor = None
+        self.loopMonitor = None
+        # runs a function in the background
+        self.spawn = None
+
+        self.contentCache = None
+        if self.config['MEMORY_CACHE_SIZE']:
+            self.contentCache = ContentCache(self.config['MEMORY_CACHE_SIZE'],
+                                             max_item_size=self.config['MEMORY_CACHE_MAX_FILE_SIZE'],
+                                             min_hits=self.config['MEMORY_CACHE_MIN_HITS'])
+
         if self.config['USERS_DATABASE']:
             self.usersDB = users.init_db(self.config['USERS_DATABASE'],
                                          pwd_salt_size=self.config['PWD_SALT_SIZE'],
@@ -63,6 +120,18 @@ all operations about users will be unsupported. Are all admins.""")
     def users_enabled(self):
         return bool(self.usersDB)
 
+    @property
+    def stats(self):
+        '''statistics of the event loop, executor and caches, None for the disabled ones'''
+        return {
+            'event_loop': dict(self.loopMonitor.stats) if self.loopMonitor is not None else None,
+            'executor': self.executor.stats.as_dict() if self.executor is not None else None,
+            'content_cache': self.contentCache.stats if self.contentCache is not None else None,
+            'query_cache': self.archivant.query_cache_stats,
+            'similar_cache': self.archivant.similar_cache_stats,
+            'dedup': self.archivant.dedup_stats
+        }
+
 
 class LibreantViewApp(LibreantCoreApp):
     def __init__(self, import_name, conf={}):
@@ -71,7 +140,8 @@ class LibreantViewApp(LibreantCoreApp):
             'AGHERANT_DESCRIPTIONS': [],
             'API_URL': '/api/v1',
             'RESULTS_PER_PAGE': 30,
-            'MAX_RESULTS_PER_PAGE': 100
+            'MAX_RESULTS_PER_PAGE': 100,
+            'SEARCH_CURSOR_THRESHOLD': 1000
         }
         defaults.update(conf)
         super(LibreantViewApp, self).__init__(import_name, defaults)
@@ -117,14 +187,38 @@ def create_app(conf={}):
         if(size < 1 or size > app.config['MAX_RESULTS_PER_PAGE']):
             return renderErrorPage(message='Invalid size number', httpCode=400)
 
-        from_ = (page-1)*size
-        res = app.archivant._db.get_books_querystring(query, from_=from_, size=size)
+        # without search_after support cursors hold offsets, bounded like pages
+        maxOffset = app.config['SEARCH_CURSOR_THRESHOLD'] - size
+        cursor = request.args.get('cursor')
+        if cursor is not None:
+            try:
+                searchArgs = util.parse_cursor(cursor, maxOffset)
+            except ValueError:
+                return renderErrorPage(message='Invalid cursor', httpCode=400)
+            from_ = searchArgs.get('from_', 0)
+        else:
+            from_ = (page-1)*size
+            searchArgs = {'from_': from_}
+        # pages past the threshold are reached following cursors,
+        # so that elasticsearch does not have to collect all the previous results
+        lastOffsetPage = max(1, app.config['SEARCH_CURSOR_THRESHOLD'] / size)
+        if cursor is None and page > lastOffsetPage:
+            return renderErrorPage(message='Page number too high, maximum is {}'.format(lastOffsetPage), httpCode=400)
+        res = app.archivant._db.get_books_querystring(query, size=size, includes=LIST_FIELDS, **searchArgs)
         totalRes = res['hits']['total']
         totalPages = (totalRes == 0) + totalRes/size + (totalRes % size > 0)
         if(page > totalPages):
             return renderErrorPage(message='Page number too high, maximum is {}'.format(totalPages), httpCode=400)
-        pagination=util.get_centered_pagination(current=page, total=totalPages)
-        if pagination['first']  == pagination['last']:
+        if cursor is None:
+            pagination = util.get_centered_pagination(current=page, total=min(totalPages, lastOffsetPage))
+        else:
+            pagination = dict(prev=None, first=page, current=page, last=page, next=None)
+        pagination['next_url'] = None
+        if (cursor is not None or page == lastOffsetPage) and page < totalPages and res['hits']['hits']:
+            nextCursor = util.next_cursor(res['hits']['hits'], from_, maxOffset)
+            if nextCursor is not None:
+                pagination['next_url'] = url_for('search', q=query, size=size, page=page+1, cursor=nextCursor)
+        if pagination['first'] == pagination['last'] and pagination['next_url'] is None:
             pagination = None
         res = res['hits']['hits']
         books = []
@@ -176,16 +270,11 @@ def create_app(conf={}):
 
         attachments = []
         for upName, upFile in request.files.items():
-            tmpFileFd, tmpFilePath = tempfile.mkstemp()
-            upFile.save(tmpFilePath)
             fileInfo = {}
-            fileInfo['file'] = tmpFilePath
+            fileInfo['file'] = upFile.stream
             fileInfo['name'] = secure_filename(upFile.filename)
             fileInfo['mime'] = upFile.mimetype
             fileInfo['notes'] = request.form[upName + '_notes']
-            # close fileDescriptor
-            os.close(tmpFileFd)
-
             attachments.append(fileInfo)
 
         try:
@@ -193,10 +282,6 @@ def create_app(conf={}):
         except Exception as e:
             app.logger.exception(e)
             return renderErrorPage(str(e), 500)
-        finally:
-            # remove temp files
-            for a in attachments:
-                os.remove(a['file'])
         return redirect(url_for('view_volume', volumeID=addedVolumeID))
 
     @app.route('/add', methods=['GET'])
@@ -260,13 +345,22 @@ def create_app(conf={}):
             hideFromToolbar = {}
             hideFromToolbar['delete'] = not app.autht.currIdentity.can(currentDomain, users.Action.DELETE)
             hideFromToolbar['edit'] = not app.autht.currIdentity.can(currentDomain, users.Action.UPDATE)
-        similar = app.archivant._db.mlt(volume['id'])['hits']['hits'][:10]
+        # on gevent, expired similar volumes are refreshed after the page is sent
+        similar = app.archivant._db.similar_books(volume['id'], size=10, includes=SIMILAR_FIELDS,
+                                                  spawn=app.spawn)
         return render_template('details.html',
                                volume=volume,
                                similar=similar,
                                hide_from_toolbar=hideFromToolbar,
                                api_url=app.config['API_URL'])
 
+    @app.route('/download/<volumeID>/all')
+    def download_volume(volumeID):
+        try:
+            return send_volume_archive(app.archivant, volumeID)
+        except NotFoundException:
+            return renderErrorPage(message='no volume found with id "{}"'.format(volumeID), httpCode=404)
+
     @app.route('/download/<volumeID>/<attachmentID>')
     def download_attachment(volumeID, attachmentID):
         try:
@@ -277,7 +371,7 @@ def create_app(conf={}):
 
     @app.route('/recents')
     def recents():
-        res = app.archivant._db.get_last_inserted()['hits']['hits']
+        res = app.archivant._db.get_last_inserted(includes=RECENTS_FIELDS)['hits']['hits']
         return render_template('recents.html', items=res)
 
     @app.babel.localeselector
@@ -366,9 +460,55 @@ def renderErrorPage(message, httpCode):
     return render_template('error.html', message=message, code=httpCode), httpCode
 
 
+def log_stats_periodically(app):
+    interval = app.config['STATS_LOG_INTERVAL']
+    while True:
+        gevent.sleep(interval)
+        for name, stats in sorted(app.stats.items()):
+            if stats is not None:
+                app.logger.info('%s stats: %s', name, ', '.join('{}={}'.format(k, v) for k, v in sorted(stats.items())))
+
+
+def expire_uploads_periodically(app):
+    # a session is removed at most this late after its expiration
+    interval = min(app.config['UPLOAD_EXPIRE'], 3600) or 1
+    while True:
+        gevent.sleep(interval)
+        try:
+            app.archivant.expire_uploads()
+        except Exception:
+            app.logger.exception('error while removing expired uploads')
+
+
+def flush_download_counts_periodically(app):
+    interval = app.config['DOWNLOAD_COUNT_FLUSH_INTERVAL'] or 1
+    while True:
+        gevent.sleep(interval)
+        try:
+            app.archivant.flush_download_counts()
+        except Exception:
+            app.logger.exception('error while flushing download counters')
+
+
 def main(conf={}):
     app = create_app(conf)
-    gevent_run(app)
+    app.spawn = gevent.spawn
+    # keep hashing and storing uploaded files out of the event loop
+    app.executor = GeventExecutor()
+    app.archivant.set_executor(app.executor)
+    greenlets = [gevent.spawn(flush_download_counts_periodically, app)]
+    if app.archivant.is_file_op_supported():
+        greenlets.append(gevent.spawn(expire_uploads_periodically, app))
+    if app.config['EVENT_LOOP_BLOCK_THRESHOLD'] is not None:
+        app.loopMonitor = LoopMonitor(app.logger, threshold=app.config['EVENT_LOOP_BLOCK_THRESHOLD'])
+        greenlets.append(app.loopMonitor.start())
+    if app.config['STATS_LOG_INTERVAL']:
+        greenlets.append(gevent.spawn(log_stats_periodically, app))
+    try:
+        gevent_run(app)
+    finally:
+        gevent.killall(greenlets)
+        app.archivant.flush_download_counts()
 
 
 if __name__ == '__main__':
@@ -1,6 +1,160 @@
 '''
 This module provides some function to make running a webserver a little easier
 '''
+import os
+import stat
+import errno
+import time
+
+from archivant.executors import TaskStats, collect
+
+try:
+    from os import sendfile
+except ImportError:
+    try:
+        # python2 backport provided by the pysendfile package
+        from sendfile import sendfile
+    except ImportError:
+        sendfile = None
+
+
+class SendfileWrapper(object):
+    '''`wsgi.file_wrapper` that marks file responses suitable for sendfile
+
+       When iterated it behaves like the standard file wrapper,
+       servers that recognize it can transfer the file with sendfile.
+       Only regular files are sent that way: the content of other readable
+       objects, e.g. decompressed or streamed from the network, is not the one
+       of their file descriptor.
+    '''
+
+    def __init__(self, f, block_size=8192):
+        self.file = f
+        self.block_size = block_size
+
+    def fileno(self):
+        '''return the file descriptor of the wrapped object if it is a regular file, None otherwise'''
+        if not isinstance(self.file, file):
+            return None
+        try:
+            fd = self.file.fileno()
+            if stat.S_ISREG(os.fstat(fd).st_mode):
+                return fd
+        except (OSError, IOError, ValueError):
+            pass
+        return None
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        data = self.file.read(self.block_size)
+        if data:
+            return data
+        raise StopIteration()
+
+    __next__ = next
+
+    def close(self):
+        if hasattr(self.file, 'close'):
+            self.file.close()
+
+
+def get_sendfile_handler():
+    '''return a gevent WSGIHandler that sends file responses with sendfile'''
+    from gevent.pywsgi import WSGIHandler
+    from gevent.socket import wait_write
+
+    class SendfileWSGIHandler(WSGIHandler):
+
+        def get_environ(self):
+            env = super(SendfileWSGIHandler, self).get_environ()
+            env['wsgi.file_wrapper'] = SendfileWrapper
+            return env
+
+        def process_result(self):
+            wrapper = self.result
+            length = getattr(self, 'provided_content_length', None)
+            if not isinstance(wrapper, SendfileWrapper) or wrapper.fileno() is None \
+                    or length is None or self.headers_sent:
+                return super(SendfileWSGIHandler, self).process_result()
+            # send the headers only, then let the kernel copy the file into the socket
+            self.write(b'')
+            sockFd = self.socket.fileno()
+            offset = wrapper.file.tell()
+            remaining = int(length)
+            while remaining > 0:
+                try:
+                    sent = sendfile(sockFd, wrapper.fileno(), offset, remaining)
+                except (OSError, IOError) as e:
+                    if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        wait_write(sockFd)
+                        continue
+                    raise
+                if sent == 0:
+                    break
+                offset += sent
+                remaining -= sent
+                self.response_length += sent
+
+    return SendfileWSGIHandler
+
+
+class GeventExecutor(object):
+    '''run blocking functions in the native threads of the gevent hub threadpool
+
+       The calling greenlet waits for them without blocking the event loop,
+       see :py:mod:`archivant.executors`.
+       Statistics about the executed tasks are kept in :py:attr:`stats`.
+    '''
+
+    def __init__(self):
+        self.stats = TaskStats()
+
+    def map(self, func, items, concurrency):
+        import gevent
+        from gevent.pool import Pool
+        threadpool = gevent.get_hub().threadpool
+        timed = self.stats.timed(func)
+        pool = Pool(max(concurrency, 1))
+        greenlets = [pool.spawn(threadpool.apply, timed, (item,)) for item in items]
+        gevent.joinall(greenlets, raise_error=True)
+        return collect([g.value for g in greenlets])
+
+
+class LoopMonitor(object):
+    '''measure how long the gevent event loop stays blocked
+
+       A greenlet wakes up every `interval` seconds: the delay of each wake up
+       is time in which no other greenlet could run. Delays longer than
+       `threshold` seconds are logged, totals are kept in :py:attr:`stats`.
+    '''
+
+    def __init__(self, logger, interval=0.1, threshold=0.5):
+        self.logger = logger
+        self.interval = interval
+        self.threshold = threshold
+        self.stats = dict(checks=0, blocked=0.0, max_blocked=0.0, slow=0)
+
+    def check(self, delay):
+        self.stats['checks'] += 1
+        self.stats['blocked'] += delay
+        self.stats['max_blocked'] = max(self.stats['max_blocked'], delay)
+        if delay >= self.threshold:
+            self.stats['slow'] += 1
+            self.logger.warning('event loop blocked for {:.3f}s'.format(delay))
+
+    def run(self):
+        import gevent
+        while True:
+            start = time.time()
+            gevent.sleep(self.interval)
+            self.check(max(time.time() - start - self.interval, 0))
+
+    def start(self):
+        '''start monitoring in a new greenlet, that is returned'''
+        import gevent
+        return gevent.spawn(self.run)
 
 
 def gevent_run(app):
@@ -23,6 +177,9 @@ def gevent_run(app):
         #starting from gevent version 1.1b1 we can pass custom logger to gevent
         if version_info[:2] >= (1,1):
             server_params['log'] = logger
+        # without a front-end server taking care of file transfers, use sendfile if available
+        if sendfile is not None and not app.config.get('DOWNLOAD_OFFLOAD'):
+            server_params['handler_class'] = get_sendfile_handler()
         http_server = WSGIServer((address, port), run_app, **server_params)
         http_server.serve_forever()
 
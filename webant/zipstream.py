@@ -0,0 +1,176 @@
+'''
+This module builds ZIP archives on the fly, so that many files can be
+sent in a single response without assembling the archive in memory
+or in a temporary file.
+
+Checksums and compressed sizes are computed while the content is sent,
+so they are written in a data descriptor after each entry, unless the
+content is already deflated and its checksum is known in advance.
+Entries and archives bigger than 4 GiB use the ZIP64 extensions.
+'''
+import time
+import zlib
+import struct
+from contextlib import closing
+
+from download import BLOCK_SIZE
+
+
+STORED = 0
+DEFLATED = 8
+
+# sizes and offsets from this value on need the ZIP64 extensions
+ZIP64_LIMIT = 0xFFFFFFFF
+# deflated content can be slightly bigger than the original one
+DEFLATE_MARGIN = 2**20
+
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+
+# regular file, rw-r--r--
+EXTERNAL_ATTR = 0100644 << 16
+
+
+class ZipEntry(object):
+    '''A file of the archive
+
+       :param name: name of the file inside the archive
+       :param size: size of the uncompressed content
+       :param open: function returning a readable object with the content
+       :param compress: if True the content is deflated, otherwise it is stored as it is
+       :param mtime: timestamp of the last modification of the file
+       :param open_deflated: optional function returning a tuple (f, crc32, length) when the content
+                             is already available deflated, as the next `length` bytes of `f`,
+                             or None to fall back to `open`.
+    '''
+
+    def __init__(self, name, size, open, compress=False, mtime=None, open_deflated=None):
+        self.name = name
+        self.size = size
+        self.open = open
+        self.compress = compress
+        self.mtime = mtime
+        self.open_deflated = open_deflated
+
+
+def dos_date_time(timestamp):
+    '''return the MS-DOS (date, time) of `timestamp` used in zip headers'''
+    t = time.localtime(timestamp if timestamp is not None else time.time())
+    if t.tm_year < 1980:
+        return (0 << 9) | (1 << 5) | 1, 0
+    date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return date, (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+
+
+def iter_zip(entries, block_size=BLOCK_SIZE):
+    '''iterate over the content of a ZIP archive holding the given :py:class:`ZipEntry` objects
+
+       Files are opened only when their turn comes, and closed right after.
+       If the size of a content does not match the one declared by its entry
+       an IOError is raised, since the archive would be corrupted.
+    '''
+    offset = 0
+    records = []
+    for entry in entries:
+        with closing(iter_entry(entry, offset, records, block_size)) as chunks:
+            for chunk in chunks:
+                offset += len(chunk)
+                yield chunk
+    directory = ''.join(central_header(*record) for record in records)
+    yield directory + end_records(len(records), len(directory), offset)
+
+
+def iter_entry(entry, offset, records, block_size=BLOCK_SIZE):
+    '''iterate over the local header, content and data descriptor of `entry`
+
+       The record needed to write its central directory header is appended to `records`.
+    '''
+    name = entry.name.encode('utf-8') if isinstance(entry.name, unicode) else entry.name
+    date, dosTime = dos_date_time(entry.mtime)
+    deflated = entry.open_deflated() if entry.open_deflated is not None else None
+    if deflated is not None:
+        f, crc, csize = deflated
+        method = DEFLATED
+        flags = FLAG_UTF8
+        zip64 = entry.size >= ZIP64_LIMIT or csize >= ZIP64_LIMIT
+    else:
+        f = entry.open()
+        method = DEFLATED if entry.compress else STORED
+        flags = FLAG_UTF8 | FLAG_DATA_DESCRIPTOR
+        # crc and sizes are written in the data descriptor
+        crc = csize = 0
+        zip64 = entry.size >= ZIP64_LIMIT - (DEFLATE_MARGIN if entry.compress else 0)
+    size = entry.size if deflated is not None else 0
+    version = 45 if zip64 else 20
+    with closing(f):
+        extra = ''
+        if zip64:
+            extra = struct.pack('<HHQQ', 1, 16, size, csize)
+            headerSizes = (0xFFFFFFFF, 0xFFFFFFFF)
+        else:
+            headerSizes = (csize, size)
+        yield struct.pack('<IHHHHHIIIHH', 0x04034b50, version, flags, method, dosTime, date,
+                          crc, headerSizes[0], headerSizes[1], len(name), len(extra)) + name + extra
+
+        if deflated is not None:
+            remaining = csize
+            while remaining > 0:
+                chunk = f.read(min(block_size, remaining))
+                if not chunk:
+                    raise IOError("content of '{}' is shorter than expected".format(entry.name))
+                remaining -= len(chunk)
+                yield chunk
+        else:
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS) \
+                if method == DEFLATED else None
+            while True:
+                chunk = f.read(block_size)
+                if not chunk:
+                    break
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+                if compressor is not None:
+                    chunk = compressor.compress(chunk)
+                csize += len(chunk)
+                if chunk:
+                    yield chunk
+            if compressor is not None:
+                chunk = compressor.flush()
+                csize += len(chunk)
+                yield chunk
+            crc &= 0xFFFFFFFF
+            if size != entry.size:
+                raise IOError("size of '{}' is {} instead of {}".format(entry.name, size, entry.size))
+            if zip64:
+                yield struct.pack('<IIQQ', 0x08074b50, crc, csize, size)
+            else:
+                yield struct.pack('<IIII', 0x08074b50, crc, csize, size)
+    records.append((name, version, flags, method, dosTime, date, crc, csize, size, offset))
+
+
+def central_header(name, version, flags, method, dosTime, date, crc, csize, size, offset):
+    '''return the central directory header of an entry'''
+    # fields that do not fit are moved, in this order, into the zip64 extra field
+    extraFields = [v for v in (size, csize, offset) if v >= ZIP64_LIMIT]
+    extra = ''
+    if extraFields:
+        version = 45
+        extra = struct.pack('<HH', 1, 8 * len(extraFields)) + \
+            ''.join(struct.pack('<Q', v) for v in extraFields)
+    size, csize, offset = [0xFFFFFFFF if v >= ZIP64_LIMIT else v for v in (size, csize, offset)]
+    return struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | version, version, flags, method,
+                       dosTime, date, crc, csize, size, len(name), len(extra), 0, 0, 0,
+                       EXTERNAL_ATTR, offset) + name + extra
+
+
+def end_records(count, directorySize, directoryOffset):
+    '''return the records that close the archive, the ZIP64 ones are included only when needed'''
+    res = ''
+    if count >= 0xFFFF or directorySize >= ZIP64_LIMIT or directoryOffset >= ZIP64_LIMIT:
+        res += struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0,
+                           count, count, directorySize, directoryOffset)
+        res += struct.pack('<IIQI', 0x07064b50, 0, directoryOffset + directorySize, 1)
+        count = 0xFFFF
+        directorySize = directoryOffset = 0xFFFFFFFF
+    return res + struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, count, count,
+                             directorySize, directoryOffset, 0)